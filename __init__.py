@@ -1,31 +1,193 @@
 # File: __init__.py
+#
+# The app factory. Importing the package only creates the (unbound) extensions below, which keeps
+# it cheap; `create_app()` builds a configured app and pulls in the rest of the package.
 
+import gc
 import os
+import tempfile
 from dotenv import load_dotenv
 from flask import Flask
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_sqlalchemy import SQLAlchemy
-
-# Initialize Flask app
-app = Flask(__name__)
-
-# Set configuration variables
-load_dotenv()
-app.config['SECRET_KEY'] = '6e92377866688c1abde454b4443f811e'
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER')
-app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT'))
-app.config['MAIL_USE_TLS'] = (os.environ.get('MAIL_USE_TLS') == 'True')
-app.config['MAIL_USERNAME'] = os.environ.get('EMAIL_USER')
-app.config['MAIL_PASSWORD'] = os.environ.get('EMAIL_PASS')
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sahara import database
 
 # Register extensions
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-mail = Mail(app)
+db = database.RoutingSQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+mail = Mail()
 
-from sahara import routes
+
+def configure(app, config=None):
+    """
+    Sets the configuration variables of `app` from the environment (and .env file), overridden by
+    the dict `config`.
+    """
+    load_dotenv()
+    app.config['SECRET_KEY'] = '6e92377866688c1abde454b4443f811e'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['DATABASE_PROFILE'] = os.environ.get('DATABASE_PROFILE')
+    app.config['DATABASE_REPLICA_URI'] = os.environ.get('DATABASE_REPLICA_URI')
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+    app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 25))
+    app.config['MAIL_USE_TLS'] = (os.environ.get('MAIL_USE_TLS') == 'True')
+    app.config['MAIL_USERNAME'] = os.environ.get('EMAIL_USER')
+    app.config['MAIL_PASSWORD'] = os.environ.get('EMAIL_PASS')
+    app.config['MAIL_QUEUE_WORKERS'] = int(os.environ.get('MAIL_QUEUE_WORKERS', 2))
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+    app.config['PRINCIPAL_CACHE_TTL'] = float(os.environ.get('PRINCIPAL_CACHE_TTL', 0))
+    app.config['ROW_CACHE_TTL'] = float(os.environ.get('ROW_CACHE_TTL', 60))
+    app.config['ROW_CACHE_SIZE'] = int(os.environ.get('ROW_CACHE_SIZE', 10000))
+    app.config['ROW_CACHE_BACKEND'] = os.environ.get('ROW_CACHE_BACKEND', 'memory')
+    app.config['ROW_CACHE_SQLITE_PATH'] = os.environ.get(
+        'ROW_CACHE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'sahara_cache', 'rows.db'))
+    app.config['BESTSELLER_CACHE_TTL'] = float(os.environ.get('BESTSELLER_CACHE_TTL', 300))
+    app.config['RECOMMENDATIONS_TOP_K'] = int(os.environ.get('RECOMMENDATIONS_TOP_K', 10))
+    app.config['RECOMMENDATIONS_MIN_COUNT'] = int(os.environ.get('RECOMMENDATIONS_MIN_COUNT', 2))
+    app.config['RECOMMENDATIONS_STATE_PATH'] = os.environ.get(
+        'RECOMMENDATIONS_STATE_PATH', os.path.join(tempfile.gettempdir(), 'sahara_copurchase.npz'))
+    app.config['EMAIL_FILTER_ENABLED'] = (os.environ.get('EMAIL_FILTER_ENABLED', 'True') == 'True')
+    app.config['EMAIL_FILTER_REFRESH'] = float(os.environ.get('EMAIL_FILTER_REFRESH', 5))
+    app.config['EMAIL_FILTER_REBUILD'] = float(os.environ.get('EMAIL_FILTER_REBUILD', 3600))
+    app.config['SUGGEST_REFRESH_INTERVAL'] = float(os.environ.get('SUGGEST_REFRESH_INTERVAL', 5))
+    app.config['SUGGEST_REBUILD_INTERVAL'] = float(os.environ.get('SUGGEST_REBUILD_INTERVAL', 3600))
+    app.config['SEARCH_MIN_SIMILARITY'] = float(os.environ.get('SEARCH_MIN_SIMILARITY', 0.5))
+    app.config['RATELIMIT_ENABLED'] = (os.environ.get('RATELIMIT_ENABLED', 'True') == 'True')
+    app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND', 'memory')
+    app.config['RATELIMIT_SQLITE_PATH'] = os.environ.get(
+        'RATELIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'sahara_ratelimit.db'))
+    app.config['RATELIMIT_LOGIN_IP'] = os.environ.get('RATELIMIT_LOGIN_IP', '20/60')
+    app.config['RATELIMIT_LOGIN_EMAIL'] = os.environ.get('RATELIMIT_LOGIN_EMAIL', '5/60')
+    app.config['RATELIMIT_RESET_IP'] = os.environ.get('RATELIMIT_RESET_IP', '5/300')
+    app.config['RATELIMIT_RESET_EMAIL'] = os.environ.get('RATELIMIT_RESET_EMAIL', '3/900')
+    app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+    app.config['METRICS_ENABLED'] = (os.environ.get('METRICS_ENABLED', 'True') == 'True')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+    app.config['QUERY_COUNT_WARNING'] = int(os.environ.get('QUERY_COUNT_WARNING', 30))
+    app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+    app.config['PROFILE_RATE'] = float(os.environ.get('PROFILE_RATE', 0))
+    app.config['PROFILE_PATHS'] = os.environ.get('PROFILE_PATHS', '')
+    app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN')
+    app.config['PROFILE_DIR'] = os.environ.get(
+        'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'sahara_profiles'))
+    app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 500))
+    app.config['COMPRESS_ENABLED'] = (os.environ.get('COMPRESS_ENABLED', 'True') == 'True')
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['USE_X_SENDFILE'] = (os.environ.get('USE_X_SENDFILE') == 'True')
+    app.config['TEMPLATE_BYTECODE_DIR'] = os.environ.get(
+        'TEMPLATE_BYTECODE_DIR', os.path.join(tempfile.gettempdir(), 'sahara_templates'))
+    app.config['TEMPLATE_FRAGMENT_CACHE'] = (
+        os.environ.get('TEMPLATE_FRAGMENT_CACHE', 'True') == 'True')
+    app.config['PRELOAD'] = (os.environ.get('PRELOAD') == 'True')
+    app.config['SERVER_BIND'] = os.environ.get('SERVER_BIND', '127.0.0.1:8000')
+    app.config['SERVER_WORKERS'] = int(os.environ.get('SERVER_WORKERS', 2 * os.cpu_count() + 1))
+    app.config['SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS', 4))
+    app.config['SERVER_WORKER_CLASS'] = os.environ.get('SERVER_WORKER_CLASS', 'gthread')
+    app.config['SERVER_TIMEOUT'] = int(os.environ.get('SERVER_TIMEOUT', 30))
+    app.config['SERVER_GRACEFUL_TIMEOUT'] = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+    app.config['SERVER_MAX_REQUESTS'] = int(os.environ.get('SERVER_MAX_REQUESTS', 0))
+    app.config['SERVER_PIDFILE'] = os.environ.get('SERVER_PIDFILE')
+    app.config.update(config or {})
+
+    # Settings worked out from the ones above
+    app.config['DATABASE_PROFILE'] = database.profile_for(app.config['SQLALCHEMY_DATABASE_URI'],
+                                                          app.config['DATABASE_PROFILE'])
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          database.engine_options(app.config['DATABASE_PROFILE'], app.config))
+    if app.config['DATABASE_REPLICA_URI']:
+        app.config.setdefault('SQLALCHEMY_BINDS',
+                              {database.REPLICA_BIND: app.config['DATABASE_REPLICA_URI']})
+    app.config.setdefault('MAIL_DEFAULT_SENDER', ('Sahara Devs', app.config['MAIL_USERNAME']))
+
+
+def create_app(config=None):
+    """
+    Returns a new Sahara app, configured from the environment and the dict `config` (see
+    `configure()`).
+
+    With PRELOAD set, everything a worker would otherwise load on its first requests is loaded up
+    front (see `preload()`), for servers that create the app once and then fork their workers.
+    """
+    app = Flask(__name__)
+    configure(app, config)
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+    mail.init_app(app)
+
+    # Imported here rather than at the top, as they need the extensions above
+    from sahara import assets, compression, images, metrics, models, profiler, ratelimit, replica
+    from sahara import routes, storage, templating
+    models.init_app(app)
+    templating.init_app(app)
+    storage.init_app(app)
+    ratelimit.init_app(app)
+    assets.init_app(app)
+    images.init_app(app)
+    metrics.init_app(app)
+    replica.init_app(app)
+    app.register_blueprint(routes.bp)
+    compression.init_app(app)
+    profiler.init_app(app)
+
+    # Behind a reverse proxy every request comes from the proxy, so the client's address (which the
+    # rate limits are keyed on) is taken from the X-Forwarded-For header the proxies set instead
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    # Tune the database connections and check the settings took
+    with app.app_context():
+        engines = [db.get_engine()]
+        if database.REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {}):
+            engines.append(db.get_engine(bind=database.REPLICA_BIND))
+        if app.config['DATABASE_PROFILE'] == 'sqlite':
+            database.enable_sqlite_pragmas(engines, app.config)
+        for engine in engines:
+            database.check_engine(engine, app.config['DATABASE_PROFILE'], app.config)
+
+    if app.config['PRELOAD']:
+        preload(app)
+
+    return app
+
+
+def preload(app):
+    """
+    Loads the lookup tables, the filter of registered emails, the index of search suggestions and
+    every template of `app`, then moves everything allocated so far out of the garbage collector's
+    reach.
+
+    Workers forked afterwards share these pages with the parent copy-on-write. Freezing them stops
+    the collector from writing to every object it scans, which would give each worker its own copy.
+    """
+    from sahara import models
+
+    with app.app_context():
+        models.preload_lookups()
+        models.registered_emails.might_exist('')
+        models.book_suggestions.suggest('', 0)
+        db.session.remove()
+        # A connection must never be shared between processes
+        db.get_engine().dispose()
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,215 @@
+# File: assets.py
+#
+# Fingerprinted, precompressed copies of the static files.
+#
+# The build step copies every static file to static/dist under a name containing a hash of its
+# contents (e.g. CSS/main1.3f9a0c2b71de.css), writes gzip and brotli versions of the ones worth
+# compressing next to it, and records the mapping in static/dist/manifest.json. Since a changed
+# file gets a new name, the copies can be cached by browsers forever. Run it after changing any
+# static file, from the project root:
+#     python -m sahara.assets
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from os import path
+from flask import current_app, url_for
+from werkzeug.security import safe_join
+from sahara import create_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# Folders under static/ that aren't part of the build (the build's own output and book covers,
+# which are uploaded at run time)
+EXCLUDED_DIRS = (DIST_DIR, path.join('img', 'books'))
+
+# Extensions worth compressing; images are already compressed
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt', '.html')
+
+# Precompressed variants, in order of preference, as (Content-Encoding, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# url(...) references in stylesheets
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+# A fingerprinted file never changes, so it can be cached for as long as browsers allow
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+####################################################################################################
+#                                              BUILD                                               #
+####################################################################################################
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def compress(file_path, data):
+    """
+    Writes .gz (and, if the brotli module is installed, .br) versions of `data`, the contents of
+    `file_path`, next to it, keeping only the ones that are meaningfully smaller than the original.
+    """
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < 0.9 * len(data):
+            with open(file_path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def rewrite_css_urls(css, css_path, manifest):
+    """
+    Points the relative url(...) references in the stylesheet `css`, found at `css_path` under
+    static/, at the fingerprinted copies of the files they refer to.
+    """
+    def replace(match):
+        quote, url = match.groups()
+        if '://' in url or url.startswith(('/', 'data:', '#')):
+            return match.group(0)
+
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), url))
+        if target not in manifest:
+            return match.group(0)
+
+        # static/dist mirrors static/, so the stylesheet's copy is in the same folder as it
+        hashed = posixpath.relpath(manifest[target], posixpath.dirname(css_path))
+        return f'url({quote}{hashed}{quote})'
+
+    return CSS_URL.sub(replace, css)
+
+
+def build(static_dir=None):
+    """
+    Rebuilds static/dist from the files in `static_dir` (the app's static folder by default) and
+    returns the manifest, which maps each file's path to its fingerprinted path.
+    """
+    static_dir = static_dir or current_app.static_folder
+    dist_dir = path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    sources = {}
+    for root, dirs, files in os.walk(static_dir):
+        relative_root = path.relpath(root, static_dir)
+        dirs[:] = [d for d in dirs
+                   if path.normpath(path.join(relative_root, d)) not in EXCLUDED_DIRS]
+        for name in files:
+            relative = path.normpath(path.join(relative_root, name)).replace(os.sep, '/')
+            sources[relative] = path.join(root, name)
+
+    # Stylesheets go last, since their fingerprints depend on those of the files they reference
+    manifest = {}
+    for relative in sorted(sources, key=lambda name: (name.endswith('.css'), name)):
+        with open(sources[relative], 'rb') as f:
+            data = f.read()
+
+        stem, ext = path.splitext(relative)
+        if ext == '.css':
+            css = rewrite_css_urls(data.decode('utf-8'), relative, manifest)
+            data = css.encode('utf-8')
+
+        hashed = f'{stem}.{fingerprint(data)}{ext}'
+        manifest[relative] = hashed
+        dest = path.join(dist_dir, *hashed.split('/'))
+        os.makedirs(path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(data)
+
+        if ext.lower() in COMPRESSIBLE:
+            compress(dest, data)
+
+    with open(path.join(dist_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+####################################################################################################
+#                                             SERVING                                              #
+####################################################################################################
+
+
+def load_manifest(static_dir):
+    """
+    Returns the manifest written by the last build into `static_dir`, or an empty one if there
+    hasn't been one.
+    """
+    try:
+        with open(path.join(static_dir, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def init_app(app):
+    """
+    Loads the manifest of the last build for `app` and makes `asset_url()` available to its
+    templates.
+    """
+    app.extensions['sahara_assets'] = load_manifest(app.static_folder)
+    app.add_template_global(asset_url)
+
+
+def asset_url(filename):
+    """
+    Returns the URL of the fingerprinted copy of the static file `filename` (e.g. "CSS/main1.css"),
+    or its plain /static URL if it isn't part of the last build.
+    """
+    hashed = current_app.extensions['sahara_assets'].get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('main.asset', filename=hashed)
+
+
+def find_variant(filename, accept_encodings):
+    """
+    Returns the path on disk of the best version of the built file `filename` the client accepts
+    (going by the request's `accept_encodings`), and the Content-Encoding to send it with (`None`
+    for the uncompressed file). The path is `None` if `filename` is outside static/dist.
+    """
+    file_path = safe_join(path.join(current_app.static_folder, DIST_DIR), filename)
+    if file_path is None:
+        return None, None
+
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] > 0 and path.isfile(file_path + suffix):
+            return file_path + suffix, encoding
+    return file_path, None
+
+
+def guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        built = build()
+    print(f'Built {len(built)} assets into {path.join(app.static_folder, DIST_DIR)}.')
+
+
+if __name__ == '__main__':
+    main()
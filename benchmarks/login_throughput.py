@@ -0,0 +1,142 @@
+# File: benchmarks/login_throughput.py
+#
+# Measures login throughput, and the latency of browse traffic served alongside a login burst, with
+# bcrypt run inline on the request threads versus in the password hashing pool.
+#
+# Run from the project root:
+#     python -m sahara.benchmarks.login_throughput [--threads 16] [--seconds 10] [--workers 2]
+
+import argparse
+import statistics
+import tempfile
+import threading
+import time
+from os import path
+from sahara import create_app, db, passwords
+from sahara.models import User, States
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+PASSWORD = 'benchmark-password'
+
+
+####################################################################################################
+#                                        UTILITY FUNCTIONS                                         #
+####################################################################################################
+
+
+def setup_database(num_users):
+    db.create_all()
+
+    pw_hash = passwords.hash_password(PASSWORD)
+
+    # The admin goes in first, as in setup.py
+    User(
+        email='admin@sahara.com',
+        password=pw_hash,
+        is_subscribed=False,
+        first_name='Sahara',
+        last_name='Devs',
+        phone_number='0123456789'
+    ).commit_to_system()
+
+    emails = []
+    for i in range(num_users):
+        user = User(
+            email=f'bench{i}@sahara.com',
+            password=pw_hash,
+            is_subscribed=False,
+            first_name='Bench',
+            last_name=str(i),
+            phone_number='0123456789'
+        )
+        user.commit_to_system()
+        user.set_user_state(States.ACTIVE.value)
+        emails.append(user.email)
+
+    return emails
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def run_burst(app, emails, num_threads, seconds):
+    """
+    Runs `num_threads` login loops and one browse loop against `app` for `seconds`, and returns the
+    number of completed logins and the browse latencies observed (in seconds).
+    """
+    deadline = time.perf_counter() + seconds
+    logins = []
+    browse_latencies = []
+
+    def login_loop(email):
+        count = 0
+        while time.perf_counter() < deadline:
+            client = app.test_client()
+            client.post('/login', data={'email': email, 'password': PASSWORD})
+            count += 1
+        logins.append(count)
+
+    def browse_loop():
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            client.get('/login')
+            browse_latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=login_loop, args=(emails[i % len(emails)],))
+               for i in range(num_threads)]
+    threads.append(threading.Thread(target=browse_loop))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(logins), browse_latencies
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput benchmark')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent login threads')
+    parser.add_argument('--seconds', type=float, default=10.0, help='length of each burst')
+    parser.add_argument('--workers', type=int, default=2, help='hashing pool size')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path.join(tmp_dir, "bench.db")}',
+            'WTF_CSRF_ENABLED': False,
+            'RATELIMIT_ENABLED': False,
+        })
+        app.app_context().push()
+        emails = setup_database(args.threads)
+
+        print(f'bcrypt rounds: {app.config["BCRYPT_LOG_ROUNDS"]}, '
+              f'login threads: {args.threads}, burst: {args.seconds}s')
+        print(f'{"mode":<12}{"logins/s":>10}{"browse p50":>14}{"browse p95":>14}')
+        for mode, workers in (('inline', 0), (f'pool({args.workers})', args.workers)):
+            passwords.shutdown()
+            app.config['PASSWORD_HASH_WORKERS'] = workers
+
+            logins, latencies = run_burst(app, emails, args.threads, args.seconds)
+            print(f'{mode:<12}{logins / args.seconds:>10.1f}'
+                  f'{statistics.median(latencies) * 1000:>12.1f}ms'
+                  f'{percentile(latencies, 95) * 1000:>12.1f}ms')
+
+        passwords.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+# File: benchmarks/suite.py
+#
+# Times the model methods and pages that matter most for performance (searching, adding to the
+# cart, checking out, loading the logged in user and rendering the homepage) against a seeded SQLite
+# database at one or more scales, and compares the results with a saved baseline.
+#
+# Run from the project root:
+#     python -m sahara.benchmarks.suite [--scale small,large] [--output results.json]
+#                                       [--baseline benchmarks/baseline.json] [--save-baseline]
+#
+# The seeded databases are cached in --data-dir, so only the first run at each scale pays for
+# building them. Each run works on a copy, so the cases that write don't drift between runs.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+from os import path
+import flask
+import sqlalchemy
+from flask import current_app, render_template
+from sahara import create_app, database, db, fixtures
+from sahara.fixtures import TITLE_WORDS
+from sahara.models import (Book, Categories, User, bestseller_cache, book_suggestions, load_user,
+                           principal_cache, registered_emails, row_cache)
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Number of (books, users, past orders) at each scale
+SCALES = {
+    'small': (1_000, 10_000, 20_000),
+    'large': (100_000, 1_000_000, 1_000_000),
+}
+NUM_PROMOTIONS = 24
+
+# The data is generated as of this date, rather than today, so that it's the same on every run
+DATA_DATE = date(2024, 1, 1)
+
+# Bumped whenever the seeded data changes, so that stale cached databases aren't reused
+DATA_VERSION = 3
+
+# A case is run at least MIN_ITERATIONS times, then until it has run for --min-time seconds or
+# MAX_ITERATIONS times
+MIN_ITERATIONS = 5
+MAX_ITERATIONS = 500
+
+
+####################################################################################################
+#                                          SEEDED DATABASE                                         #
+####################################################################################################
+
+
+def prepare_database(app, scale, seed, data_dir, work_dir):
+    """
+    Points `app` at a fresh copy of the seeded database for `scale`, building it first if it isn't
+    cached in `data_dir`.
+    """
+    num_books, num_users, num_orders = SCALES[scale]
+    cached_path = path.join(data_dir, f'{scale}-seed{seed}-v{DATA_VERSION}.db')
+
+    if not path.isfile(cached_path):
+        print(f'Building the {scale} database ({num_books} books, {num_users} users, '
+              f'{num_orders} orders)...')
+        started = time.perf_counter()
+        building_path = cached_path + '.building'
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{building_path}'
+        with app.app_context():
+            db.create_all()
+            fixtures.generate(num_books, num_users, num_orders=num_orders,
+                              num_promotions=NUM_PROMOTIONS, seed=seed, today=DATA_DATE,
+                              placeholder_covers=False)
+            db.session.remove()
+            db.engine.dispose()
+
+        # Fold the WAL back into the file so that a plain copy of it is complete
+        with sqlite3.connect(building_path) as connection:
+            connection.execute('PRAGMA journal_mode=DELETE')
+        shutil.move(building_path, cached_path)
+        print(f'Built in {time.perf_counter() - started:.1f}s')
+
+    work_path = path.join(work_dir, f'{scale}.db')
+    shutil.copyfile(cached_path, work_path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{work_path}'
+    with app.app_context():
+        # A new engine is made for the new database, which needs the pragmas create_app() set up
+        database.enable_sqlite_pragmas([db.get_engine()], app.config)
+
+    # Nothing the previous scale's database left in this process' caches and indexes may be used
+    for cache in (row_cache, bestseller_cache, principal_cache):
+        cache.clear()
+    registered_emails.reset()
+    book_suggestions.reset()
+    return num_books, num_users
+
+
+####################################################################################################
+#                                              CASES                                               #
+####################################################################################################
+
+# Each case takes the number of books and users and a seeded Random, and returns a `prepare()`
+# function, run untimed before each iteration, and a `run(*prepared)` function that is timed.
+
+
+def case_book_search(num_books, num_users, rng):
+    def prepare():
+        return (rng.choice(TITLE_WORDS),)
+
+    return prepare, Book.search
+
+
+def case_load_user(num_books, num_users, rng):
+    def prepare():
+        return (str(rng.randint(2, num_users + 1)),)
+
+    return prepare, load_user
+
+
+def case_cart_add_book(num_books, num_users, rng):
+    def prepare():
+        user = User.query.get(rng.randint(2, num_users + 1))
+        return user.cart, Book.query.get(rng.randint(1, num_books))
+
+    def run(cart, book):
+        cart.add_book(book)
+
+    return prepare, run
+
+
+def case_confirm_order(num_books, num_users, rng):
+    def prepare():
+        user = User.query.get(rng.randint(2, num_users + 1))
+        user.cart.add_book(Book.query.get(rng.randint(1, num_books)))
+        return (user,)
+
+    def run(user):
+        user.confirm_order()
+
+    return prepare, run
+
+
+def case_home_route(num_books, num_users, rng):
+    client = current_app.test_client()
+
+    def prepare():
+        return ()
+
+    def run():
+        response = client.get('/home')
+        assert response.status_code == 200, response.status_code
+
+    return prepare, run
+
+
+def case_home_template(num_books, num_users, rng):
+    # Just the template, with everything it shows already loaded
+    books = Book.get_all()
+    almost_gone = Book.search_by_quantity().all()
+    mystery = Book.search_by_category(Categories.MYSTERY.value)
+    bestsellers = Book.bestsellers(limit=3)
+    for book in books:
+        book.cover_image, book.authors
+
+    def prepare():
+        return ()
+
+    def run():
+        with current_app.test_request_context('/home'):
+            render_template('homepage.html', books=books, len=len(books),
+                            almost_gone=almost_gone, mystery=mystery, len_myst=len(mystery),
+                            bestsellers=bestsellers)
+
+    return prepare, run
+
+
+def case_rank_bestsellers(num_books, num_users, rng):
+    # The ranking itself, as run once per BESTSELLER_CACHE_TTL
+    def prepare():
+        bestseller_cache.clear()
+        return (rng.choice([None] + [category.value for category in Categories]),)
+
+    return prepare, Book.bestsellers
+
+
+def case_suggest(num_books, num_users, rng):
+    # Prefixes of one to four letters, as typed into the search bar
+    def prepare():
+        word = rng.choice(TITLE_WORDS)
+        return word[:rng.randint(1, 4)], 8
+
+    return prepare, book_suggestions.suggest
+
+
+def misspelled_words(rng):
+    # Two title words, one missing a letter, as a search typed in a hurry
+    words = rng.sample(TITLE_WORDS, 2)
+    i = rng.randrange(len(words[1]))
+    return f'{words[0]} {words[1][:i]}{words[1][i + 1:]}'
+
+
+def case_like_typo(num_books, num_users, rng):
+    # The LIKE search, which finds nothing for these
+    def prepare():
+        return (misspelled_words(rng),)
+
+    return prepare, Book.search
+
+
+def case_trigram_typo(num_books, num_users, rng):
+    # The trigram search that the search page falls back on when LIKE finds nothing
+    def prepare():
+        return (misspelled_words(rng),)
+
+    return prepare, Book.search_similar
+
+
+CASES = {
+    'book_search': case_book_search,
+    'load_user': case_load_user,
+    'cart_add_book': case_cart_add_book,
+    'confirm_order': case_confirm_order,
+    'home_route': case_home_route,
+    'home_template': case_home_template,
+    'bestsellers': case_rank_bestsellers,
+    'suggest': case_suggest,
+    'like_typo': case_like_typo,
+    'trigram_typo': case_trigram_typo,
+}
+
+
+####################################################################################################
+#                                              RUNNER                                              #
+####################################################################################################
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def run_case(app, make_case, num_books, num_users, seed, min_time):
+    """
+    Times one case against `app` and returns statistics of its iterations, in milliseconds.
+    """
+    rng = random.Random(seed)
+    with app.app_context():
+        prepare, run = make_case(num_books, num_users, rng)
+
+        # One untimed run to warm up caches and compiled statements
+        run(*prepare())
+        db.session.remove()
+
+        timings = []
+        started = time.perf_counter()
+        while len(timings) < MAX_ITERATIONS and (len(timings) < MIN_ITERATIONS
+                                                 or time.perf_counter() - started < min_time):
+            args = prepare()
+            start = time.perf_counter()
+            run(*args)
+            timings.append(time.perf_counter() - start)
+
+            # Like the end of a request, so nothing is served from the last iteration's session
+            db.session.remove()
+
+    timings = [t * 1000 for t in timings]
+    return {
+        'iterations': len(timings),
+        'mean_ms': round(statistics.mean(timings), 4),
+        'median_ms': round(statistics.median(timings), 4),
+        'p95_ms': round(percentile(timings, 95), 4),
+        'min_ms': round(min(timings), 4),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each case's median against the baseline's, and returns the (scale, case) pairs that are
+    more than `threshold` (e.g. 0.1 for 10%) slower.
+    """
+    regressions = []
+    print(f'\n{"scale":<8}{"case":<16}{"baseline":>12}{"current":>12}{"change":>10}')
+    for scale, cases in results.items():
+        for case, stats in cases.items():
+            before = baseline.get(scale, {}).get(case)
+            if before is None:
+                continue
+
+            change = stats['median_ms'] / before['median_ms'] - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((scale, case))
+            elif change < -threshold:
+                flag = '  faster'
+            print(f'{scale:<8}{case:<16}{before["median_ms"]:>10.3f}ms'
+                  f'{stats["median_ms"]:>10.3f}ms{change:>+10.1%}{flag}')
+    return regressions
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model, route and template benchmarks')
+    parser.add_argument('--scale', default='small',
+                        help=f'comma-separated scales to run: {", ".join(SCALES)}')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='comma-separated cases to run (default: all)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the data and the cases')
+    parser.add_argument('--min-time', type=float, default=2.0,
+                        help='seconds to keep repeating each case for')
+    parser.add_argument('--data-dir', default=path.join(tempfile.gettempdir(), 'sahara_bench'),
+                        help='where seeded databases are cached')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=path.join(path.dirname(__file__), 'baseline.json'),
+                        help='results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save these results as the baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown (as a fraction) reported as a regression')
+    args = parser.parse_args()
+
+    scales = args.scale.split(',')
+    cases = args.cases.split(',')
+    for name in scales:
+        if name not in SCALES:
+            parser.error(f'unknown scale {name!r}')
+    for name in cases:
+        if name not in CASES:
+            parser.error(f'unknown case {name!r}')
+    # Found out before spending minutes on the cases rather than after
+    if not args.save_baseline and not path.isfile(args.baseline):
+        parser.error(f'no baseline at {args.baseline}; run with --save-baseline to make one')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Pointed at each scale's database in turn by prepare_database()
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path.join(work_dir, "empty.db")}',
+            'WTF_CSRF_ENABLED': False,
+            'METRICS_ENABLED': False,
+            'RATELIMIT_ENABLED': False,
+        })
+
+        os.makedirs(args.data_dir, exist_ok=True)
+        for scale in scales:
+            num_books, num_users = prepare_database(app, scale, args.seed, args.data_dir,
+                                                    work_dir)
+            results[scale] = {}
+            for case in cases:
+                stats = run_case(app, CASES[case], num_books, num_users, args.seed,
+                                 args.min_time)
+                results[scale][case] = stats
+                print(f'{scale:<8}{case:<16}{stats["median_ms"]:>10.3f}ms median '
+                      f'{stats["p95_ms"]:>10.3f}ms p95  ({stats["iterations"]} runs)')
+            with app.app_context():
+                db.engine.dispose()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'flask': flask.__version__,
+            'sqlalchemy': sqlalchemy.__version__,
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved the baseline to {args.baseline}')
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if compare(results, baseline['results'], args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+import os
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from os import path
+from threading import Lock, local
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# A SQLiteCacheBackend drops its expired entries, and its oldest ones past `max_size`, once every
+# this many sets
+SQLITE_PRUNE_EVERY = 100
+
+
+####################################################################################################
+#                                          CACHE REGIONS                                           #
+####################################################################################################
+
+
+class LRUBackend:
+    """
+    Keeps up to `max_size` entries in this process' memory, dropping the least recently used one to
+    make room for a new one.
+
+    Each worker process has its own copy, so an entry invalidated in one process lives on in the
+    others until it expires. Use `SQLiteCacheBackend` to share entries between workers on the same
+    host.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._lock = Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value, tags = entry
+            if expires_at < now:
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags, expires_at):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, value, tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    self._remove(key)
+
+    def invalidate_keys(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+class SQLiteCacheBackend:
+    """
+    Keeps up to about `max_size` entries in a SQLite file shared by every worker on the host, so
+    that invalidating an entry in one process invalidates it everywhere. Expired entries are dropped
+    as they're read, and every SQLITE_PRUNE_EVERY sets along with the entries closest to expiring
+    past `max_size`.
+
+    The file and its folder are made readable by their owner only, as entries may hold personal
+    data.
+    """
+
+    def __init__(self, db_path, max_size=10000):
+        self.db_path = db_path
+        self.max_size = max_size
+        self._local = local()
+        self._sets = 0
+        self._sets_lock = Lock()
+
+        make_private_file(db_path)
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_entry '
+                               '(key TEXT PRIMARY KEY, value BLOB, expires_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_entry_expires_at '
+                               'ON cache_entry (expires_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_tag (tag TEXT, key TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_tag ON cache_tag (tag)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_tag_key ON cache_tag (key)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads or processes, so keep one per thread,
+        # and open a new one in a worker forked after the backend was created
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key, now):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM cache_entry WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, expires_at = row
+        if expires_at < now:
+            self.invalidate_keys([key])
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, tags, expires_at):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+            connection.execute('INSERT OR REPLACE INTO cache_entry (key, value, expires_at) '
+                               'VALUES (?, ?, ?)', (key, pickle.dumps(value), expires_at))
+            connection.executemany('INSERT INTO cache_tag (tag, key) VALUES (?, ?)',
+                                   [(tag, key) for tag in tags])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        with self._sets_lock:
+            self._sets += 1
+            due = self._sets % SQLITE_PRUNE_EVERY == 0
+        if due:
+            self.prune(time.time())
+
+    def prune(self, now):
+        """
+        Drops the entries that expired before `now`, then those closest to expiring until at most
+        `max_size` are left.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache_entry WHERE expires_at < ?', (now,))
+            (count,) = connection.execute('SELECT COUNT(*) FROM cache_entry').fetchone()
+            if count > self.max_size:
+                connection.execute('DELETE FROM cache_entry WHERE key IN (SELECT key FROM '
+                                   'cache_entry ORDER BY expires_at LIMIT ?)',
+                                   (count - self.max_size,))
+            connection.execute('DELETE FROM cache_tag WHERE key NOT IN '
+                               '(SELECT key FROM cache_entry)')
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def invalidate(self, tags):
+        connection = self._connection()
+        placeholders = ', '.join('?' * len(tags))
+        keys = [key for (key,) in connection.execute(
+            f'SELECT DISTINCT key FROM cache_tag WHERE tag IN ({placeholders})', list(tags))]
+        self.invalidate_keys(keys)
+
+    def invalidate_keys(self, keys):
+        if not keys:
+            return
+
+        connection = self._connection()
+        placeholders = ', '.join('?' * len(keys))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(f'DELETE FROM cache_entry WHERE key IN ({placeholders})', keys)
+            connection.execute(f'DELETE FROM cache_tag WHERE key IN ({placeholders})', keys)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM cache_entry')
+        connection.execute('DELETE FROM cache_tag')
+
+    def __len__(self):
+        (count,) = self._connection().execute('SELECT COUNT(*) FROM cache_entry').fetchone()
+        return count
+
+
+def make_private_file(file_path):
+    """
+    Creates `file_path` (and its folder) if needed, readable and writable by this user only, and
+    raises a `PermissionError` if its folder is another user's or open to others.
+    """
+    folder = path.dirname(path.abspath(file_path))
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        folder_stat = os.stat(folder)
+        if folder_stat.st_uid != os.getuid() or folder_stat.st_mode & 0o077:
+            raise PermissionError(f'{folder} must belong to this user and be private (mode 700)')
+
+    os.close(os.open(file_path, os.O_CREAT | os.O_RDWR, 0o600))
+    os.chmod(file_path, 0o600)
+
+
+# Every CacheRegion created, by name, so that their counts can be reported (see sahara.metrics)
+regions = {}
+
+
+class CacheRegion:
+    """
+    A named cache whose entries expire `ttl` seconds after being set and can be invalidated early
+    by any of the tags they were stored with (e.g. `'Book:5'` for everything built from that row).
+
+    Entries are kept by `backend` (see `LRUBackend` and `SQLiteCacheBackend`); until one is given,
+    or with `ttl <= 0`, the region is disabled and every lookup misses. Hits, misses, sets and
+    invalidations are counted per process.
+
+    Keys and tags must be strings for `SQLiteCacheBackend`; `LRUBackend` takes any hashable key.
+    """
+
+    def __init__(self, name, backend=None, ttl=0):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self.counts = {'hit': 0, 'miss': 0, 'set': 0, 'invalidate': 0}
+        self._counts_lock = Lock()
+        regions[name] = self
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    def _count(self, event, amount=1):
+        with self._counts_lock:
+            self.counts[event] += amount
+
+    def get(self, key):
+        """
+        Returns the value stored under `key`, or `None` if there is none or it has expired.
+        """
+        if not self.enabled:
+            return None
+
+        value = self.backend.get(key, time.time())
+        self._count('miss' if value is None else 'hit')
+        return value
+
+    def set(self, key, value, tags=()):
+        """
+        Stores `value` under `key` for the next `ttl` seconds, or until one of `tags` is
+        invalidated.
+        """
+        if not self.enabled:
+            return
+
+        self.backend.set(key, value, tuple(tags), time.time() + self.ttl)
+        self._count('set')
+
+    def invalidate(self, tags):
+        """
+        Removes every entry stored with any of `tags`.
+        """
+        tags = tuple(tags)
+        if not self.enabled or not tags:
+            return
+
+        self.backend.invalidate(tags)
+        self._count('invalidate', len(tags))
+
+    def pop(self, key):
+        """
+        Removes the entry stored under `key`, if there is one.
+        """
+        if self.enabled:
+            self.backend.invalidate_keys([key])
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
@@ -0,0 +1,205 @@
+# File: compression.py
+#
+# Compressing responses on the fly.
+#
+# A WSGI middleware gzip or brotli (if the optional brotli package is installed) compresses text
+# responses for browsers that accept it, picking whichever the browser prefers. Responses smaller
+# than COMPRESS_MIN_SIZE, already encoded ones (such as the precompressed files served from
+# /assets), partial ones (206, for a Range request) and anything that isn't text are passed through
+# untouched. A compressed response's strong ETag is made weak, as it no longer names these exact
+# bytes. Streamed responses are compressed chunk by chunk, flushing after each one, so the browser
+# gets each chunk as soon as the app produces it.
+
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+COMPRESSIBLE_TYPES = frozenset((
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+))
+
+# Statuses whose responses have no body
+BODILESS_STATUSES = (204, 304)
+
+# Partial Content: its byte range is of the uncompressed body, which compressing would garble
+PARTIAL_CONTENT = 206
+
+
+####################################################################################################
+#                                             ENCODERS                                             #
+####################################################################################################
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        # wbits=31 writes the gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def process(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+####################################################################################################
+#                                            MIDDLEWARE                                            #
+####################################################################################################
+
+
+class CompressionMiddleware:
+    """
+    Wraps `wsgi_app`, compressing the text responses of at least `min_size` bytes for browsers that
+    accept gzip (at `level`, 1-9) or brotli (at `brotli_quality`, 0-11).
+    """
+
+    def __init__(self, wsgi_app, level=6, brotli_quality=5, min_size=1024):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+
+    def choose_encoding(self, environ):
+        """
+        Returns the encoding the browser making the request prefers, 'br' or 'gzip', or None if it
+        accepts neither.
+        """
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        candidates = [('gzip', accepted.quality('gzip'))]
+        if brotli is not None:
+            # Listed first, so that it wins ties, as it compresses better
+            candidates.insert(0, ('br', accepted.quality('br')))
+
+        encoding, quality = max(candidates, key=lambda candidate: candidate[1])
+        return encoding if quality > 0 else None
+
+    def is_compressible(self, status, headers):
+        """
+        Returns whether a response with the `status` code and `headers` is worth compressing.
+        """
+        if status < 200 or status in BODILESS_STATUSES or 'Content-Encoding' in headers:
+            return False
+        if status == PARTIAL_CONTENT or 'Content-Range' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+
+        mimetype = parse_options_header(headers.get('Content-Type', ''))[0]
+        if mimetype not in COMPRESSIBLE_TYPES:
+            return False
+
+        content_length = headers.get('Content-Length', type=int)
+        return content_length is None or content_length >= self.min_size
+
+    def make_encoder(self, encoding):
+        if encoding == 'br':
+            return BrotliEncoder(self.brotli_quality)
+        return GzipEncoder(self.level)
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        # Filled in by start_response(), which the app calls before producing any of the body
+        response = {'started': False, 'encoder': None, 'streamed': False}
+
+        def compressing_start_response(status_line, header_list, exc_info=None):
+            response['started'] = True
+            headers = Headers(header_list)
+            if self.is_compressible(int(status_line.split(' ', 1)[0]), headers):
+                vary = headers.get('Vary')
+                if not vary:
+                    headers['Vary'] = 'Accept-Encoding'
+                elif 'accept-encoding' not in vary.lower():
+                    headers['Vary'] = f'{vary}, Accept-Encoding'
+
+                if encoding is not None:
+                    response['encoder'] = self.make_encoder(encoding)
+                    response['streamed'] = 'Content-Length' not in headers
+                    headers['Content-Encoding'] = encoding
+                    headers.remove('Content-Length')
+                    etag = headers.get('ETag')
+                    if etag and not etag.startswith('W/'):
+                        # The compressed body isn't byte-for-byte the one the strong ETag names
+                        headers['ETag'] = f'W/{etag}'
+
+            return start_response(status_line, headers.to_wsgi_list(), exc_info)
+
+        body = self.wsgi_app(environ, compressing_start_response)
+        # Hand back uncompressed bodies as they are, so that files still reach the server's
+        # wsgi.file_wrapper (and sendfile())
+        if encoding is None or (response['started'] and response['encoder'] is None):
+            return body
+        return self.compress(body, response)
+
+    def compress(self, body, response):
+        """
+        Yields the chunks of `body` compressed with the encoder start_response() picked, if any.
+        """
+        try:
+            for chunk in body:
+                encoder = response['encoder']
+                if encoder is None:
+                    yield chunk
+                    continue
+
+                data = encoder.process(chunk)
+                if response['streamed']:
+                    data += encoder.flush()
+                if data:
+                    yield data
+
+            if response['encoder'] is not None:
+                yield response['encoder'].finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def init_app(app):
+    """
+    Wraps `app` in a `CompressionMiddleware`, unless COMPRESS_ENABLED is off (e.g. because a
+    front-end server compresses responses already).
+    """
+    if app.config['COMPRESS_ENABLED']:
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                             level=app.config['COMPRESS_LEVEL'],
+                                             brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+                                             min_size=app.config['COMPRESS_MIN_SIZE'])
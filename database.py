@@ -0,0 +1,185 @@
+import logging
+import weakref
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+####################################################################################################
+#                                         ENGINE PROFILES                                          #
+####################################################################################################
+
+# Each profile tunes the SQLAlchemy engine for one kind of database. The profile is picked with
+# DATABASE_PROFILE, or from the scheme of DATABASE_URI if that isn't set.
+
+PROFILES = ('sqlite', 'mysql', 'default')
+
+# What PRAGMA synchronous reads back as
+SYNCHRONOUS_LEVELS = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+
+logger = logging.getLogger(__name__)
+
+
+def profile_for(uri, profile=None):
+    """
+    Returns the name of the profile to use for the database at `uri`: `profile` if given, otherwise
+    the one matching its scheme.
+    """
+    if profile:
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown DATABASE_PROFILE {profile!r}, expected one of {PROFILES}')
+        return profile
+
+    scheme = (uri or '').split(':', 1)[0]
+    if scheme.startswith('sqlite'):
+        return 'sqlite'
+    if scheme.startswith('mysql'):
+        return 'mysql'
+    return 'default'
+
+
+def engine_options(profile, config):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS for `profile`, with sizes and timeouts from `config`.
+    """
+    if profile == 'sqlite':
+        # SQLAlchemy doesn't pool connections to SQLite files by default, which would mean opening
+        # a connection (and running the pragmas below) on every request. A connection is only ever
+        # used by one thread at a time once it's pooled, so it's safe to hand between threads.
+        return {
+            'poolclass': QueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'connect_args': {'check_same_thread': False},
+        }
+
+    if profile == 'mysql':
+        # MySQL closes connections that have been idle for wait_timeout (8 hours by default), so
+        # recycle them well before that and check each one is alive before it's handed out
+        return {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': True,
+        }
+
+    return {}
+
+
+####################################################################################################
+#                                          SQLITE PRAGMAS                                          #
+####################################################################################################
+
+
+def sqlite_pragmas(config):
+    """
+    Returns the pragmas run on every new SQLite connection.
+
+    In WAL mode readers don't block the writer and the writer doesn't block readers, so browsing
+    carries on while a checkout commits. synchronous=NORMAL is safe in WAL mode (a power cut can
+    lose the last commits, but never corrupts the database) and saves an fsync per commit.
+    """
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': config['SQLITE_MMAP_SIZE'],
+        'busy_timeout': config['SQLITE_BUSY_TIMEOUT'],
+    }
+
+
+def enable_sqlite_pragmas(engines, config):
+    """
+    Makes every connection the SQLite engines among `engines` open from now on run
+    `sqlite_pragmas(config)`. Engines for other databases are left alone, and an engine is only
+    ever given the listener once.
+    """
+    pragmas = sqlite_pragmas(config)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    for engine in engines:
+        if engine.dialect.name == 'sqlite' and engine not in _pragma_engines:
+            event.listen(engine, 'connect', set_pragmas)
+            _pragma_engines.add(engine)
+
+
+# Engines already running the pragmas on connect
+_pragma_engines = weakref.WeakSet()
+
+
+####################################################################################################
+#                                          STARTUP CHECK                                           #
+####################################################################################################
+
+
+def check_engine(engine, profile, config):
+    """
+    Logs a summary of the settings `engine` actually ended up with at INFO, and warns about any
+    SQLite pragma that didn't take (e.g. WAL mode isn't available on some network file systems).
+
+    Warnings reach stderr even if logging was never configured, so a setting that didn't take is
+    noticed; the summary only shows up once INFO logging is turned on.
+    """
+    options = {name: value for name, value in engine_options(profile, config).items()
+               if name not in ('poolclass', 'connect_args')}
+
+    if profile == 'sqlite':
+        with engine.connect() as connection:
+            for name, expected in sqlite_pragmas(config).items():
+                actual = connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+                if name == 'synchronous':
+                    actual = SYNCHRONOUS_LEVELS.get(actual, actual)
+
+                options[name] = actual
+                if str(actual).lower() != str(expected).lower():
+                    logger.warning('SQLite %s is %s rather than %s', name, actual, expected)
+
+        # Don't keep the connection around: the app may be imported before the server forks its
+        # workers, and a connection must never be shared between processes
+        engine.dispose()
+
+    logger.info('Database profile %r: %s, %s %s', profile, engine.url.get_backend_name(),
+                type(engine.pool).__name__, options)
+
+
+####################################################################################################
+#                                          READ REPLICAS                                           #
+####################################################################################################
+
+
+# Name of the bind in SQLALCHEMY_BINDS that read-only requests are served from
+REPLICA_BIND = 'replica'
+
+
+def reading_from_replica():
+    """
+    Returns whether the SELECTs of the current request go to the replica, which may lag behind the
+    primary, so that what they read shouldn't be cached.
+    """
+    return has_request_context() and bool(g.get('use_replica'))
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends SELECTs to the replica bind while `g.use_replica` is set (see
+    `sahara.replica.read_only`), and everything else to the primary database.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (reading_from_replica() and not self._flushing
+                and getattr(clause, 'is_select', False)):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy using `RoutingSession` for its sessions.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,194 @@
+import math
+import time
+from hashlib import blake2b
+from threading import Lock
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Smallest number of emails an EmailFilter makes room for
+MIN_CAPACITY = 1024
+
+# Ids below the highest one seen that are read again on every refresh. Ids are handed out when a
+# row is inserted but seen when it's committed, so on MySQL a User can show up after another User
+# with a higher id, registered at about the same time.
+REFRESH_OVERLAP = 1000
+
+
+####################################################################################################
+#                                         UTILITY FUNCTIONS                                        #
+####################################################################################################
+
+
+def normalize_email(email):
+    """
+    Returns `email` as it's matched against registered emails: without surrounding whitespace and
+    casefolded, since emails are looked up without regard to case.
+    """
+    return email.strip().casefold()
+
+
+####################################################################################################
+#                                           BLOOM FILTER                                           #
+####################################################################################################
+
+
+class BloomFilter:
+    """
+    A fixed-size Bloom filter over strings.
+
+    `item in bloom_filter` is false only if `item` was never added. It may be true for an item that
+    wasn't added, at a rate of about `error_rate` while no more than `capacity` items are held.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.count = 0
+
+        # Optimal number of bits and hash functions for the requested capacity and error rate
+        self.num_bits = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Derive every position from two 64-bit hashes (Kirsch-Mitzenmacher double hashing)
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+####################################################################################################
+#                                           EMAIL FILTER                                           #
+####################################################################################################
+
+
+class EmailFilter:
+    """
+    A per-process record of registered emails, able to answer "definitely not registered" without
+    querying the database.
+
+    `load_since(last_id)` must return `(id, email)` pairs for every User with an id greater than
+    `last_id`. The filter is built from it on first use and topped up with it at most once every
+    `refresh_interval` seconds, which picks up Users registered by other processes; the last
+    REFRESH_OVERLAP ids are read again each time, in case they were committed out of order. It's
+    rebuilt from scratch every `rebuild_interval` seconds, as a last resort for any User missed
+    anyway, and whenever it holds more emails than it has room for. Users registered by this process
+    are added straight away with `add()`.
+    """
+
+    def __init__(self, load_since, refresh_interval=5, rebuild_interval=3600, error_rate=0.01,
+                 enabled=True):
+        self.load_since = load_since
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.error_rate = error_rate
+        self.enabled = enabled
+
+        self._bloom = None
+        self._last_id = 0
+        self._built_at = 0.0
+        self._last_refresh = 0.0
+        # Emails added while a rebuild runs, which it may have read too early to include
+        self._added_since_build = None
+        self._lock = Lock()
+
+    def _load(self, bloom, after_id):
+        # Returns the highest id read. Emails already in the filter aren't added again, so that
+        # re-reading them doesn't count against its capacity.
+        last_id = after_id
+        for user_id, email in self.load_since(after_id):
+            email = normalize_email(email)
+            if email not in bloom:
+                bloom.add(email)
+            last_id = max(last_id, user_id)
+        return last_id
+
+    def _build(self, capacity):
+        bloom = BloomFilter(capacity, self.error_rate)
+        last_id = self._load(bloom, 0)
+        while bloom.count > bloom.capacity:
+            # Twice the room it needs, so that the error rate holds as Users keep registering
+            bloom = BloomFilter(2 * bloom.count, self.error_rate)
+            last_id = self._load(bloom, 0)
+        return bloom, last_id
+
+    def _sync(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._bloom is None:
+                # Nothing to answer with in the meantime, so other threads wait for the first build
+                self._bloom, self._last_id = self._build(MIN_CAPACITY)
+                self._built_at = self._last_refresh = now
+                return
+
+            if self._added_since_build is not None or (
+                    now - self._built_at < self.rebuild_interval
+                    and self._bloom.count <= self._bloom.capacity):
+                if now - self._last_refresh >= self.refresh_interval:
+                    self._last_id = self._load(self._bloom,
+                                               max(0, self._last_id - REFRESH_OVERLAP))
+                    self._last_refresh = now
+                return
+
+            self._added_since_build = []
+            capacity = max(MIN_CAPACITY, 2 * self._bloom.count)
+
+        # Rebuilt without the lock, so that other threads keep using the old filter until it's done
+        try:
+            bloom, last_id = self._build(capacity)
+        except Exception:
+            with self._lock:
+                self._added_since_build = None
+            raise
+        with self._lock:
+            for email in self._added_since_build:
+                bloom.add(email)
+            self._added_since_build = None
+            self._bloom, self._last_id = bloom, last_id
+            self._built_at = self._last_refresh = now
+
+    def reset(self):
+        """
+        Forgets every email, so that the filter is built again on next use (e.g. after the app is
+        pointed at another database).
+        """
+        with self._lock:
+            self._bloom = None
+            self._last_id = 0
+
+    def might_exist(self, email):
+        """
+        Returns false if no User is registered under `email`, in any case, and true if one may be.
+        """
+        if not self.enabled:
+            return True
+
+        self._sync()
+        return normalize_email(email) in self._bloom
+
+    def add(self, email):
+        """
+        Records that a User has just been registered under `email`.
+        """
+        if not self.enabled:
+            return
+
+        email = normalize_email(email)
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(email)
+            if self._added_since_build is not None:
+                self._added_since_build.append(email)
@@ -0,0 +1,487 @@
+# File: fixtures.py
+#
+# Generating a realistic store to develop and benchmark against, without network access.
+#
+# Books (with authors, publishers, categories and placeholder covers), customers (with addresses,
+# payment cards and carts), past orders and promotions are made up from a seed, so the same seed
+# and date always give the same data, and bulk-inserted with SQLAlchemy Core rather than through the
+# models, which makes millions of rows a matter of minutes. Popularity is skewed: a few hot books
+# show up in most orders and a few heavy buyers place most of them, as in a real shop.
+#
+# To replace the database with a generated one, run from the folder containing the sahara package:
+#     python -m sahara.fixtures --reset --books 10000 --users 100000 --orders 200000
+
+import argparse
+import io
+import random
+import time
+from array import array
+from collections import Counter
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import bindparam
+from sahara import create_app, db, images, passwords
+from sahara.models import (Address, Author, Book, BookCategory, Cart, CartItem, Categories, Image,
+                           Order, OrderState, OrderStates, PaymentCard, Privileges, Promotion,
+                           Publisher, States, User, UserPrivilege, UserState, book_to_author,
+                           book_to_category, book_to_image, book_to_publisher, cart_to_cartitem,
+                           cartitem_to_book, order_to_address, order_to_cart, order_to_orderstate,
+                           order_to_paymentcard, order_to_promotion, paymentcard_to_address,
+                           user_to_address, user_to_cart, user_to_order, user_to_paymentcard,
+                           user_to_userprivilege, user_to_userstate)
+from sahara.storage import covers
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Password of every generated account, the admin included
+PASSWORD = 'password'
+
+# Rows sent to the database per executemany()
+BATCH_SIZE = 10_000
+
+# Orders are spread over this many days up to the generation date
+HISTORY_DAYS = 730
+
+# Orders placed within these many days are still processing or shipped rather than delivered
+PROCESSING_DAYS = 3
+SHIPPING_DAYS = 14
+
+# Chance of an order using the promotion running when it was placed
+PROMOTION_RATE = 0.1
+
+TITLE_WORDS = ('Harry', 'Potter', 'Desert', 'Night', 'River', 'Shadow', 'Garden', 'Empire',
+               'Secret', 'Winter', 'Stone', 'Crown', 'Storm', 'Silent', 'Last', 'Glass', 'Iron',
+               'Summer', 'Island', 'House', 'Letters', 'Ocean', 'City', 'Fire', 'Wolf', 'Star',
+               'Memory', 'Queen', 'Forest', 'Machine', 'Light', 'Road', 'Bone', 'Mirror', 'Song')
+EDITIONS = ('1st', '1st', '1st', '2nd', '3rd', 'Revised', 'Anniversary')
+DESCRIPTIONS = (
+    'A sweeping story of family, loss and the places we return to.',
+    'A fast-paced thriller that keeps its secrets until the very last page.',
+    'An accessible, myth-busting guide written for curious readers.',
+    'A haunting debut about a small town and the stranger who changes it.',
+    'An epic adventure across a world on the brink of war.',
+    'A collection of linked stories told over a single long summer.',
+)
+PUBLISHER_WORDS = ('Sahara', 'Harbor', 'Lantern', 'Northwind', 'Juniper', 'Keystone', 'Bluebird',
+                   'Meridian', 'Orchard', 'Granite')
+PUBLISHER_SUFFIXES = ('Media', 'Press', 'Books', 'Publishing', 'House')
+
+FIRST_NAMES = ('James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda',
+               'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica',
+               'Thomas', 'Sarah', 'Carlos', 'Karen', 'Wei', 'Aisha', 'Mohammed', 'Yuki', 'Priya',
+               'Olga', 'Kwame', 'Sofia', 'Diego', 'Amara')
+LAST_NAMES = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+              'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Thomas',
+              'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee', 'Nguyen', 'Chen', 'Patel', 'Kim',
+              'Okafor', 'Ivanova', 'Sato', 'Mensah', 'Rossi', 'Cohen')
+STREET_NAMES = ('Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill',
+                'Park', 'Broad', 'Milledge', 'Prince', 'Baxter', 'Lumpkin')
+STREET_SUFFIXES = ('Street', 'Avenue', 'Road', 'Lane', 'Drive', 'Court')
+CITIES = (('Athens', 'Georgia', '30602'), ('Atlanta', 'Georgia', '30303'),
+          ('Savannah', 'Georgia', '31401'), ('Austin', 'Texas', '73301'),
+          ('Denver', 'Colorado', '80202'), ('Portland', 'Oregon', '97201'),
+          ('Chicago', 'Illinois', '60601'), ('Boston', 'Massachusetts', '02108'),
+          ('Seattle', 'Washington', '98101'), ('Nashville', 'Tennessee', '37201'),
+          ('Miami', 'Florida', '33101'), ('Columbus', 'Ohio', '43004'))
+CARD_TYPES = ('Visa', 'Mastercard', 'American Express', 'Discover')
+
+# Placeholder covers: (background, band) colours
+COVER_COLOURS = (((31, 58, 96), (226, 183, 72)), ((120, 28, 36), (240, 230, 210)),
+                 ((22, 82, 64), (250, 245, 235)), ((58, 44, 92), (236, 160, 96)),
+                 ((30, 30, 30), (200, 40, 40)), ((214, 196, 160), (60, 40, 30)),
+                 ((70, 110, 140), (245, 245, 245)), ((150, 90, 40), (30, 30, 30)))
+COVER_SIZE = (350, 500)
+
+
+####################################################################################################
+#                                        UTILITY FUNCTIONS                                         #
+####################################################################################################
+
+
+class BatchInserter:
+    """
+    Collects rows for any number of tables and inserts each table's rows with one executemany()
+    per `batch_size` rows collected.
+
+    Tables are always flushed in the order they were first written to, so rows are inserted after
+    the rows they reference as long as parents are added before their children.
+    """
+
+    def __init__(self, connection, batch_size=BATCH_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.counts = Counter()
+        self._pending = {}
+        self._size = 0
+
+    def add(self, table, row):
+        self._pending.setdefault(table, []).append(row)
+        self._size += 1
+        if self._size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table, rows in self._pending.items():
+            if rows:
+                self.connection.execute(table.insert(), rows)
+                self.counts[table.name] += len(rows)
+                rows.clear()
+        self._size = 0
+
+
+def skewed_picker(ids, skew, rng):
+    """
+    Returns a function `pick(k)` returning `k` random picks from `ids`, where the n-th most popular
+    id is picked in proportion to 1 / n ** `skew` (0 picks uniformly). Which ids are the popular
+    ones is also random, so they aren't simply the first few.
+    """
+    ids = list(ids)
+    rng.shuffle(ids)
+    if skew <= 0:
+        return lambda k: rng.choices(ids, k=k)
+
+    cum_weights = list(accumulate(1 / rank ** skew for rank in range(1, len(ids) + 1)))
+    return lambda k: rng.choices(ids, cum_weights=cum_weights, k=k)
+
+
+def add_cart(rows, cart_id, items, prices, next_item_id):
+    """
+    Adds the cart `cart_id` holding `items`, a dict of book id to quantity, to `rows`, numbering
+    its items from `next_item_id`. Returns the cart's subtotal and the next unused item id.
+    """
+    subtotal = round(sum(prices[book_id] * quantity for book_id, quantity in items.items()), 2)
+    rows.add(Cart.__table__, {'id': cart_id, 'subtotal': subtotal})
+    for item_id, (book_id, quantity) in enumerate(items.items(), next_item_id):
+        rows.add(CartItem.__table__, {'id': item_id, 'book_id': book_id, 'cart_id': cart_id,
+                                      'quantity': quantity})
+        rows.add(cart_to_cartitem, {'cart_id': cart_id, 'cartitem_id': item_id})
+        rows.add(cartitem_to_book, {'cartitem_id': item_id, 'book_id': book_id})
+    return subtotal, next_item_id + len(items)
+
+
+def placeholder_cover(background, band, label):
+    """
+    Returns a plain JPEG cover labelled `label`, in the colours `background` and `band`, as a
+    file-like object.
+    """
+    # Imported here so that generating a store without covers doesn't load Pillow
+    import PIL.Image
+    import PIL.ImageDraw
+
+    image = PIL.Image.new('RGB', COVER_SIZE, background)
+    draw = PIL.ImageDraw.Draw(image)
+    width, height = COVER_SIZE
+    draw.rectangle((0, height * 3 // 5, width, height * 3 // 5 + 60), fill=band)
+    draw.rectangle((20, 20, width - 21, height - 21), outline=band, width=4)
+    draw.text((40, height * 3 // 5 + 24), label, fill=background)
+
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=85)
+    data.seek(0)
+    return data
+
+
+def store_placeholder_covers():
+    """
+    Stores one placeholder cover per entry of COVER_COLOURS, with its derivatives, and returns
+    their URLs.
+    """
+    urls = []
+    for i, (background, band) in enumerate(COVER_COLOURS):
+        stored = covers.save(placeholder_cover(background, band, f'Sahara #{i + 1}'), 'jpg')
+        if stored.created:
+            images.make_derivatives(images.to_disk_path(stored.url))
+        urls.append(stored.url)
+    return urls
+
+
+####################################################################################################
+#                                            GENERATION                                            #
+####################################################################################################
+
+
+def generate(num_books, num_users, num_orders=0, num_promotions=0, seed=1, today=None,
+             book_skew=1.0, buyer_skew=1.0, cart_fill=0.2, placeholder_covers=True,
+             batch_size=BATCH_SIZE):
+    """
+    Fills the (empty) database with `num_books` books and, besides the admin (user 1, as in
+    setup.py), `num_users` customers, who have placed `num_orders` orders over the HISTORY_DAYS up
+    to `today` (by default, the current date) using `num_promotions` promotions.
+
+    Everything is drawn from `seed`. `book_skew` and `buyer_skew` set how concentrated orders are on
+    the most popular books and the heaviest buyers (0 spreads them evenly, 1 gives a Zipf
+    distribution, higher is more extreme), and `cart_fill` is the fraction of customers with books
+    in their cart. Books share the stored placeholder covers, or, without `placeholder_covers`, the
+    default cover.
+
+    Returns the number of rows inserted into each table.
+    """
+    if num_orders and not (num_books and num_users):
+        raise ValueError('Orders need at least one book and one customer')
+
+    rng = random.Random(seed)
+    today = today or date.today()
+    now = datetime(today.year, today.month, today.day)
+
+    # Hashing is slow on purpose, so every account and card shares one hash
+    pw_hash = passwords.hash_password(PASSWORD)
+    card_hash = passwords.hash_password('4111111111111111')
+
+    cover_urls = store_placeholder_covers() if placeholder_covers else ['/static/img/bookCover.jpg']
+
+    with db.engine.begin() as connection:
+        rows = BatchInserter(connection, batch_size)
+
+        # Lookup tables
+        for privilege in Privileges:
+            rows.add(UserPrivilege.__table__, {'id': privilege.value})
+        for state in States:
+            rows.add(UserState.__table__, {'id': state.value})
+        for category in Categories:
+            rows.add(BookCategory.__table__, {'id': category.value})
+        for state in OrderStates:
+            rows.add(OrderState.__table__, {'id': state.value})
+
+        # Books
+        num_publishers = max(1, num_books // 500)
+        for i in range(1, num_publishers + 1):
+            # Every combination of word and suffix, then numbered ones
+            round_, word = divmod(i - 1, len(PUBLISHER_WORDS))
+            name = f'{PUBLISHER_WORDS[word]} {PUBLISHER_SUFFIXES[round_ % len(PUBLISHER_SUFFIXES)]}'
+            if round_ >= len(PUBLISHER_SUFFIXES):
+                name += f' {round_ // len(PUBLISHER_SUFFIXES) + 1}'
+            rows.add(Publisher.__table__, {'id': i, 'name': name})
+
+        for i, url in enumerate(cover_urls, 1):
+            rows.add(Image.__table__, {'id': i, 'filename': url})
+
+        num_authors = max(1, num_books // 4)
+        for i in range(1, num_authors + 1):
+            rows.add(Author.__table__, {'id': i, 'first_name': rng.choice(FIRST_NAMES),
+                                        'last_name': rng.choice(LAST_NAMES)})
+
+        prices = array('d', [0.0])
+        for i in range(1, num_books + 1):
+            price = rng.randint(3, 59) + rng.choice((0.5, 0.95, 0.99))
+            prices.append(price)
+            rows.add(Book.__table__, {
+                'id': i,
+                'isbn': f'978{i:010d}',
+                'title': ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 4))),
+                'edition': rng.choice(EDITIONS),
+                'description': rng.choice(DESCRIPTIONS),
+                'publishing_year': date(rng.randint(1950, today.year), 1, 1),
+                'price': price,
+                # A tenth of the books are nearly sold out
+                'quantity': rng.randint(0, 5) if rng.random() < 0.1 else rng.randint(10, 100),
+                'rating': round(rng.uniform(1, 5), 1),
+            })
+            for author_id in {rng.randint(1, num_authors)
+                              for _ in range(rng.choices((1, 2, 3), (80, 15, 5))[0])}:
+                rows.add(book_to_author, {'book_id': i, 'author_id': author_id})
+            rows.add(book_to_publisher, {'book_id': i,
+                                         'publisher_id': rng.randint(1, num_publishers)})
+            rows.add(book_to_category, {'book_id': i,
+                                        'bookcategory_id': rng.randint(1, len(Categories))})
+            rows.add(book_to_image, {'book_id': i, 'image_id': rng.randint(1, len(cover_urls))})
+
+        # The admin, who like the one made by setup.py has no cart
+        rows.add(User.__table__, {'id': 1, 'email': 'admin@sahara.com', 'password': pw_hash,
+                                  'is_subscribed': False, 'first_name': 'Sahara',
+                                  'last_name': 'Devs', 'phone_number': '0123456789'})
+        rows.add(user_to_userprivilege, {'user_id': 1, 'userprivilege_id': Privileges.ADMIN.value})
+        rows.add(user_to_userstate, {'user_id': 1, 'userstate_id': States.ACTIVE.value})
+
+        # Customers: user i + 1 has address i and cart i, and the cards from first_card[i]
+        pick_books = skewed_picker(range(1, num_books + 1), book_skew, rng)
+        first_card = array('l', [0])
+        card_count = array('b', [0])
+        next_card_id = next_item_id = 1
+        states = [s.value for s in States]
+        for i in range(1, num_users + 1):
+            user_id = i + 1
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            rows.add(User.__table__, {
+                'id': user_id,
+                'email': f'{first_name}.{last_name}.{user_id}@example.com'.lower(),
+                'password': pw_hash,
+                'is_subscribed': rng.random() < 0.3,
+                'first_name': first_name,
+                'last_name': last_name,
+                'phone_number': f'{rng.randint(200, 999)}{rng.randint(0, 9_999_999):07d}',
+            })
+            rows.add(user_to_userprivilege, {'user_id': user_id,
+                                             'userprivilege_id': Privileges.CUSTOMER.value})
+            rows.add(user_to_userstate, {'user_id': user_id,
+                                         'userstate_id': rng.choices(states, (90, 7, 3))[0]})
+
+            city, state, zip_code = rng.choice(CITIES)
+            rows.add(Address.__table__, {
+                'id': i,
+                'street_1': (f'{rng.randint(1, 9999)} {rng.choice(STREET_NAMES)} '
+                             f'{rng.choice(STREET_SUFFIXES)}'),
+                'street_2': f'Apt {rng.randint(1, 400)}' if rng.random() < 0.2 else None,
+                'city': city,
+                'state': state,
+                'zip_code': zip_code,
+            })
+            rows.add(user_to_address, {'user_id': user_id, 'address_id': i})
+
+            num_cards = rng.choices((0, 1, 2), (20, 65, 15))[0]
+            first_card.append(next_card_id)
+            card_count.append(num_cards)
+            for card_id in range(next_card_id, next_card_id + num_cards):
+                rows.add(PaymentCard.__table__, {
+                    'id': card_id,
+                    'type': rng.choice(CARD_TYPES),
+                    'number': card_hash,
+                    'expiration_date': datetime(today.year + rng.randint(0, 5),
+                                                rng.randint(1, 12), 1),
+                    'name_on_card': f'{first_name} {last_name}',
+                    'security_code': f'{rng.randint(0, 999):03d}',
+                    'last_four_digits': f'{rng.randint(0, 9999):04d}',
+                })
+                rows.add(user_to_paymentcard, {'user_id': user_id, 'paymentcard_id': card_id})
+                rows.add(paymentcard_to_address, {'paymentcard_id': card_id, 'address_id': i})
+            next_card_id += num_cards
+
+            items = {}
+            if rng.random() < cart_fill:
+                items = {book_id: rng.choices((1, 2), (90, 10))[0]
+                         for book_id in pick_books(rng.randint(1, 3))}
+            subtotal, next_item_id = add_cart(rows, i, items, prices, next_item_id)
+            rows.add(user_to_cart, {'user_id': user_id, 'cart_id': i})
+
+        # Promotions, one after another across the order history, the last still running
+        start = now - timedelta(days=HISTORY_DAYS)
+        promotion_length = timedelta(days=HISTORY_DAYS) / max(1, num_promotions)
+        discounts = []
+        for i in range(1, num_promotions + 1):
+            promotion_start = start + promotion_length * (i - 1)
+            discount = rng.choice((5, 10, 15, 20, 25, 50))
+            discounts.append(discount)
+            end = now + timedelta(days=30) if i == num_promotions else (
+                promotion_start + promotion_length)
+            rows.add(Promotion.__table__, {
+                'id': i,
+                'code': f'{rng.choice(TITLE_WORDS).upper()}{discount}-{i:04d}',
+                'discount': discount,
+                'start_date': promotion_start.date(),
+                'end_date': end.date(),
+                'is_sent': promotion_start <= now,
+            })
+
+        # Orders, in the order they were placed, each with the cart it was placed from, counting the
+        # copies of each book sold as User.confirm_order() does
+        pick_buyers = skewed_picker(range(1, num_users + 1), buyer_skew, rng) if num_users else None
+        units_sold = array('l', [0] * (num_books + 1))
+        next_cart_id = num_users + 1
+        for order_id in range(1, num_orders + 1):
+            placed = start + timedelta(days=HISTORY_DAYS) * ((order_id - 1 + rng.random())
+                                                             / num_orders)
+            customer = pick_buyers(1)[0]
+            user_id = customer + 1
+
+            items = {book_id: rng.choices((1, 2, 3), (85, 12, 3))[0]
+                     for book_id in pick_books(rng.choices((1, 2, 3, 4), (50, 30, 15, 5))[0])}
+            subtotal, next_item_id = add_cart(rows, next_cart_id, items, prices, next_item_id)
+            for book_id, quantity in items.items():
+                units_sold[book_id] += quantity
+
+            promotion_id = None
+            if num_promotions and rng.random() < PROMOTION_RATE:
+                promotion_id = min(num_promotions, int((placed - start) / promotion_length) + 1)
+                subtotal *= (100 - discounts[promotion_id - 1]) / 100
+
+            age = now - placed
+            if age < timedelta(days=PROCESSING_DAYS):
+                state = OrderStates.PROCESSING
+            elif age < timedelta(days=SHIPPING_DAYS):
+                state = OrderStates.SHIPPED
+            else:
+                state = OrderStates.DELIVERED
+
+            # As in User.confirm_order(): tax and shipping on top
+            rows.add(Order.__table__, {
+                'id': order_id,
+                'user_id': user_id,
+                'total': round(subtotal + subtotal * 0.07 + 3.99, 2),
+                'placed_datetime': placed,
+            })
+            rows.add(user_to_order, {'user_id': user_id, 'order_id': order_id})
+            rows.add(order_to_cart, {'order_id': order_id, 'cart_id': next_cart_id})
+            rows.add(order_to_orderstate, {'order_id': order_id, 'orderstate_id': state.value})
+            rows.add(order_to_address, {'order_id': order_id, 'address_id': customer})
+            if card_count[customer]:
+                card_id = first_card[customer] + rng.randrange(card_count[customer])
+                rows.add(order_to_paymentcard, {'order_id': order_id, 'paymentcard_id': card_id})
+            if promotion_id:
+                rows.add(order_to_promotion, {'order_id': order_id, 'promotion_id': promotion_id})
+            next_cart_id += 1
+
+        rows.flush()
+
+        book = Book.__table__
+        sales = [{'book_id': book_id, 'units_sold': sold}
+                 for book_id, sold in enumerate(units_sold) if sold]
+        for i in range(0, len(sales), batch_size):
+            connection.execute(book.update().where(book.c.id == bindparam('book_id'))
+                               .values(units_sold=bindparam('units_sold')),
+                               sales[i:i + batch_size])
+
+    return rows.counts
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a store to develop against.')
+    parser.add_argument('--books', type=int, default=1_000, help='number of books (default 1000)')
+    parser.add_argument('--users', type=int, default=1_000,
+                        help='number of customers (default 1000)')
+    parser.add_argument('--orders', type=int, default=5_000,
+                        help='number of past orders (default 5000)')
+    parser.add_argument('--promotions', type=int, default=24,
+                        help='number of promotions (default 24)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the data (default 1)')
+    parser.add_argument('--date', type=date.fromisoformat,
+                        help='date the data is generated as of, as YYYY-MM-DD (default today)')
+    parser.add_argument('--book-skew', type=float, default=1.0,
+                        help='how concentrated orders are on hot books (0 = even, default 1)')
+    parser.add_argument('--buyer-skew', type=float, default=1.0,
+                        help='how concentrated orders are on heavy buyers (0 = even, default 1)')
+    parser.add_argument('--cart-fill', type=float, default=0.2,
+                        help='fraction of customers with books in their cart (default 0.2)')
+    parser.add_argument('--no-covers', action='store_true',
+                        help="use the default cover rather than storing placeholder covers")
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate every table first')
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        if User.query.first() is not None or Book.query.first() is not None:
+            parser.error('the database already has data; pass --reset to replace it')
+
+        started = time.perf_counter()
+        counts = generate(args.books, args.users, num_orders=args.orders,
+                          num_promotions=args.promotions, seed=args.seed, today=args.date,
+                          book_skew=args.book_skew, buyer_skew=args.buyer_skew,
+                          cart_fill=args.cart_fill, placeholder_covers=not args.no_covers)
+        elapsed = time.perf_counter() - started
+
+    for table, count in sorted(counts.items()):
+        print(f'{table:<24}{count:>12,}')
+    print(f'Inserted {sum(counts.values()):,} rows in {elapsed:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -307,7 +307,9 @@ class PasswordResetRequestForm(FlaskForm):
     submit = SubmitField('Submit')
 
     def validate_email(self, email):
-        if not User.exists(email.data):
+        # Keep the User around so the route doesn't have to look it up again
+        self.user = User.from_email(email.data)
+        if self.user is None:
             raise ValidationError("A user with that email does not exist.")
 
     def validate_password(self, password):
@@ -325,6 +327,11 @@ class PasswordResetForm(FlaskForm):
 
 
 class SearchForm(FlaskForm):
+    # Searching changes nothing, so there is nothing for CSRF protection to protect, and without a
+    # token the search bar is the same for everyone and can be cached (see sahara.templating)
+    class Meta:
+        csrf = False
+
     search_term = StringField('Search Term')
     submitSearch = SubmitField('Search')
 
@@ -514,6 +521,31 @@ class CheckoutForm(FlaskForm):
                 raise ValidationError(msg)
 
 
+class UserDirectoryForm(FlaskForm):
+    # Submitted as query parameters, so there is nothing for CSRF protection to protect
+    class Meta:
+        csrf = False
+
+    email_prefix = StringField('Email starts with', validators=[Optional()])
+    state = SelectField('State', validators=[Optional()], choices=[
+        ('', 'Any'),
+        ('1', 'Active'),
+        ('2', 'Inactive'),
+        ('3', 'Suspended')])
+    subscribed = SelectField('Subscription', validators=[Optional()], choices=[
+        ('', 'Any'),
+        ('yes', 'Subscribed'),
+        ('no', 'Not subscribed')])
+    submit = SubmitField('Filter')
+
+
+class BulkUserStateForm(FlaskForm):
+    state = SelectField('Set selected users to', validators=[DataRequired()], choices=[
+        ('1', 'Active'),
+        ('3', 'Suspended')])
+    submit = SubmitField('Apply')
+
+
 class AddToCartForm(FlaskForm):
     quantity = IntegerField('Quantity:', validators=[DataRequired()])
     addToCart = SubmitField('Add to Cart')
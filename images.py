@@ -0,0 +1,239 @@
+# File: images.py
+#
+# Resized and WebP copies ("derivatives") of book cover images.
+#
+# Covers are shown at a handful of fixed sizes, so each uploaded cover gets a JPEG and a WebP copy
+# per size, made by a pool of worker processes. To (re)build the derivatives of every cover already
+# in static/img/books, run from the project root:
+#     python -m sahara.images
+
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from threading import Lock
+from flask import current_app
+from markupsafe import Markup, escape
+from sahara import create_app
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Bounding boxes (width, height) covers are displayed in
+SIZES = {
+    'thumb': (120, 200),
+    'page': (350, 450),
+    'gallery': (600, 400),
+}
+FORMATS = {
+    'jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+}
+DERIVED_DIR = 'derived'
+BOOK_IMAGE_DIR = path.join('img', 'books')
+
+logger = logging.getLogger(__name__)
+
+
+####################################################################################################
+#                                        UTILITY FUNCTIONS                                         #
+####################################################################################################
+
+
+def normalize_url(url):
+    """
+    Returns `url` with forward slashes. The covers that ship with the project were recorded on
+    Windows, with backslashes (e.g. "/static\\img\\books\\9781509858637.jpg").
+    """
+    return url.replace('\\', '/')
+
+
+def to_disk_path(url):
+    """
+    Returns the location on disk of the static file served at `url` (e.g. "/static/img/a.jpg").
+    """
+    relative = normalize_url(url).split(current_app.static_url_path + '/', 1)[-1]
+    return path.join(current_app.static_folder, *relative.split('/'))
+
+
+def derivative_name(filename, size, fmt):
+    """
+    Returns the file name of the `size` derivative of the cover `filename` in format `fmt`.
+    """
+    stem = path.splitext(path.basename(normalize_url(filename)))[0]
+    return f'{stem}-{size}.{fmt}'
+
+
+def derivative_url(url, size, fmt):
+    """
+    Returns the URL the `size` derivative of the cover at `url` is served from in format `fmt`.
+    """
+    directory = normalize_url(url).rsplit('/', 1)[0]
+    return f'{directory}/{DERIVED_DIR}/{derivative_name(url, size, fmt)}'
+
+
+####################################################################################################
+#                                         WORKER FUNCTIONS                                         #
+####################################################################################################
+
+
+def make_derivatives(source_path):
+    """
+    Writes every size and format of derivative for the image at `source_path` into a `derived`
+    folder next to it, and returns the paths written.
+
+    Runs in a worker process, so it only works with paths.
+    """
+    # Only the image workers need Pillow, so the app doesn't pay for importing it
+    import PIL.Image
+
+    dest_dir = path.join(path.dirname(source_path), DERIVED_DIR)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    written = []
+    with PIL.Image.open(source_path) as original:
+        original.load()
+        for size, box in SIZES.items():
+            # Shrinks to fit the box, keeping the aspect ratio; never enlarges
+            resized = original.copy()
+            resized.thumbnail(box, PIL.Image.LANCZOS)
+
+            for fmt, (pil_format, options) in FORMATS.items():
+                image = resized
+                if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+
+                # Write under a temporary name first so a half-written file is never served
+                dest_path = path.join(dest_dir, derivative_name(source_path, size, fmt))
+                tmp_path = f'{dest_path}.{os.getpid()}.tmp'
+                if image.size == original.size and pil_format == original.format:
+                    # Already small enough; re-encoding would only make it bigger
+                    shutil.copyfile(source_path, tmp_path)
+                else:
+                    image.save(tmp_path, pil_format, **options)
+                os.replace(tmp_path, dest_path)
+                written.append(dest_path)
+
+    return written
+
+
+####################################################################################################
+#                                            IMAGE POOL                                            #
+####################################################################################################
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    """
+    Returns this process' image pool, creating it on first use.
+
+    The pool is keyed by pid so that a pool created before a fork is never shared with the child.
+    """
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'])
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('Failed to make cover derivatives', exc_info=future.exception())
+
+
+def queue_derivatives(url):
+    """
+    Starts making the derivatives of the cover at `url` in the background and returns the
+    `Future` for it. Until they exist, `cover_picture()` falls back to the original.
+    """
+    future = _get_executor().submit(make_derivatives, to_disk_path(url))
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def backfill(image_dir=None, workers=None):
+    """
+    Makes the derivatives of every image under `image_dir` (static/img/books by default) across a
+    pool of `workers` processes, and returns the number of images processed.
+    """
+    image_dir = image_dir or path.join(current_app.static_folder, BOOK_IMAGE_DIR)
+
+    # Covers are sharded into nested directories by their hash, next to their `derived` folders
+    sources = []
+    for root, dirs, files in os.walk(image_dir):
+        dirs[:] = sorted(d for d in dirs if d != DERIVED_DIR)
+        sources += [path.join(root, name) for name in sorted(files) if not name.endswith('.tmp')]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for source, written in zip(sources, executor.map(make_derivatives, sources)):
+            print(f'{path.basename(source)}: {len(written)} derivatives')
+
+    return len(sources)
+
+
+####################################################################################################
+#                                         TEMPLATE HELPERS                                         #
+####################################################################################################
+
+
+# URLs of derivatives known to exist on disk, so each is only checked for once per process
+_existing = set()
+
+
+def _exists(url):
+    if url in _existing:
+        return True
+    if path.isfile(to_disk_path(url)):
+        _existing.add(url)
+        return True
+    return False
+
+
+def init_app(app):
+    app.add_template_global(cover_picture)
+
+
+def cover_picture(image, size, alt='', **attrs):
+    """
+    Renders a <picture> showing the cover `image` (an `Image`, or its URL) at `size`, offering the
+    WebP derivative to browsers that support it and the JPEG derivative to the rest.
+
+    Falls back to the original image if the derivatives haven't been made yet. Any extra keyword
+    arguments become attributes of the <img> tag.
+    """
+    url = normalize_url(getattr(image, 'filename', image) or '')
+
+    webp_url = derivative_url(url, size, 'webp')
+    jpg_url = derivative_url(url, size, 'jpg')
+    src = jpg_url if _exists(jpg_url) else url
+
+    attributes = ''.join(f' {escape(key)}="{escape(value)}"' for key, value in attrs.items())
+    html = '<picture>'
+    if _exists(webp_url):
+        html += f'<source srcset="{escape(webp_url)}" type="image/webp">'
+    html += f'<img src="{escape(src)}" alt="{escape(alt)}"{attributes}></picture>'
+    return Markup(html)
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    with create_app().app_context():
+        count = backfill()
+    print(f'Made derivatives for {count} images.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# File: import_users.py
+#
+# Imports customers from a CSV file, in batches.
+#
+# Run from the project root:
+#     python -m sahara.import_users customers.csv [--batch-size 1000] [--workers 8] [--active]
+#
+# The CSV must have a header row with the columns email, first_name, last_name and phone_number,
+# plus either password (plain text, hashed on import) or password_hash (an existing bcrypt hash).
+# The optional columns is_subscribed, street_1, street_2, city, state and zip_code are also read.
+
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from sahara import create_app, db, passwords
+from sahara.models import Address, Cart, User, UserPrivilege, UserState, Privileges, States
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+DEFAULT_BATCH_SIZE = 1000
+TRUE_STRINGS = ('1', 'true', 'yes', 'y')
+
+
+####################################################################################################
+#                                        UTILITY FUNCTIONS                                         #
+####################################################################################################
+
+
+def read_batches(csv_path, batch_size):
+    """
+    Yields lists of up to `batch_size` rows from the CSV file at `csv_path`.
+    """
+    with open(csv_path, mode='r', newline='') as data_file:
+        batch = []
+        for row in csv.DictReader(data_file):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def is_bcrypt_hash(value):
+    return bool(value) and len(value) == 60 and passwords.get_rounds(value) is not None
+
+
+def build_user(row, pw_hash, privilege, state):
+    address = None
+    if row.get('street_1'):
+        address = Address(street_1=row['street_1'],
+                          street_2=row.get('street_2') or None,
+                          city=row.get('city', ''),
+                          state=row.get('state', ''),
+                          zip_code=row.get('zip_code', ''))
+
+    return User(
+        email=row['email'],
+        password=pw_hash,
+        is_subscribed=row.get('is_subscribed', '').strip().lower() in TRUE_STRINGS,
+        first_name=row['first_name'],
+        last_name=row['last_name'],
+        phone_number=row['phone_number'],
+        address=address,
+        privilege=privilege,
+        state=state,
+        cart=Cart.next_available()
+    )
+
+
+def import_batch(rows, state_id, executor):
+    """
+    Adds the Users described by `rows` to the database in one transaction, skipping rows whose email
+    is already taken, and returns the number of Users added.
+    """
+    # Drop emails that are already registered (or repeated within the batch) with a single query
+    emails = [row['email'] for row in rows]
+    taken = {email for (email,) in db.session.query(User.email).filter(User.email.in_(emails))}
+
+    new_rows = []
+    for row in rows:
+        if row['email'] not in taken:
+            taken.add(row['email'])
+            new_rows.append(row)
+
+    # Hash plain-text passwords across the pool, keeping any existing bcrypt hashes as they are
+    to_hash = [row['password'] for row in new_rows if not is_bcrypt_hash(row.get('password_hash'))]
+    hashes = iter(passwords.hash_passwords(to_hash, executor))
+
+    # Shared by every User in the batch
+    privilege = UserPrivilege.from_id(Privileges.CUSTOMER.value)
+    state = UserState.from_id(state_id)
+
+    users = []
+    for row in new_rows:
+        pw_hash = row.get('password_hash')
+        if not is_bcrypt_hash(pw_hash):
+            pw_hash = next(hashes)
+        users.append(build_user(row, pw_hash, privilege, state))
+
+    db.session.add_all(users)
+    db.session.commit()
+    return len(users)
+
+
+def import_users(csv_path, batch_size=DEFAULT_BATCH_SIZE, workers=None, active=False):
+    """
+    Imports every customer in the CSV file at `csv_path` and returns the number of Users added.
+
+    Customers are added as active if `active` is true (e.g. accounts verified by a previous system)
+    and as inactive, pending email verification, otherwise.
+    """
+    state_id = States.ACTIVE.value if active else States.INACTIVE.value
+
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch_no, rows in enumerate(read_batches(csv_path, batch_size), start=1):
+            added = import_batch(rows, state_id, executor)
+            total += added
+            print(f'Batch {batch_no}: added {added} of {len(rows)} users ({total} total)')
+
+    return total
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import customers from a CSV file.')
+    parser.add_argument('csv_path', help='path to the CSV file to import')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='users committed per transaction')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes used for password hashing')
+    parser.add_argument('--active', action='store_true',
+                        help='import users as already verified')
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        total = import_users(args.csv_path, args.batch_size, args.workers, args.active)
+    print(f'Imported {total} users.')
+
+
+if __name__ == '__main__':
+    main()
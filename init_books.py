@@ -1,16 +1,17 @@
 import csv
 from datetime import datetime
-import PIL.Image
 from os import path
 import random
-import requests
 import sys
-from sahara import app
-from sahara.routes import STATIC_DIR, BOOK_IMAGE_DIR
+from sahara import images
+from sahara.storage import covers
 from sahara.models import Book, Author, Publisher, Image, BookCategory
 
 
 def generate_books(num_books=sys.maxsize):
+    # Only needed to download the covers, so not imported with the rest of the package
+    import requests
+
     with open('main_dataset.csv', mode='r') as data_file:
         reader = csv.DictReader(data_file)
 
@@ -59,20 +60,12 @@ def generate_books(num_books=sys.maxsize):
             publishing_year = datetime(publishing_year_int, 1, 1)
 
             # Get cover image
-            cover_image = None
-            url = book['image']
-            with PIL.Image.open(requests.get(url, stream=True).raw) as image_file:
-                filename = path.join(
-                    BOOK_IMAGE_DIR,
-                    url.split('/')[-1]
-                )
-                image_file.save(path.join(
-                    STATIC_DIR,
-                    'img',
-                    'books',
-                    url.split('/')[-1]
-                ))
-                cover_image = Image.from_filename(filename)
+            response = requests.get(book['image'], stream=True)
+            response.raw.decode_content = True
+            stored = covers.save(response.raw, path.splitext(book['image'])[1])
+            cover_image = Image.from_filename(stored.url)
+            if stored.created:
+                images.queue_derivatives(stored.url)
 
             # Get category
             category_value = random.randint(1, 8)
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from flask import current_app
+from sahara import mail
+
+####################################################################################################
+#                                            MAIL QUEUE                                            #
+####################################################################################################
+
+# Sending mail means a round trip to the SMTP server per message, which shouldn't hold up the
+# request that triggered it. Messages handed to `send_async()` are sent by a few background threads
+# instead.
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    """
+    Returns this process' mail sending threads, starting them on first use.
+
+    The pool is keyed by pid since threads started before a fork don't exist in the child.
+    """
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['MAIL_QUEUE_WORKERS'],
+                                           thread_name_prefix='mail')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _send(app, message):
+    with app.app_context():
+        try:
+            mail.send(message)
+        except Exception:
+            app.logger.exception('Failed to send "%s" to %s', message.subject, message.recipients)
+
+
+def send_async(message):
+    """
+    Queues `message` to be sent in the background and returns immediately.
+    """
+    _get_executor().submit(_send, current_app._get_current_object(), message)
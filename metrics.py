@@ -0,0 +1,182 @@
+# File: metrics.py
+#
+# Per-request SQL statistics and Prometheus metrics.
+#
+# Every statement sent to the database during a request is counted and timed. When a request
+# finishes, it's recorded in per-route histograms (served at /metrics in the Prometheus text format)
+# and logged if it was slow, ran a lot of queries, or ran the same statement over and over - the
+# usual sign of an N+1 pattern, e.g. a lazy-loaded relationship read inside a loop.
+#
+# The histograms are kept per process, so with several workers each scrape sees one of them. They
+# describe the traffic and the queries behind it, so they're only served to scrapers sending
+# METRICS_TOKEN.
+
+import re
+import time
+from collections import Counter
+from threading import Lock
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sahara import caching
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Lists of placeholders, e.g. "IN (?, ?, ?)", which differ in length between otherwise identical
+# statements
+PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+####################################################################################################
+#                                            HISTOGRAMS                                            #
+####################################################################################################
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram of observations, with a separate series per label value.
+    """
+
+    def __init__(self, name, description, buckets, label):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Returns this histogram in the Prometheus text exposition format.
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._series.items()):
+                label = f'{self.label}="{escape_label(label_value)}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+        return '\n'.join(lines)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram('sahara_request_duration_seconds',
+                             'Time taken to handle a request, by route.',
+                             DURATION_BUCKETS, 'route')
+request_queries = Histogram('sahara_request_sql_queries',
+                            'Number of SQL statements run by a request, by route.',
+                            QUERY_COUNT_BUCKETS, 'route')
+request_sql_duration = Histogram('sahara_request_sql_seconds',
+                                 'Time a request spent waiting on SQL statements, by route.',
+                                 DURATION_BUCKETS, 'route')
+HISTOGRAMS = (request_duration, request_queries, request_sql_duration)
+
+
+def render_cache_counts():
+    """
+    Returns the counts of every cache region in the Prometheus text exposition format.
+    """
+    name = 'sahara_cache_events_total'
+    lines = [f'# HELP {name} Cache hits, misses, sets and invalidated tags, by cache region.',
+             f'# TYPE {name} counter']
+    for region_name, region in sorted(caching.regions.items()):
+        for cache_event, count in region.counts.items():
+            lines.append(f'{name}{{region="{escape_label(region_name)}",event="{cache_event}"}} '
+                         f'{count}')
+    return '\n'.join(lines)
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    sections = [histogram.render() for histogram in HISTOGRAMS] + [render_cache_counts()]
+    return '\n'.join(sections) + '\n'
+
+
+####################################################################################################
+#                                          SQL STATISTICS                                          #
+####################################################################################################
+
+
+def statement_shape(statement):
+    """
+    Returns `statement` with whitespace and placeholder lists normalised, so that statements that
+    only differ in their parameters have the same shape.
+    """
+    return PLACEHOLDER_LIST.sub('(?)', WHITESPACE.sub(' ', statement).strip())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_request_context() or 'sql_shapes' not in g:
+        return
+
+    g.sql_count += 1
+    g.sql_time += elapsed
+    g.sql_shapes[statement_shape(statement)] += 1
+
+
+def init_app(app):
+    app.before_request(start_request_stats)
+    app.teardown_request(record_request_stats)
+
+
+def start_request_stats():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_shapes = Counter()
+
+
+def record_request_stats(exception=None):
+    if 'request_start' not in g or not current_app.config['METRICS_ENABLED']:
+        return
+
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    request_duration.observe(route, elapsed)
+    request_queries.observe(route, g.sql_count)
+    request_sql_duration.observe(route, g.sql_time)
+
+    # For the profiler, which runs outside the app
+    request.environ['sahara.sql_count'] = g.sql_count
+
+    if (elapsed * 1000 >= current_app.config['SLOW_REQUEST_MS']
+            or g.sql_count >= current_app.config['QUERY_COUNT_WARNING']):
+        current_app.logger.warning('%s %s took %.0f ms and ran %d queries (%.0f ms)',
+                                   request.method, request.path, elapsed * 1000, g.sql_count,
+                                   g.sql_time * 1000)
+
+    for shape, count in g.sql_shapes.most_common():
+        if count < current_app.config['N_PLUS_ONE_THRESHOLD']:
+            break
+        current_app.logger.warning('Probable N+1 in %s %s: ran %d times: %s', request.method,
+                                   request.path, count, shape[:300])
@@ -1,9 +1,18 @@
 from enum import Enum
 from datetime import datetime, date
+from itertools import chain, groupby
+from flask import current_app
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask_login import UserMixin
-from sqlalchemy import or_
-from sahara import app, bcrypt, db, login_manager
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session, contains_eager, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sahara import bcrypt, db, login_manager
+from sahara.caching import CacheRegion, LRUBackend, SQLiteCacheBackend
+from sahara.database import reading_from_replica
+from sahara.email_filter import EmailFilter
+from sahara.suggestions import SuggestionIndex
 
 ####################################################################################################
 #                                            CONSTANTS                                             #
@@ -49,14 +58,213 @@ class OrderStates(Enum):
     DELIVERED = 3
 
 
+# Number of books in a bestseller list
+BESTSELLERS_SHOWN = 10
+
+# Number of books shown as bought together with a book
+RELATED_BOOKS_SHOWN = 3
+
+# Number of close matches shown for a search with no exact ones
+SIMILAR_RESULTS_SHOWN = 20
+
+
 ####################################################################################################
 #                                        UTILITY FUNCTIONS                                         #
 ####################################################################################################
 
 
+# Cross-request cache of logged in Users, keyed by id. Disabled unless PRINCIPAL_CACHE_TTL > 0.
+principal_cache = CacheRegion('principals')
+PRINCIPAL_CACHE_SIZE = 10000
+
+# Cross-request cache of the rows behind the hot get-by-id lookups (see `cached_get()`), keyed and
+# tagged by `row_tag()`. Disabled unless ROW_CACHE_TTL > 0.
+row_cache = CacheRegion('rows')
+
+# Cross-request cache of the ids of the best selling books, overall and per category (see
+# `Book.bestsellers()`). Disabled unless BESTSELLER_CACHE_TTL > 0.
+bestseller_cache = CacheRegion('bestsellers')
+
+
+def load_emails_since(last_id):
+    """
+    Yields the id and email of every User with an id greater than `last_id`.
+    """
+    query = db.session.query(User.id, User.email).filter(User.id > last_id).order_by(User.id)
+    return query.yield_per(10000)
+
+
+# Per-process filter of registered emails, used to skip the query for emails that aren't registered
+registered_emails = EmailFilter(load_emails_since)
+
+
+def load_books_since(last_id):
+    """
+    Yields the id, title, ISBN, copies sold and author names of every Book with an id greater than
+    `last_id`, in order of id.
+    """
+    query = db.session.query(Book.id, Book.title, Book.isbn, Book.units_sold, Author.first_name,
+                             Author.last_name) \
+        .outerjoin(Book.authors) \
+        .filter(Book.id > last_id) \
+        .order_by(Book.id)
+    for book_id, rows in groupby(query.yield_per(10000), key=lambda row: row.id):
+        rows = list(rows)
+        authors = [f'{row.first_name} {row.last_name}' for row in rows
+                   if row.first_name is not None]
+        yield book_id, rows[0].title, rows[0].isbn, rows[0].units_sold, authors
+
+
+# Per-process index of books by title, author and ISBN prefixes, for the search bar's suggestions
+book_suggestions = SuggestionIndex(load_books_since)
+
+# Ids of the rows of each lookup table known to exist, by model. Filled in by `preload_lookups()`.
+known_lookups = {}
+
+
+def init_app(app):
+    principal_cache.backend = LRUBackend(PRINCIPAL_CACHE_SIZE)
+    principal_cache.ttl = app.config['PRINCIPAL_CACHE_TTL']
+    if app.config['ROW_CACHE_BACKEND'] == 'sqlite':
+        row_cache.backend = SQLiteCacheBackend(app.config['ROW_CACHE_SQLITE_PATH'],
+                                               app.config['ROW_CACHE_SIZE'])
+    else:
+        row_cache.backend = LRUBackend(app.config['ROW_CACHE_SIZE'])
+    row_cache.ttl = app.config['ROW_CACHE_TTL']
+    # One ranking per category, plus the overall one, for each length asked for
+    bestseller_cache.backend = LRUBackend(64)
+    bestseller_cache.ttl = app.config['BESTSELLER_CACHE_TTL']
+    registered_emails.refresh_interval = app.config['EMAIL_FILTER_REFRESH']
+    registered_emails.rebuild_interval = app.config['EMAIL_FILTER_REBUILD']
+    registered_emails.enabled = app.config['EMAIL_FILTER_ENABLED']
+    book_suggestions.refresh_interval = app.config['SUGGEST_REFRESH_INTERVAL']
+    book_suggestions.rebuild_interval = app.config['SUGGEST_REBUILD_INTERVAL']
+    book_suggestions.min_similarity = app.config['SEARCH_MIN_SIMILARITY']
+
+
+def preload_lookups():
+    """
+    Adds any missing row to the lookup tables (privileges, user states, book categories and order
+    states) and records their ids, so that their `from_id()` no longer queries for them.
+    """
+    for model, values in ((UserPrivilege, Privileges), (UserState, States),
+                          (BookCategory, Categories), (OrderState, OrderStates)):
+        existing = {row.id for row in model.query}
+        for value in values:
+            if value.value not in existing:
+                db.session.add(model(id=value.value))
+        known_lookups[model] = existing | {value.value for value in values}
+    db.session.commit()
+
+
+def known_lookup(model, row_id):
+    """
+    Returns the row `row_id` of the lookup table `model` without querying the database, or `None`
+    if it isn't known to exist.
+    """
+    if row_id not in known_lookups.get(model, ()):
+        return None
+
+    row = model(id=row_id)
+    make_transient_to_detached(row)
+    return db.session.merge(row, load=False)
+
+
+def row_tag(model, row_id):
+    """
+    Returns the tag of row `row_id` of `model` in the row cache (e.g. `'Book:5'`), which is also the
+    key its own entry is stored under.
+    """
+    return f'{model.__name__}:{row_id}'
+
+
+def column_values(row, exclude=()):
+    """
+    Returns the column values of `row` as a plain dict, leaving out the columns named in `exclude`.
+    """
+    return {column.key: getattr(row, column.key) for column in row.__table__.columns
+            if column.key not in exclude}
+
+
+def detached_row(model, values):
+    """
+    Returns a `model` row with the column `values`, marked as already in the database, ready to be
+    merged into a session without querying for it.
+    """
+    row = model(**values)
+    make_transient_to_detached(row)
+    return row
+
+
+def cached_get(model, row_id, load, snapshot=None, restore=None, exclude=()):
+    """
+    Returns the row `row_id` of `model`, or `None` if there is no such row.
+
+    A row already in the current session is returned as is. Otherwise it's rebuilt from the row
+    cache without querying the database or, failing that, loaded with `load(row_id)` and cached,
+    unless it was read from the replica, which may still hold a version the cache has dropped.
+    `snapshot(row)` returns what to cache for a row and the tags to store it with, and
+    `restore(cached)` rebuilds the row from it and attaches it to the session; by default a row's
+    column values are cached, except those named in `exclude`, tagged with the row itself. Columns
+    left out of the cache are loaded from the database if they're used.
+    """
+    try:
+        row_id = int(row_id)
+    except (TypeError, ValueError):
+        return load(row_id)
+
+    row = db.session.identity_map.get(identity_key(model, row_id))
+    if row is not None:
+        return row
+
+    key = row_tag(model, row_id)
+    cached = row_cache.get(key)
+    if cached is not None:
+        if restore is None:
+            return db.session.merge(detached_row(model, cached), load=False)
+        return restore(cached)
+
+    row = load(row_id)
+    if row is not None and row_cache.enabled and not reading_from_replica():
+        if snapshot is None:
+            row_cache.set(key, column_values(row, exclude), (key,))
+        else:
+            row_cache.set(key, *snapshot(row))
+    return row
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_row_cache_tags(session, flush_context):
+    """
+    Notes the tags of the cached rows changed or deleted by a flush, to invalidate on commit.
+    """
+    if not row_cache.enabled:
+        return
+
+    tags = session.info.setdefault('row_cache_tags', set())
+    for row in chain(session.dirty, session.deleted):
+        if isinstance(row, (Author, Book, Image, PaymentCard, Promotion, Publisher, User)):
+            tags.add(row_tag(type(row), row.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_row_cache(session):
+    row_cache.invalidate(session.info.pop('row_cache_tags', ()))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_row_cache_tags(session, previous_transaction):
+    session.info.pop('row_cache_tags', None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    Returns the logged in `User` for `user_id`.
+
+    flask_login keeps the result for the rest of the request, so this runs at most once per request.
+    """
+    return User.load_principal(int(user_id))
 
 
 ####################################################################################################
@@ -100,7 +308,8 @@ user_to_userprivilege = db.Table(
 user_to_userstate = db.Table(
     'user_userstate',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('userstate_id', db.Integer, db.ForeignKey('userstate.id'), primary_key=True),
+    db.Column('userstate_id', db.Integer, db.ForeignKey('userstate.id'), primary_key=True,
+              index=True),
 )
 
 
@@ -202,6 +411,16 @@ order_to_promotion = db.Table(
     db.Column('promotion_id', db.Integer, db.ForeignKey('promotion.id'), primary_key=True),
 )
 
+# The books most often bought together with each book, best first, as ranked by
+# sahara/recommendations.py. Keyed by (book_id, rank), so a book's list is one index range.
+book_recommendation = db.Table(
+    'book_recommendation',
+    db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('related_book_id', db.Integer, db.ForeignKey('book.id'), nullable=False),
+    db.Column('score', db.Float, nullable=False),
+)
+
 ####################################################################################################
 #                                             DB MODELS                                            #
 ####################################################################################################
@@ -211,10 +430,15 @@ order_to_promotion = db.Table(
 # User #########################################################################
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
+    __table_args__ = (
+        db.Index('ix_user_name', 'last_name', 'first_name'),
+    )
 
     # Auth fields
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(50), unique=True, nullable=False)
+    # Compared without regard to case, as MySQL does by default, on SQLite too
+    email = db.Column(db.String(50).with_variant(db.String(50, collation='NOCASE'), 'sqlite'),
+                      unique=True, nullable=False)
     password = db.Column(db.String(60), nullable=False)
 
     # Subscription status
@@ -269,7 +493,10 @@ class User(db.Model, UserMixin):
         While this function returns `None` if the User does not exist, the `User.exists()` function
         is recommended for checking the existence of a `User` in the database.
         """
-        requested_user = User.query.filter_by(email=email).first()
+        if not registered_emails.might_exist(email):
+            return None
+
+        requested_user = User.query.filter_by(email=email.strip()).first()
         if requested_user:
             return requested_user
         else:
@@ -284,11 +511,81 @@ class User(db.Model, UserMixin):
         While this function returns `None` if the User does not exist, the `User.exists()` function
         is recommended for checking the existence of a `User` in the database.
         """
-        requested_user = User.query.filter_by(id=user_id).first()
-        if requested_user:
-            return requested_user
-        else:
-            return None
+        return cached_get(User, user_id, lambda row_id: User.query.filter_by(id=row_id).first(),
+                          snapshot=lambda user: (user.__snapshot(), (row_tag(User, user.id),)),
+                          restore=User.__from_snapshot)
+
+    @staticmethod
+    def load_principal(user_id):
+        """
+        Returns the `User` corresponding to the inputted `user_id` with its privilege, state and
+        cart already loaded, or `None` if such a User doesn't exist.
+
+        The User and everything needed to authorize and render a request for them is fetched in a
+        single query. When the principal cache is enabled, a recent copy is reused instead and no
+        query is issued at all.
+        """
+        snapshot = principal_cache.get(user_id)
+        if snapshot is not None:
+            return User.__from_snapshot(snapshot)
+
+        # The association tables are joined by hand: joining along the relationships (or using
+        # joinedload()) wraps each association table and its target in a nested outer join, which
+        # SQLite evaluates by scanning the whole association table
+        user = (User.query
+                .outerjoin(user_to_userprivilege, user_to_userprivilege.c.user_id == User.id)
+                .outerjoin(UserPrivilege,
+                           UserPrivilege.id == user_to_userprivilege.c.userprivilege_id)
+                .outerjoin(user_to_userstate, user_to_userstate.c.user_id == User.id)
+                .outerjoin(UserState, UserState.id == user_to_userstate.c.userstate_id)
+                .outerjoin(user_to_cart, user_to_cart.c.user_id == User.id)
+                .outerjoin(Cart, Cart.id == user_to_cart.c.cart_id)
+                .options(contains_eager(User.privilege),
+                         contains_eager(User.state),
+                         contains_eager(User.cart))
+                .filter(User.id == user_id)
+                .first())
+
+        if user is not None and principal_cache.enabled and not reading_from_replica():
+            principal_cache.set(user_id, user.__snapshot())
+        return user
+
+    def __snapshot(self):
+        """
+        Returns the column values, privilege id, state id and cart id of this User as a plain dict.
+        The password hash is left out, so that it's never kept in a cache, and is loaded if it's
+        used.
+        """
+        snapshot = column_values(self, exclude=('password',))
+        snapshot['privilege_id'] = self.privilege.id if self.privilege else None
+        snapshot['state_id'] = self.state.id if self.state else None
+        snapshot['cart_id'] = self.cart.id if self.cart else None
+        return snapshot
+
+    @staticmethod
+    def __from_snapshot(snapshot):
+        """
+        Rebuilds a User from `User.__snapshot()` and attaches it to the current session without
+        querying the database. The privilege, state and cart are attached by id (the cart's
+        subtotal and items load when they're used); other relationships load lazily as usual.
+        """
+        snapshot = dict(snapshot)
+        privilege_id = snapshot.pop('privilege_id')
+        state_id = snapshot.pop('state_id')
+        cart_id = snapshot.pop('cart_id')
+
+        user = User(**snapshot)
+        for key, model, pk in (('privilege', UserPrivilege, privilege_id),
+                               ('state', UserState, state_id),
+                               ('cart', Cart, cart_id)):
+            related = None
+            if pk is not None:
+                related = model(id=pk)
+                make_transient_to_detached(related)
+            set_committed_value(user, key, related)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
 
     @staticmethod
     def from_timed_token(token):
@@ -296,7 +593,7 @@ class User(db.Model, UserMixin):
         Returns the `User` corresponding to the inputted `token`, or `None` if such a User doesn't
         exist or if the inputted token has expired.
         """
-        s = Serializer(app.config['SECRET_KEY'])
+        s = Serializer(current_app.config['SECRET_KEY'])
 
         try:
             user_id = s.loads(token)['user_id']
@@ -315,12 +612,52 @@ class User(db.Model, UserMixin):
         """
         return User.query.all()
 
+    @staticmethod
+    def directory(page=1, per_page=50, state_id=None, is_subscribed=None, email_prefix=None,
+                  sort='id', descending=False):
+        """
+        Returns a `Pagination` over Users for the admin user directory.
+
+        Results can be narrowed by `state_id`, `is_subscribed` and `email_prefix`, and ordered by
+        `sort`, one of `'id'`, `'name'`, `'email'`, `'state'` or `'subscribed'`.
+
+        Each User's state and privilege are fetched by the same joined query as the page itself, so
+        rendering a page costs one query (plus one to count the results) regardless of its size.
+        """
+        query = (User.query
+                 .join(User.state)
+                 .join(User.privilege)
+                 .options(contains_eager(User.state), contains_eager(User.privilege)))
+
+        if state_id is not None:
+            query = query.filter(UserState.id == state_id)
+        if is_subscribed is not None:
+            query = query.filter(User.is_subscribed == is_subscribed)
+        if email_prefix:
+            query = query.filter(User.email.startswith(email_prefix, autoescape=True))
+
+        sorts = {
+            'id': [User.id],
+            'name': [User.last_name, User.first_name],
+            'email': [User.email],
+            'state': [UserState.id],
+            'subscribed': [User.is_subscribed],
+        }
+        columns = sorts.get(sort, sorts['id'])
+        if descending:
+            columns = [column.desc() for column in columns]
+        query = query.order_by(*columns, User.id)
+
+        return query.paginate(page=page, per_page=per_page, error_out=False)
+
     def __commit_to_database(self):
         """
         Commits this User to the database in its current state.
         """
         db.session.add(self)
         db.session.commit()
+        if principal_cache.enabled:
+            principal_cache.pop(self.id)
 
     def set_password(self, password, commit=True):
         """
@@ -472,6 +809,38 @@ class User(db.Model, UserMixin):
         if commit:
             self.__commit_to_database()
 
+    @staticmethod
+    def set_states(user_ids, state_id):
+        """
+        Changes the state of every User in `user_ids` to `state_id` with a single UPDATE, and
+        returns the `(id, email, first_name)` of each User changed.
+
+        The administrator's state is never changed, and ids of Users that don't exist are ignored.
+        """
+        admin_ids = (db.session.query(user_to_userprivilege.c.user_id)
+                     .filter(user_to_userprivilege.c.userprivilege_id == Privileges.ADMIN.value))
+        changed = (db.session.query(User.id, User.email, User.first_name)
+                   .filter(User.id.in_(user_ids), User.id.notin_(admin_ids))
+                   .all())
+        if not changed:
+            return []
+
+        # Make sure the state exists before pointing Users at it
+        db.session.add(UserState.from_id(state_id))
+
+        db.session.execute(
+            user_to_userstate.update()
+            .where(user_to_userstate.c.user_id.in_([user.id for user in changed]))
+            .values(userstate_id=state_id)
+        )
+        db.session.commit()
+
+        for user in changed:
+            principal_cache.pop(user.id)
+        # A bulk UPDATE doesn't go through the session, so the row cache is told by hand
+        row_cache.invalidate(row_tag(User, user.id) for user in changed)
+        return changed
+
     def confirm_order(self, promotion_applied=None, payment_method=None, shipping_addr=None):
         subtotal = self.cart.subtotal
         if promotion_applied:
@@ -494,6 +863,12 @@ class User(db.Model, UserMixin):
 
         self.previous_orders.append(new_order)
 
+        # Counted as part of the order, so that the rankings never need to add up past orders. The
+        # increment happens in the database, so concurrent orders of the same book can't lose one.
+        for cart_item in self.cart.cart_items:
+            if cart_item.quantity > 0:
+                cart_item.book.units_sold = Book.units_sold + cart_item.quantity
+
         self.cart = Cart.next_available()
 
         self.__commit_to_database()
@@ -514,20 +889,24 @@ class User(db.Model, UserMixin):
             # User should be CUSTOMER and INACTIVE
             self.privilege = UserPrivilege.from_id(Privileges.CUSTOMER.value)
             self.state = UserState.from_id(States.INACTIVE.value)
-
-            user_id = User.query.order_by('id').all()[-1].id + 1
             self.cart = Cart.next_available()
 
         # Add user to session
         self.__commit_to_database()
+        registered_emails.add(self.email)
 
     # Utilities
     @staticmethod
     def exists(email):
         """
         Returns true if there is a User that exists by the inputted `email`.
+
+        Emails that have never been registered are ruled out without querying the database.
         """
-        if User.query.filter_by(email=email).first():
+        if not registered_emails.might_exist(email):
+            return False
+
+        if User.query.filter_by(email=email.strip()).first():
             return True
         else:
             return False
@@ -560,7 +939,7 @@ class User(db.Model, UserMixin):
         Returns a string representing a timed token that encapsulates this `User`'s id for
         `expires_sec` seconds.
         """
-        s = Serializer(app.config['SECRET_KEY'], expires_sec)
+        s = Serializer(current_app.config['SECRET_KEY'], expires_sec)
         return s.dumps({'user_id': self.id}).decode('utf-8')
 
     def __repr__(self):
@@ -726,11 +1105,10 @@ class PaymentCard(db.Model):
 
     @staticmethod
     def from_id(card_id):
-        card = PaymentCard.query.filter_by(id=card_id).first()
-        if card:
-            return card
-        else:
-            return None
+        # The card number's hash and the security code are never kept in the cache
+        return cached_get(PaymentCard, card_id,
+                          lambda row_id: PaymentCard.query.filter_by(id=row_id).first(),
+                          exclude=('number', 'security_code'))
 
 
 ################################################################################
@@ -744,8 +1122,9 @@ class UserPrivilege(db.Model):
     # Constructors
     @staticmethod
     def from_id(privilege_id):
-        # Check for privilege type in db
-        privilege = UserPrivilege.query.filter_by(id=privilege_id).first()
+        # Check for privilege type in db (or in the session, which costs no query)
+        privilege = (known_lookup(UserPrivilege, privilege_id)
+                     or UserPrivilege.query.get(privilege_id))
         if privilege:
             # It exists, return it
             return privilege
@@ -765,8 +1144,9 @@ class UserState(db.Model):
     # Constructors
     @staticmethod
     def from_id(state_id):
-        if UserState.query.filter_by(id=state_id).first():
-            return UserState.query.filter_by(id=state_id).first()
+        state = known_lookup(UserState, state_id) or UserState.query.get(state_id)
+        if state:
+            return state
         else:
             return UserState(id=state_id)
 
@@ -809,6 +1189,7 @@ class Book(db.Model):
     price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     rating = db.Column(db.Float, nullable=False)
+    units_sold = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
 
     # Data Access
     @staticmethod
@@ -831,6 +1212,8 @@ class Book(db.Model):
     def commit_to_system(self):
         db.session.add(self)
         db.session.commit()
+        book_suggestions.add(self.id, self.title, self.isbn, self.units_sold,
+                             [repr(author) for author in self.authors])
 
     """
     @staticmethod
@@ -854,18 +1237,137 @@ class Book(db.Model):
         # Book.authors[0].first_name.like(f'%{term}%'),
         # Book.authors[0].last_name.like(f'%{term}%')
 
+    @staticmethod
+    def search_similar(search_term, limit=SIMILAR_RESULTS_SHOWN):
+        """
+        Returns up to `limit` Books whose title or an author's name is close to `search_term`,
+        allowing for typos, closest first, and the title or name that came closest (or `None` if
+        no Book did).
+
+        Matched in memory against the trigrams of every title and author name (see
+        sahara/suggestions.py) rather than by scanning the book table.
+        """
+        matches = book_suggestions.similar(search_term, limit)
+        if not matches:
+            return [], None
+
+        # Loaded by primary key in one query, like the rows Book.search() returns. A book deleted
+        # since it was indexed is skipped.
+        books = {book.id: book for book in
+                 Book.query.filter(Book.id.in_([book_id for book_id, _, _ in matches]))}
+        return [books[book_id] for book_id, _, _ in matches if book_id in books], matches[0][1]
+
     @staticmethod
     def search_by_category(category_id):
         return Book.query.filter_by(category=BookCategory.from_id(category_id)).all()
 
     @staticmethod
     def get_by_id(book_id):
-        return Book.query.get(book_id)
+        """
+        Returns the `Book` with the id `book_id`, with its authors, publisher, cover and category,
+        or `None` if there is no such Book.
+        """
+        return cached_get(Book, book_id, Book.query.get,
+                          snapshot=Book.__snapshot, restore=Book.__from_snapshot)
+
+    def __snapshot(self):
+        """
+        Returns the column values of this Book and of the rows it links to as a plain dict, and the
+        tags of every row included.
+        """
+        # The stock level and sales change with every order, so they're left out and loaded when
+        # they're read
+        snapshot = column_values(self, exclude=('quantity', 'units_sold'))
+        snapshot['authors'] = [column_values(author) for author in self.authors]
+        snapshot['publisher'] = column_values(self.publisher) if self.publisher else None
+        snapshot['cover_image'] = column_values(self.cover_image) if self.cover_image else None
+        snapshot['category_id'] = self.category.id if self.category else None
+
+        tags = [row_tag(Book, self.id)]
+        tags += [row_tag(Author, author['id']) for author in snapshot['authors']]
+        for model, key in ((Publisher, 'publisher'), (Image, 'cover_image')):
+            if snapshot[key] is not None:
+                tags.append(row_tag(model, snapshot[key]['id']))
+        return snapshot, tags
+
+    @staticmethod
+    def __from_snapshot(snapshot):
+        """
+        Rebuilds a Book from `Book.__snapshot()` and attaches it to the current session without
+        querying the database.
+        """
+        snapshot = dict(snapshot)
+        authors = [detached_row(Author, values) for values in snapshot.pop('authors')]
+        related = {'authors': authors}
+        for model, key in ((Publisher, 'publisher'), (Image, 'cover_image')):
+            values = snapshot.pop(key)
+            related[key] = detached_row(model, values) if values is not None else None
+        category_id = snapshot.pop('category_id')
+        related['category'] = (detached_row(BookCategory, {'id': category_id})
+                               if category_id is not None else None)
+
+        book = Book(**snapshot)
+        for key, value in related.items():
+            set_committed_value(book, key, value)
+        make_transient_to_detached(book)
+
+        return db.session.merge(book, load=False)
 
     @staticmethod
     def search_by_quantity():
         return Book.query.order_by(Book.quantity)
 
+    @staticmethod
+    def bestsellers(category_id=None, limit=BESTSELLERS_SHOWN):
+        """
+        Returns the `limit` best selling Books of the category `category_id`, or of all categories,
+        most copies sold first.
+
+        The ranking is read off `units_sold` and kept for BESTSELLER_CACHE_TTL seconds, so it can
+        lag a little behind the latest orders; the Books themselves come from the row cache.
+        """
+        key = f'bestsellers:{category_id}:{limit}'
+        book_ids = bestseller_cache.get(key)
+        if book_ids is None:
+            query = db.session.query(Book.id)
+            if category_id is not None:
+                query = query.join(book_to_category).filter(
+                    book_to_category.c.bookcategory_id == category_id)
+            book_ids = [book_id for (book_id,) in
+                        query.order_by(Book.units_sold.desc(), Book.id).limit(limit)]
+            bestseller_cache.set(key, book_ids)
+
+        # A book deleted since the ranking was cached is skipped
+        books = (Book.get_by_id(book_id) for book_id in book_ids)
+        return [book for book in books if book is not None]
+
+    def also_bought(self, limit=RELATED_BOOKS_SHOWN):
+        """
+        Returns up to `limit` of the Books most often bought together with this Book, as last
+        ranked by the recommendation job (see sahara/recommendations.py).
+        """
+        book_ids = db.session.query(book_recommendation.c.related_book_id) \
+            .filter(book_recommendation.c.book_id == self.id) \
+            .order_by(book_recommendation.c.rank) \
+            .limit(limit)
+        books = (Book.get_by_id(book_id) for (book_id,) in book_ids)
+        return [book for book in books if book is not None]
+
+    @staticmethod
+    def recount_units_sold():
+        """
+        Sets the `units_sold` of every Book to the copies of it in past orders, e.g. after adding
+        the column to an existing database, and returns the number of Books updated.
+        """
+        sold = db.session.query(func.coalesce(func.sum(CartItem.quantity), 0)) \
+            .join(order_to_cart, order_to_cart.c.cart_id == CartItem.cart_id) \
+            .filter(CartItem.book_id == Book.id) \
+            .scalar_subquery()
+        count = Book.query.update({Book.units_sold: sold}, synchronize_session=False)
+        db.session.commit()
+        bestseller_cache.clear()
+        return count
+
     # Utilities
     def __repr__(self):
         return f'Book(ID = {self.id}, Title = {self.title})'
@@ -906,7 +1408,8 @@ class BookCategory(db.Model):
     # Constructors
     @staticmethod
     def from_id(category_id):
-        category = BookCategory.query.filter_by(id=category_id).first()
+        category = (known_lookup(BookCategory, category_id)
+                    or BookCategory.query.filter_by(id=category_id).first())
         if category:
             return category
         else:
@@ -957,12 +1460,20 @@ class Image(db.Model):
 
     # Properties
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(100), nullable=False, index=True)
 
     @staticmethod
     def from_filename(filename):
+        # Cached by filename, and tagged with the row so that changing it drops this entry too
+        key = f'Image:filename:{filename}'
+        cached = row_cache.get(key)
+        if cached is not None:
+            return db.session.merge(detached_row(Image, cached), load=False)
+
         image = Image.query.filter_by(filename=filename).first()
         if image:
+            if not reading_from_replica():
+                row_cache.set(key, column_values(image), (row_tag(Image, image.id),))
             return image
         else:
             return Image(filename=filename)
@@ -1011,11 +1522,8 @@ class Promotion(db.Model):
     
     @staticmethod
     def from_id(promo_id):
-        promo = Promotion.query.filter_by(id=promo_id).first()
-        if promo:
-            return promo
-        else:
-            return None
+        return cached_get(Promotion, promo_id,
+                          lambda row_id: Promotion.query.filter_by(id=row_id).first())
 
     @property
     def is_active(self):
@@ -1176,7 +1684,8 @@ class OrderState(db.Model):
     # Constructors
     @staticmethod
     def from_id(state_id):
-        if OrderState.query.filter_by(id=state_id).first():
-            return OrderState.query.filter_by(id=state_id).first()
+        state = known_lookup(OrderState, state_id) or OrderState.query.get(state_id)
+        if state:
+            return state
         else:
             return OrderState(id=state_id)
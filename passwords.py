@@ -0,0 +1,155 @@
+import os
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from threading import Lock
+import bcrypt
+from flask import current_app
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Seconds a request will wait on the hashing pool before giving up
+HASH_TIMEOUT = 30
+
+# Passwords sent to a worker at a time by hash_passwords()
+HASH_CHUNK_SIZE = 16
+
+
+class HashTimeout(Exception):
+    """
+    Raised when the hashing pool doesn't answer within HASH_TIMEOUT seconds, e.g. because every
+    worker is busy. The request should be turned away with a "try again" rather than fail.
+    """
+
+
+####################################################################################################
+#                                         WORKER FUNCTIONS                                         #
+####################################################################################################
+
+# These run inside the worker processes, so they must stay at module level (picklable) and must not
+# touch the app, the database or any other per-process state.
+
+
+def _hash(password, rounds):
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        # Malformed hash
+        return False
+
+
+####################################################################################################
+#                                           HASHING POOL                                           #
+####################################################################################################
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = Lock()
+
+
+def _get_executor():
+    """
+    Returns this process' hashing pool, creating it on first use, or `None` if hashing should be
+    done inline (`PASSWORD_HASH_WORKERS = 0`).
+
+    The pool is keyed by pid so that a pool created before a fork is never shared with the child.
+    """
+    global _executor, _executor_pid
+
+    max_workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if max_workers < 1:
+        return None
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run(fn, *args):
+    executor = _get_executor()
+    if executor is None:
+        return fn(*args)
+    future = executor.submit(fn, *args)
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except futures.TimeoutError:
+        # Not worth hashing any more if it hasn't started, as nobody is waiting for it
+        future.cancel()
+        raise HashTimeout(f'No hashing worker answered within {HASH_TIMEOUT}s') from None
+
+
+def shutdown():
+    """
+    Stops this process' hashing pool, if one has been started.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+####################################################################################################
+#                                            PUBLIC API                                            #
+####################################################################################################
+
+
+def hash_password(password):
+    """
+    Returns the bcrypt hash of `password` at the configured cost (`BCRYPT_LOG_ROUNDS`). Raises
+    `HashTimeout` if the hashing pool is too busy.
+    """
+    return _run(_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def hash_passwords(passwords, executor=None):
+    """
+    Returns the bcrypt hashes of `passwords`, in order, at the configured cost.
+
+    Meant for batch jobs such as user imports, which should pass their own, larger `executor`. The
+    hashing pool (or the calling thread, if there is none) is used otherwise.
+    """
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    executor = executor or _get_executor()
+    if executor is None:
+        return [_hash(password, rounds) for password in passwords]
+
+    return list(executor.map(_hash, passwords, repeat(rounds), chunksize=HASH_CHUNK_SIZE))
+
+
+def check_password(pw_hash, password):
+    """
+    Returns true if `password` matches the bcrypt hash `pw_hash`. Raises `HashTimeout` if the
+    hashing pool is too busy.
+    """
+    return _run(_check, pw_hash, password)
+
+
+def get_rounds(pw_hash):
+    """
+    Returns the cost factor encoded in the bcrypt hash `pw_hash`, or `None` if it can't be read.
+    """
+    # Hashes look like "$2b$12$<salt and checksum>"
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(pw_hash):
+    """
+    Returns true if `pw_hash` was made at a different cost than the one currently configured.
+    """
+    return get_rounds(pw_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
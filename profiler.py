@@ -0,0 +1,205 @@
+# File: profiler.py
+#
+# Profiling a sample of live requests.
+#
+# A WSGI middleware runs a fraction of requests (PROFILE_RATE), every request to the paths in
+# PROFILE_PATHS, and any request carrying an X-Profile header equal to PROFILE_TOKEN under cProfile.
+# Each capture is saved to PROFILE_DIR as a .prof file, loadable with pstats or snakeviz, next to a
+# .json file holding the request's path, status and timing. Admins can list the slowest captures at
+# /admin/profiles.
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from os import path
+from flask import current_app
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+TOKEN_HEADER = 'HTTP_X_PROFILE'
+
+# Captures are named "<timestamp>-<random hex>"
+CAPTURE_NAME = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+# Orders a capture's functions can be listed in
+REPORT_SORTS = ('cumulative', 'tottime', 'calls')
+
+logger = logging.getLogger(__name__)
+
+
+####################################################################################################
+#                                            MIDDLEWARE                                            #
+####################################################################################################
+
+
+class ProfilerMiddleware:
+    """
+    Wraps `wsgi_app`, profiling the requests picked by `should_profile()` and saving each capture
+    into `profile_dir`, which keeps at most `max_files` of them.
+    """
+
+    def __init__(self, wsgi_app, profile_dir, rate=0.0, paths=(), token=None, max_files=500):
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.rate = rate
+        self.paths = tuple(p.rstrip('/') or '/' for p in paths)
+        self.token = token
+        self.max_files = max_files
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def should_profile(self, environ):
+        if self.token and environ.get(TOKEN_HEADER) == self.token:
+            return True
+
+        request_path = environ.get('PATH_INFO', '')
+        for profiled_path in self.paths:
+            if request_path == profiled_path or request_path.startswith(profiled_path + '/'):
+                return True
+
+        return self.rate > 0 and random.random() < self.rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        status = []
+
+        def capture_status(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        body = None
+        try:
+            # Read the whole body while profiling, so the work done by streamed responses counts
+            body = self.wsgi_app(environ, capture_status)
+            chunks = list(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            self.save(profile, environ, status[0] if status else '500 INTERNAL SERVER ERROR',
+                      elapsed)
+
+        return chunks
+
+    def save(self, profile, environ, status, elapsed):
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        metadata = {
+            'name': name,
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'query_string': environ.get('QUERY_STRING', ''),
+            'status': int(status.split(' ', 1)[0]),
+            'duration_ms': round(elapsed * 1000, 2),
+            'sql_count': environ.get('sahara.sql_count'),
+            'timestamp': time.time(),
+            'pid': os.getpid(),
+        }
+
+        try:
+            profile.dump_stats(path.join(self.profile_dir, f'{name}.prof'))
+            with open(path.join(self.profile_dir, f'{name}.json'), 'w') as f:
+                json.dump(metadata, f)
+            self.prune()
+        except OSError:
+            logger.exception('Failed to save the profile of %s', metadata['path'])
+
+    def prune(self):
+        """
+        Deletes the oldest captures beyond `max_files`.
+        """
+        names = sorted(name[:-len('.json')] for name in os.listdir(self.profile_dir)
+                       if name.endswith('.json'))
+        for name in names[:max(0, len(names) - self.max_files)]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(path.join(self.profile_dir, name + extension))
+                except FileNotFoundError:
+                    pass
+
+
+def init_app(app):
+    """
+    Wraps `app` in a `ProfilerMiddleware` if anything is configured to be profiled.
+    """
+    paths = [p.strip() for p in app.config['PROFILE_PATHS'].split(',') if p.strip()]
+    if app.config['PROFILE_RATE'] > 0 or paths or app.config['PROFILE_TOKEN']:
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app,
+                                          app.config['PROFILE_DIR'],
+                                          rate=app.config['PROFILE_RATE'],
+                                          paths=paths,
+                                          token=app.config['PROFILE_TOKEN'],
+                                          max_files=app.config['PROFILE_MAX_FILES'])
+
+
+####################################################################################################
+#                                             CAPTURES                                             #
+####################################################################################################
+
+
+def slowest_captures(limit=50):
+    """
+    Returns the metadata of the `limit` slowest captures, slowest first.
+    """
+    profile_dir = current_app.config['PROFILE_DIR']
+    if not path.isdir(profile_dir):
+        return []
+
+    captures = []
+    for name in os.listdir(profile_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(path.join(profile_dir, name)) as f:
+                captures.append(json.load(f))
+        except (OSError, ValueError):
+            # Pruned or still being written by another worker
+            continue
+
+    captures.sort(key=lambda capture: capture['duration_ms'], reverse=True)
+    return captures[:limit]
+
+
+def capture_path(name, extension):
+    """
+    Returns the location of the `extension` file of the capture `name`, or `None` if `name` isn't
+    a capture name.
+    """
+    if not CAPTURE_NAME.match(name):
+        return None
+    return path.join(current_app.config['PROFILE_DIR'], name + extension)
+
+
+def capture_report(name, sort='cumulative', limit=60):
+    """
+    Returns the metadata of the capture `name` and its `limit` most expensive functions by `sort`
+    as text, or `None` if there is no such capture.
+    """
+    if sort not in REPORT_SORTS:
+        sort = REPORT_SORTS[0]
+
+    prof_path, json_path = capture_path(name, '.prof'), capture_path(name, '.json')
+    if prof_path is None or not path.isfile(prof_path) or not path.isfile(json_path):
+        return None
+
+    with open(json_path) as f:
+        metadata = json.load(f)
+
+    report = io.StringIO()
+    stats = pstats.Stats(prof_path, stream=report)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return metadata, report.getvalue()
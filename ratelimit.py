@@ -0,0 +1,220 @@
+import os
+import sqlite3
+import time
+from collections import deque
+from threading import Lock, local
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Seconds between sweeps of the attempts that have left every window, which would otherwise be kept
+# for every IP and email ever seen
+PRUNE_INTERVAL = 60
+
+####################################################################################################
+#                                             BACKENDS                                             #
+####################################################################################################
+
+
+class MemoryBackend:
+    """
+    Keeps the timestamps of recent attempts in this process' memory.
+
+    Each worker process counts on its own, so the effective limit is multiplied by the number of
+    workers. Use `SQLiteBackend` to share counts between workers on the same host.
+    """
+
+    def __init__(self):
+        self._hits = {}
+        self._lock = Lock()
+
+    def hit(self, key, window, limit, now):
+        """
+        Records an attempt for `key` at `now` if fewer than `limit` attempts were made in the last
+        `window` seconds, and returns whether the attempt was allowed.
+        """
+        with self._lock:
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+
+            if len(hits) >= limit:
+                return False
+
+            hits.append(now)
+            return True
+
+    def prune(self, before):
+        """
+        Forgets every key with no attempt since `before`.
+        """
+        with self._lock:
+            stale = [key for key, hits in self._hits.items() if not hits or hits[-1] <= before]
+            for key in stale:
+                del self._hits[key]
+
+    def clear(self):
+        with self._lock:
+            self._hits.clear()
+
+
+class SQLiteBackend:
+    """
+    Keeps the timestamps of recent attempts in a SQLite file shared by every worker on the host.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = local()
+
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS rate_limit_hit (key TEXT, ts REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_rate_limit_hit ON rate_limit_hit (key, ts)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_rate_limit_hit_ts ON rate_limit_hit (ts)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads or processes, so keep one per thread,
+        # and open a new one in a worker forked after the backend was created
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def hit(self, key, window, limit, now):
+        """
+        Records an attempt for `key` at `now` if fewer than `limit` attempts were made in the last
+        `window` seconds, and returns whether the attempt was allowed.
+        """
+        connection = self._connection()
+
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't both see the last
+        # free slot
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM rate_limit_hit WHERE key = ? AND ts <= ?',
+                               (key, now - window))
+            (count,) = connection.execute('SELECT COUNT(*) FROM rate_limit_hit WHERE key = ?',
+                                          (key,)).fetchone()
+
+            allowed = count < limit
+            if allowed:
+                connection.execute('INSERT INTO rate_limit_hit (key, ts) VALUES (?, ?)',
+                                   (key, now))
+            connection.execute('COMMIT')
+            return allowed
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def prune(self, before):
+        """
+        Deletes every attempt made before `before`, whatever its key.
+        """
+        connection = self._connection()
+        connection.execute('DELETE FROM rate_limit_hit WHERE ts <= ?', (before,))
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM rate_limit_hit')
+
+
+####################################################################################################
+#                                           RATE LIMITER                                           #
+####################################################################################################
+
+
+def parse_limit(limit):
+    """
+    Parses a limit written as `'<attempts>/<seconds>'` (e.g. `'5/60'`) into a tuple of ints.
+    """
+    attempts, seconds = limit.split('/')
+    return int(attempts), int(seconds)
+
+
+class RateLimiter:
+    """
+    Sliding-window rate limiting of named actions (e.g. `'login'`) by client IP and by email.
+
+    `limits` maps each action to a dict with optional `'ip'` and `'email'` entries, each a limit
+    in the form accepted by `parse_limit()`. Every PRUNE_INTERVAL seconds, the backend forgets the
+    attempts older than the longest window.
+    """
+
+    def __init__(self, backend, limits, enabled=True):
+        self.backend = backend
+        self.limits = {action: {scope: parse_limit(limit) for scope, limit in scopes.items()}
+                       for action, scopes in limits.items()}
+        self.enabled = enabled
+
+        self._longest_window = max((window for scopes in self.limits.values()
+                                    for _, window in scopes.values()), default=0)
+        self._last_prune = time.time()
+
+    def allow(self, action, ip=None, email=None):
+        """
+        Returns true if an attempt at `action` from `ip` for `email` is within every limit, and
+        records the attempt against each of them.
+
+        Pass only the values known so far; e.g. check the IP before reading the form and the email
+        once it has been validated.
+        """
+        if not self.enabled:
+            return True
+
+        now = time.time()
+        if now - self._last_prune >= PRUNE_INTERVAL:
+            # Set first, so that only one of the threads getting here prunes
+            self._last_prune = now
+            self.backend.prune(now - self._longest_window)
+
+        for scope, value in (('ip', ip), ('email', email)):
+            if value is None or scope not in self.limits.get(action, {}):
+                continue
+
+            limit, window = self.limits[action][scope]
+            key = f'{action}:{scope}:{value.lower()}'
+            if not self.backend.hit(key, window, limit, now):
+                return False
+
+        return True
+
+
+def create_limiter(config):
+    """
+    Returns a `RateLimiter` configured from the app `config`.
+    """
+    if config['RATELIMIT_BACKEND'] == 'sqlite':
+        backend = SQLiteBackend(config['RATELIMIT_SQLITE_PATH'])
+    else:
+        backend = MemoryBackend()
+
+    limits = {
+        'login': {
+            'ip': config['RATELIMIT_LOGIN_IP'],
+            'email': config['RATELIMIT_LOGIN_EMAIL'],
+        },
+        'reset_password': {
+            'ip': config['RATELIMIT_RESET_IP'],
+            'email': config['RATELIMIT_RESET_EMAIL'],
+        },
+    }
+
+    return RateLimiter(backend, limits, enabled=config['RATELIMIT_ENABLED'])
+
+
+def init_app(app):
+    app.extensions['sahara_limiter'] = create_limiter(app.config)
+
+
+# The `RateLimiter` of the current app
+limiter = LocalProxy(lambda: current_app.extensions['sahara_limiter'])
@@ -0,0 +1,233 @@
+# File: recommendations.py
+#
+# "Customers also bought": ranks, for every book, the books most often ordered together with it.
+#
+# The job counts how many orders contain each pair of books in a sparse book x book matrix, built
+# with SciPy from the order x book matrix of past orders (X.T @ X). Each book's neighbours are
+# scored by cosine similarity (orders with both / sqrt(orders with one * orders with the other)),
+# so the store's bestsellers don't top every list, and the best RECOMMENDATIONS_TOP_K are written
+# to the `book_recommendation` table, which the book page reads with one indexed lookup.
+#
+# The matrix is saved to RECOMMENDATIONS_STATE_PATH with the id of the last order counted. Later
+# runs only count the orders placed since and re-rank the books whose scores they changed. Run it
+# from the project root, alongside the app, to keep the lists up to date as orders arrive:
+#     python -m sahara.recommendations --interval 300
+# or once (e.g. from cron), with --once. --rebuild starts again from every order.
+
+import argparse
+import os
+import time
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func, select
+from sahara import create_app, db
+from sahara.models import CartItem, book_recommendation, order_to_cart
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Order items fetched from the database at a time
+FETCH_SIZE = 50_000
+
+# Rows written to the recommendation table per statement
+WRITE_BATCH_SIZE = 1000
+
+
+####################################################################################################
+#                                         CO-PURCHASE MATRIX                                       #
+####################################################################################################
+
+
+def fetch_order_items(after_order_id):
+    """
+    Returns the order ids and book ids of the items of every order placed after `after_order_id`,
+    as two arrays.
+    """
+    query = select(order_to_cart.c.order_id, CartItem.book_id) \
+        .join(CartItem, CartItem.cart_id == order_to_cart.c.cart_id) \
+        .where(order_to_cart.c.order_id > after_order_id, CartItem.quantity > 0)
+
+    order_ids, book_ids = [], []
+    result = db.session.connection().execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=np.int64)
+        order_ids.append(chunk[:, 0])
+        book_ids.append(chunk[:, 1])
+
+    if not order_ids:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(order_ids), np.concatenate(book_ids)
+
+
+def co_purchase_counts(order_ids, book_ids, num_books):
+    """
+    Returns the symmetric `num_books` x `num_books` matrix of how many orders contain each pair of
+    books, whose diagonal is how many orders contain each book.
+    """
+    _, order_rows = np.unique(order_ids, return_inverse=True)
+    orders = sparse.csr_matrix((np.ones(len(book_ids), np.int32), (order_rows, book_ids)),
+                               shape=(order_rows.max(initial=-1) + 1, num_books))
+    # A book listed twice in an order still counts once
+    orders.sum_duplicates()
+    orders.data[:] = 1
+    return (orders.T @ orders).tocsr()
+
+
+def add_counts(counts, new_counts):
+    """
+    Returns the sum of two co-purchase matrices, grown to the larger of the two.
+    """
+    size = max(counts.shape[0], new_counts.shape[0])
+    counts = counts.copy()
+    new_counts = new_counts.copy()
+    counts.resize((size, size))
+    new_counts.resize((size, size))
+    return (counts + new_counts).tocsr()
+
+
+def load_state(state_path):
+    """
+    Returns the co-purchase matrix saved at `state_path` and the id of the last order it counts, or
+    `(None, 0)` if there is none.
+    """
+    if not os.path.isfile(state_path):
+        return None, 0
+
+    with np.load(state_path) as state:
+        counts = sparse.csr_matrix((state['data'], state['indices'], state['indptr']),
+                                   shape=tuple(state['shape']))
+        return counts, int(state['last_order_id'])
+
+
+def save_state(state_path, counts, last_order_id):
+    # Written next to the old state and moved over it, so a crash never leaves half a file
+    temp_path = state_path + '.tmp.npz'
+    np.savez(temp_path, data=counts.data, indices=counts.indices, indptr=counts.indptr,
+             shape=np.array(counts.shape), last_order_id=np.array(last_order_id))
+    os.replace(temp_path, state_path)
+
+
+####################################################################################################
+#                                              RANKING                                             #
+####################################################################################################
+
+
+def top_neighbours(counts, book_ids, top_k, min_count):
+    """
+    Returns the best `top_k` neighbours of each of `book_ids` as arrays of book ids, ranks (from 0),
+    neighbour ids and scores, leaving out pairs bought together fewer than `min_count` times.
+    """
+    rows = counts[book_ids]
+    row_of = np.repeat(np.arange(len(book_ids)), np.diff(rows.indptr))
+    neighbours = rows.indices
+    together = rows.data
+
+    # As floats, as the product of two counts can overflow their integer type
+    orders_with = counts.diagonal().astype(np.float64)
+    scores = together / np.sqrt(orders_with[book_ids[row_of]] * orders_with[neighbours])
+
+    keep = (neighbours != book_ids[row_of]) & (together >= min_count)
+    row_of, neighbours, scores = row_of[keep], neighbours[keep], scores[keep]
+
+    # Best first within each book, ties going to the lower book id. Sorting on the row last keeps
+    # each book's neighbours together, so their rank is their offset from the first of them.
+    order = np.lexsort((neighbours, -scores, row_of))
+    row_of, neighbours, scores = row_of[order], neighbours[order], scores[order]
+    starts = np.searchsorted(row_of, np.arange(len(book_ids)))
+    ranks = np.arange(len(row_of)) - starts[row_of]
+
+    best = ranks < top_k
+    return book_ids[row_of[best]], ranks[best], neighbours[best], scores[best]
+
+
+def write_recommendations(book_ids, ranked):
+    """
+    Replaces the recommendations of `book_ids` with the `ranked` ones from `top_neighbours()`.
+    """
+    table = book_recommendation
+    for i in range(0, len(book_ids), WRITE_BATCH_SIZE):
+        batch = book_ids[i:i + WRITE_BATCH_SIZE].tolist()
+        db.session.execute(table.delete().where(table.c.book_id.in_(batch)))
+
+    rows = [{'book_id': book_id, 'rank': rank, 'related_book_id': related, 'score': score}
+            for book_id, rank, related, score in zip(*(column.tolist() for column in ranked))]
+    for i in range(0, len(rows), WRITE_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + WRITE_BATCH_SIZE])
+    db.session.commit()
+
+
+def update(state_path, top_k, min_count, rebuild=False):
+    """
+    Counts the orders placed since the last run (or all of them, with `rebuild`) and re-ranks the
+    books they affect. Returns the number of orders counted and of books re-ranked.
+    """
+    counts, last_order_id = (None, 0) if rebuild else load_state(state_path)
+    latest_order_id = db.session.query(func.max(order_to_cart.c.order_id)).scalar() or 0
+    if last_order_id > latest_order_id:
+        # The saved matrix counts orders this database doesn't have, so it's from another one
+        counts, last_order_id = None, 0
+
+    order_ids, book_ids = fetch_order_items(last_order_id)
+    if counts is not None and not len(order_ids):
+        return 0, 0
+
+    num_books = int(book_ids.max(initial=0)) + 1
+    new_counts = co_purchase_counts(order_ids, book_ids, num_books)
+    if counts is None:
+        counts = new_counts
+        # Everything is re-ranked, so books that are no longer bought lose their old lists too
+        db.session.execute(book_recommendation.delete())
+        affected = np.unique(book_ids)
+    else:
+        counts = add_counts(counts, new_counts)
+        # The books in the new orders, and every book bought with them, as their scores depend on
+        # how many orders contain them
+        affected = np.unique(counts[np.unique(book_ids)].indices)
+
+    write_recommendations(affected, top_neighbours(counts, affected, top_k, min_count))
+    last_order_id = int(order_ids.max(initial=last_order_id))
+    save_state(state_path, counts, last_order_id)
+    return len(np.unique(order_ids)), len(affected)
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank the books bought together with each book.')
+    parser.add_argument('--interval', type=float, default=300,
+                        help='seconds between updates (default 300)')
+    parser.add_argument('--once', action='store_true', help='update once and exit')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='count every order again rather than only the new ones')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+    state_path = app.config['RECOMMENDATIONS_STATE_PATH']
+    top_k = app.config['RECOMMENDATIONS_TOP_K']
+    min_count = app.config['RECOMMENDATIONS_MIN_COUNT']
+
+    rebuild = args.rebuild
+    while True:
+        started = time.monotonic()
+        num_orders, num_books = update(state_path, top_k, min_count, rebuild=rebuild)
+        print(f'Counted {num_orders} orders and re-ranked {num_books} books '
+              f'in {time.monotonic() - started:.2f}s')
+        db.session.remove()
+
+        if args.once:
+            break
+        rebuild = False
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
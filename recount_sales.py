@@ -0,0 +1,20 @@
+# File: recount_sales.py
+#
+# Recounts the copies of each book sold from the orders placed so far, e.g. after adding the
+# `units_sold` column to an existing database. Orders placed from then on keep the count up to date.
+#
+# Run from the project root:
+#     python -m sahara.recount_sales
+
+from sahara import create_app
+from sahara.models import Book
+
+
+def main():
+    with create_app().app_context():
+        count = Book.recount_units_sold()
+    print(f'Recounted the sales of {count} books')
+
+
+if __name__ == '__main__':
+    main()
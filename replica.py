@@ -0,0 +1,135 @@
+# File: replica.py
+#
+# Serving read-only pages from a replica database.
+#
+# Views decorated with `read_only` run their SELECTs against the `replica` bind (set with
+# DATABASE_REPLICA_URI) when the request is a GET, so browsing can be scaled out separately from
+# checkout. A browser that has just written anything gets a cookie that keeps it on the primary for
+# REPLICA_STICKY_SECONDS, so it always sees its own changes even while the replica lags behind.
+#
+# For a SQLite setup, the replica can be a second file kept up to date by running, from the
+# project root:
+#     python -m sahara.replica --interval 5
+
+import argparse
+import sqlite3
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sahara import create_app, db
+from sahara.database import REPLICA_BIND, RoutingSession
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+STICKY_COOKIE = 'read_primary'
+
+
+####################################################################################################
+#                                             ROUTING                                              #
+####################################################################################################
+
+
+def replica_enabled():
+    return REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def read_only(view):
+    """
+    Serves the SELECTs of GET requests to `view` from the replica, unless the browser has written
+    something in the last REPLICA_STICKY_SECONDS.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if (replica_enabled() and request.method in ('GET', 'HEAD')
+                and STICKY_COOKIE not in request.cookies):
+            g.use_replica = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _mark_written():
+    if has_request_context():
+        # Anything read after a write in the same request has to see it too
+        g.use_replica = False
+        g.wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    _mark_written()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _after_execute(orm_execute_state):
+    # Bulk UPDATEs and DELETEs run through session.execute() without a flush
+    if not orm_execute_state.is_select:
+        _mark_written()
+
+
+def init_app(app):
+    app.after_request(stick_to_primary)
+
+
+def stick_to_primary(response):
+    if g.get('wrote') and replica_enabled():
+        response.set_cookie(STICKY_COOKIE, '1',
+                            max_age=current_app.config['REPLICA_STICKY_SECONDS'],
+                            httponly=True, samesite='Lax')
+    return response
+
+
+####################################################################################################
+#                                             COPY JOB                                             #
+####################################################################################################
+
+
+def copy_database(source_path, dest_path):
+    """
+    Copies the SQLite database at `source_path` over the one at `dest_path` with SQLite's online
+    backup API, which gives a consistent snapshot even while the source is being written to.
+    Connections open on the destination see the new contents on their next query.
+    """
+    source = sqlite3.connect(source_path)
+    dest = sqlite3.connect(dest_path, timeout=current_app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+    try:
+        source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep a SQLite read replica up to date.')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between copies (default 5)')
+    parser.add_argument('--once', action='store_true', help='copy once and exit')
+    args = parser.parse_args()
+
+    app = create_app()
+    app.app_context().push()
+    if not replica_enabled():
+        parser.error('DATABASE_REPLICA_URI is not set')
+
+    primary = db.get_engine().url
+    replica = db.get_engine(bind=REPLICA_BIND).url
+    if primary.get_backend_name() != 'sqlite' or replica.get_backend_name() != 'sqlite':
+        parser.error('the copy job only works between SQLite databases')
+
+    while True:
+        started = time.monotonic()
+        copy_database(primary.database, replica.database)
+        print(f'Copied {primary.database} to {replica.database} '
+              f'in {time.monotonic() - started:.2f}s')
+
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
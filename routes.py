@@ -1,23 +1,40 @@
+import hmac
 from os import path
-from flask import render_template, send_from_directory, Flask, flash, redirect, url_for, request
+from flask import (render_template, send_file, send_from_directory, Blueprint, flash, redirect,
+                   url_for, request, abort, current_app, jsonify, Response)
 from flask_login import current_user, login_required, login_user, logout_user
 from flask_mail import Message
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
-from sahara import app, bcrypt, mail
+from sahara import assets, db, images, mail, mail_queue, metrics, passwords, profiler
+from sahara.email_filter import normalize_email
+from sahara.ratelimit import limiter
+from sahara.replica import read_only
+from sahara.storage import covers
+from sahara.suggestions import normalize
 from sahara.forms import (RegistrationForm, LoginForm, EditAddressInfoForm, EditPersonalInfoForm,
                           EditPaymentInfoForm, SearchForm, PasswordResetRequestForm,
-                          PasswordResetForm, AddBook, AddPromoForm, CheckoutForm, AddToCartForm)
+                          PasswordResetForm, AddBook, AddPromoForm, CheckoutForm, AddToCartForm,
+                          UserDirectoryForm, BulkUserStateForm)
 from sahara.models import (Address, PaymentCard, User, Privileges, States, Book, Promotion, Author,
-                           Publisher, BookCategory, Categories, Image, CartItem)
+                           Publisher, BookCategory, Categories, Image, CartItem, book_suggestions)
 
 ####################################################################################################
 #                                            CONSTANTS                                             #
 ####################################################################################################
 
 
-STATIC_DIR = path.join(app.root_path, 'static')
-BOOK_IMAGE_DIR = path.join('/', 'static', 'img', 'books')
-SENDER = ("Sahara Devs", app.config['MAIL_USERNAME'])
+USERS_PER_PAGE = 50
+FAVICON_MAX_AGE = 24 * 60 * 60
+# The bestseller shelves are as wide as the homepage's other shelves
+BESTSELLER_SHELF_SIZE = 3
+# Search suggestions returned, and seconds browsers may reuse them for
+SUGGESTIONS_SHOWN = 8
+SUGGESTIONS_MAX_AGE = 60
+
+
+# Every page of the store
+bp = Blueprint('main', __name__)
 
 
 ####################################################################################################
@@ -25,7 +42,7 @@ SENDER = ("Sahara Devs", app.config['MAIL_USERNAME'])
 ####################################################################################################
 
 def redirect_to_home():
-    return redirect(url_for('home'))
+    return redirect(url_for('.home'))
 
 
 def redirect_if_authenticated():
@@ -34,17 +51,53 @@ def redirect_if_authenticated():
         redirect_to_home()
 
 
-def redirect_if_not_admin():
-    if current_user.privilege.id != Privileges.ADMIN.value:
-        flash('You are not authorized to access this page.')
-        redirect_to_home()
+def current_user_is_admin():
+    return current_user.is_authenticated and current_user.privilege.id == Privileges.ADMIN.value
+
+
+def flash_too_many_attempts():
+    flash('Too many attempts. Please wait a few minutes and try again.')
+
+
+def flash_busy():
+    flash('We are very busy right now. Please try again in a moment.')
 
 
 def send_email(user, subject, body):
-    message = Message(subject=subject, sender=SENDER, recipients=[user.email], body=body)
+    message = Message(subject=subject, recipients=[user.email], body=body)
     mail.send(message)
 
 
+def send_state_changed_email(email, first_name, state_id):
+    if state_id == States.SUSPENDED.value:
+        news = ('Your Sahara account has been suspended. Please contact us if you think this is '
+                'a mistake.')
+    else:
+        news = 'Your Sahara account is active again. Welcome back!'
+
+    body = (
+        f'Hello, {first_name}!\n'
+        '\n'
+        f'{news}\n'
+        '\n'
+        'Sincerely,\n'
+        'The Sahara Team'
+    )
+    message = Message(subject='Sahara Account Status', recipients=[email], body=body)
+    mail_queue.send_async(message)
+
+
+def change_user_states(user_ids, state_id):
+    """
+    Sets the state of every user in `user_ids` (except the administrator) to `state_id` and queues
+    a notification email for each of them. Returns the number of users changed.
+    """
+    changed = User.set_states(user_ids, state_id)
+    for user in changed:
+        send_state_changed_email(user.email, user.first_name, state_id)
+    return len(changed)
+
+
 def send_info_changed_email(user):
     body = (
         f'Hello, {user.first_name}!\n'
@@ -67,18 +120,59 @@ def send_info_changed_email(user):
 
 ################################################################################
 # Favicon ######################################################################
-@app.route('/favicon.ico')
+@bp.route('/favicon.ico')
 def favicon():
     """
     I mean... what would Sahara be without the cactus favicon?
     """
-    return send_from_directory(STATIC_DIR, 'favicon.ico', mimetype='image/vnd.microsoft.icon')
+    # Browsers ask for /favicon.ico by name, so it can't be fingerprinted; a day is a compromise
+    return send_from_directory(current_app.static_folder, 'favicon.ico',
+                               mimetype='image/vnd.microsoft.icon', cache_timeout=FAVICON_MAX_AGE)
+
+
+################################################################################
+# Metrics ######################################################################
+@bp.route('/metrics')
+def prometheus_metrics():
+    """
+    Per-route request latency and SQL query histograms for Prometheus to scrape, served only to
+    requests with an `Authorization: Bearer` header carrying METRICS_TOKEN.
+    """
+    token = current_app.config['METRICS_TOKEN']
+    if not current_app.config['METRICS_ENABLED'] or not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+################################################################################
+# Static Assets ################################################################
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    """
+    Serves a fingerprinted static file built by `python -m sahara.assets`, precompressed if the
+    browser accepts it. Its name changes whenever it does, so browsers may cache it forever.
+    """
+    file_path, encoding = assets.find_variant(filename, request.accept_encodings)
+    if file_path is None or not path.isfile(file_path):
+        abort(404)
+
+    # send_file() hands the open file to the server's wsgi.file_wrapper, so servers that support
+    # it (e.g. gunicorn) send it with sendfile() rather than copying it through Python
+    response = send_file(file_path, mimetype=assets.guess_mimetype(filename), conditional=True)
+    response.headers['Cache-Control'] = assets.IMMUTABLE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 
 ################################################################################
 # Home #########################################################################
-@app.route("/")
-@app.route("/home", methods=['GET', 'POST'])
+@bp.route("/")
+@bp.route("/home", methods=['GET', 'POST'])
+@read_only
 def home():
     """
     Main entry point for this website.
@@ -88,27 +182,44 @@ def home():
     books = Book.get_all()
     almost_gone = Book.search_by_quantity()
     mystery = Book.search_by_category(Categories.MYSTERY.value)
+    bestsellers = Book.bestsellers(limit=BESTSELLER_SHELF_SIZE)
 
-    search_form = SearchForm()
     if path.exists("sahara/templates/homepage.html"):
         return render_template("homepage.html",
-                               search_form=search_form,
                                books=books,
                                len=len(books),
                                almost_gone=almost_gone,
                                mystery=mystery,
-                               len_myst=len(mystery))
+                               len_myst=len(mystery),
+                               bestsellers=bestsellers)
     else:
         return render_template("setup_success.html")
 
 
+################################################################################
+# Category View ################################################################
+@bp.route("/category/<int:category_id>")
+@read_only
+def category(category_id):
+    """
+    Lists the books of a category, under its bestsellers.
+    """
+    if category_id not in {category.value for category in Categories}:
+        abort(404)
+
+    return render_template('category.html',
+                           category=BookCategory.from_id(category_id),
+                           bestsellers=Book.bestsellers(category_id, limit=BESTSELLER_SHELF_SIZE),
+                           books=Book.search_by_category(category_id))
+
+
 ################################################################################
 # Book View ####################################################################
-@app.route("/book/", defaults={'id': '1'}, methods=['GET', 'POST'])
-@app.route("/book/<int:id>", methods=['GET', 'POST'])
+@bp.route("/book/", defaults={'id': '1'}, methods=['GET', 'POST'])
+@bp.route("/book/<int:id>", methods=['GET', 'POST'])
+@read_only
 def book(id):
     book = Book.get_by_id(id)
-    search_form = SearchForm()
     form = AddToCartForm()
     if form.validate_on_submit():
         if current_user.is_authenticated:
@@ -119,12 +230,12 @@ def book(id):
         else:
             # Otherwise, ask user to log in
             flash('Please log in or sign up to add this book to your cart')
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
 
     return render_template('bookPage.html',
-                           search_form=search_form,
                            book=book,
-                           form=form)
+                           form=form,
+                           also_bought=book.also_bought() if book else [])
 
 
 ####################################################################################################
@@ -134,7 +245,7 @@ def book(id):
 
 ################################################################################
 # Login ########################################################################
-@app.route("/login", methods=['GET', 'POST'])
+@bp.route("/login", methods=['GET', 'POST'])
 def login():
     """
     On GET: Renders the login form for the user to see.
@@ -142,18 +253,39 @@ def login():
     """
     redirect_if_authenticated()
     form = LoginForm()
-    search_form = SearchForm()
-    if form.validate_on_submit():
-        if User.exists(form.email.data):
-            user = User.from_email(form.email.data)
 
-            if bcrypt.check_password_hash(user.password, form.password.data):
+    # Throttle by IP before doing any work, and by email before checking the password
+    if request.method == 'POST' and not limiter.allow('login', ip=request.remote_addr):
+        flash_too_many_attempts()
+        return render_template('Login.html', form=form), 429
+
+    if form.validate_on_submit():
+        if not limiter.allow('login', email=normalize_email(form.email.data)):
+            flash_too_many_attempts()
+            return render_template('Login.html', form=form), 429
+
+        user = User.from_email(form.email.data)
+        try:
+            password_matches = user and passwords.check_password(user.password, form.password.data)
+        except passwords.HashTimeout:
+            flash_busy()
+            return render_template('Login.html', form=form), 503
+
+        if user:
+            if password_matches:
+                # Bring the stored hash up to the configured cost while we have the password, unless
+                # the pool is too busy, in which case it's done on a later login
+                if passwords.needs_rehash(user.password):
+                    try:
+                        user.set_password(passwords.hash_password(form.password.data))
+                    except passwords.HashTimeout:
+                        pass
 
                 if user.privilege.id == Privileges.ADMIN.value:
                     remember_me = form.remember_me.data
                     login_user(user, remember=remember_me)
                     flash(f'Login successful for {form.email.data}!')
-                    return redirect(url_for('admin'))
+                    return redirect(url_for('.admin'))
                 else:
                     if user.state.id == States.INACTIVE.value:
                         flash('Please verify your account before trying to log in!')
@@ -163,25 +295,29 @@ def login():
                         remember_me = form.remember_me.data
                         login_user(user, remember=remember_me)
                         flash(f'Login successful for {form.email.data}!')
-                        return redirect(url_for('home'))
+                        return redirect(url_for('.home'))
             else:
                 flash(f'Unsuccesful login. Please try again.')
         else:
             flash(f'Unsuccesful login. Please try again.')
 
-    return render_template('Login.html', form=form, search_form=search_form)
+    return render_template('Login.html', form=form)
 
 
 ################################################################################
 # Register #####################################################################
-@app.route("/register", methods=['GET', 'POST'])
+@bp.route("/register", methods=['GET', 'POST'])
 def register():
     redirect_if_authenticated()
     form = RegistrationForm()
-    search_form = SearchForm()
     if form.validate_on_submit():
-        # Hash password
-        pass_hash = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        # Hash password and card number
+        try:
+            pass_hash = passwords.hash_password(form.password.data)
+            card_num = passwords.hash_password(form.card_num.data) if form.has_card_info() else None
+        except passwords.HashTimeout:
+            flash_busy()
+            return render_template('Signup.html', form=form), 503
 
         # Get address data if applicable
         addr = None
@@ -195,8 +331,6 @@ def register():
         # Get card info
         card_info = []
         if form.has_card_info():
-            card_num = bcrypt.generate_password_hash(form.card_num.data).decode('utf-8')
-
             card_info.append(PaymentCard(
                 type=form.ctype.data,
                 number=card_num,
@@ -217,7 +351,13 @@ def register():
             address=addr,
             payment_cards=card_info,
         )
-        user.commit_to_system()
+        try:
+            user.commit_to_system()
+        except IntegrityError:
+            # Someone registered this email through another worker since the form was validated
+            db.session.rollback()
+            form.email.errors.append('That email is already taken')
+            return render_template('Signup.html', form=form)
 
         # Send confirmation email
         token = user.get_timed_token()
@@ -227,7 +367,7 @@ def register():
             'To validate your account and access our services, please visit the following link '
             'within the next 20 minutes:\n'
             '\n'
-            f'{url_for("validate_account", token=token, _external=True)}\n'
+            f'{url_for(".validate_account", token=token, _external=True)}\n'
             '\n'
             'Thanks for choosing us!\n'
             '\n'
@@ -236,44 +376,42 @@ def register():
         )
         send_email(user, 'Sahara Account Verificaiton', body)
 
-        return redirect(url_for('regconfirm'))
+        return redirect(url_for('.regconfirm'))
 
-    return render_template('Signup.html', form=form, search_form=search_form)
+    return render_template('Signup.html', form=form)
 
 
 ################################################################################
 # Confirm Registration #########################################################
-@app.route("/regconfirm", methods=['GET', 'POST'])
+@bp.route("/regconfirm", methods=['GET', 'POST'])
 def regconfirm():
     redirect_if_authenticated()
-    search_form = SearchForm()
-    return render_template('registrationConfirm.html', search_form=search_form)
+    return render_template('registrationConfirm.html')
 
 
 ################################################################################
 # Validate Account #############################################################
-@app.route('/validate/<token>')
+@bp.route('/validate/<token>')
 def validate_account(token):
     redirect_if_authenticated()
-    search_form = SearchForm()
     user = User.from_timed_token(token)
 
     if user is None:
         flash('This token is expired.')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
 
     user.set_user_state(States.ACTIVE.value)
-    return render_template("VerifyAccountSuccess.html", search_form=search_form)
+    return render_template("VerifyAccountSuccess.html")
 
 
 ################################################################################
 # Logout #######################################################################
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     logout_user()
     flash("You've been logged out.")
-    return redirect(url_for('home'))
+    return redirect(url_for('.home'))
 
 
 ####################################################################################################
@@ -283,23 +421,20 @@ def logout():
 
 ################################################################################
 # Account Home #################################################################
-@app.route("/profile", methods=['GET', 'POST'])
+@bp.route("/profile", methods=['GET', 'POST'])
 @login_required
 def profile():
     orders = current_user.previous_orders
-    search_form = SearchForm()
     return render_template('profile.html',
                            current_user=current_user,
-                           search_form=search_form,
                            orders=orders)
 
 
 ################################################################################
 # Account Home #################################################################
-@app.route("/edit/address", methods=['GET', 'POST'])
+@bp.route("/edit/address", methods=['GET', 'POST'])
 @login_required
 def edit_address():
-    search_form = SearchForm()
     form = EditAddressInfoForm()
 
     if form.validate_on_submit():
@@ -323,29 +458,32 @@ def edit_address():
         flash('Address updated!')
 
         # Redirect to account page
-        return redirect(url_for('profile'))
+        return redirect(url_for('.profile'))
 
     # Display the form
     # stateNum = current_user.address.state
     if current_user.address:
         form.state.data = current_user.address.state
     return render_template("EditAddress.html",
-                           search_form=search_form,
                            form=form,
                            current_user=current_user)
 
 
 ################################################################################
 # Edit Payment Info ############################################################
-@app.route("/edit/cards", methods=['GET', 'POST'])
+@bp.route("/edit/cards", methods=['GET', 'POST'])
 @login_required
 def edit_payment_cards():
     # See if form has been validated
     form = EditPaymentInfoForm()
-    search_form = SearchForm()
     if form.validate_on_submit():
         # Get new payment card
-        card_num = bcrypt.generate_password_hash(form.card_num.data).decode('utf-8')
+        try:
+            card_num = passwords.hash_password(form.card_num.data)
+        except passwords.HashTimeout:
+            flash_busy()
+            return render_template('EditPaymentCards.html', form=form,
+                                   current_user=current_user), 503
         card = PaymentCard(
             type=form.card_type.data,
             number=card_num,
@@ -362,23 +500,21 @@ def edit_payment_cards():
         flash('Payment info updated!')
 
         # Redirect to account page
-        return redirect(url_for('profile'))
+        return redirect(url_for('.profile'))
 
     # Display the form
     return render_template('EditPaymentCards.html',
-                           search_form=search_form,
                            form=form,
                            current_user=current_user)
 
 
 ################################################################################
 # Edit Personal Info ###########################################################
-@app.route("/edit/personal_info", methods=['GET', 'POST'])
+@bp.route("/edit/personal_info", methods=['GET', 'POST'])
 @login_required
 def edit_personal_info():
     # See if form has been validated
     form = EditPersonalInfoForm()
-    search_form = SearchForm()
     if form.validate_on_submit():
         # Get new form data
         first_name = form.first_name.data
@@ -401,28 +537,37 @@ def edit_personal_info():
         flash('Personal info updated!')
 
         # Redirect to account page
-        return redirect(url_for('profile'))
+        return redirect(url_for('.profile'))
 
     # Display the form
     return render_template('EditPersonalInfo.html',
-                           search_form=search_form,
                            form=form,
                            current_user=current_user)
 
 
 ################################################################################
 # Reset Password Request #######################################################
-@app.route("/reset_password_request", methods=['GET', 'POST'])
+@bp.route("/reset_password_request", methods=['GET', 'POST'])
 def reset_password_request():
-    search_form = SearchForm()
-    # See if form has been validated
     form = PasswordResetRequestForm()
+
+    # Throttle by IP before looking the email up, and by email before sending anything
+    if request.method == 'POST' and not limiter.allow('reset_password', ip=request.remote_addr):
+        flash_too_many_attempts()
+        return render_template('ResetPasswordRequest.html',
+                               form=form,
+                               current_user=current_user), 429
+
+    # See if form has been validated
     if form.validate_on_submit():
-        # Get form data
-        email = form.email.data
+        if not limiter.allow('reset_password', email=normalize_email(form.email.data)):
+            flash_too_many_attempts()
+            return render_template('ResetPasswordRequest.html',
+                                   form=form,
+                                   current_user=current_user), 429
 
-        # Get user associated with email
-        user = User.from_email(email)
+        # Get user associated with email (already looked up while validating the form)
+        user = form.user
 
         # Get token for user
         token = user.get_timed_token()
@@ -437,7 +582,7 @@ def reset_password_request():
             'Otherwise, please visit the following link (within the next 20 minutes) to change '
             'your password:\n'
             '\n'
-            f'{url_for("reset_password", token=token, _external=True)}\n'
+            f'{url_for(".reset_password", token=token, _external=True)}\n'
             '\n'
             'Thanks for choosing Sahara!\n'
             '\n'
@@ -452,24 +597,26 @@ def reset_password_request():
         if current_user.is_authenticated:
             logout_user()
 
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     return render_template('ResetPasswordRequest.html',
                            form=form,
-                           search_form=search_form,
                            current_user=current_user)
 
 
 ################################################################################
 # Password Reset ###############################################################
-@app.route("/reset_password/<token>", methods=['GET', 'POST'])
+@bp.route("/reset_password/<token>", methods=['GET', 'POST'])
 def reset_password(token):
-    search_form = SearchForm()
 
     form = PasswordResetForm()
     if form.validate_on_submit():
         # Get form data
-        new_password_hash = bcrypt.generate_password_hash(form.new_password.data).decode('utf-8')
+        try:
+            new_password_hash = passwords.hash_password(form.new_password.data)
+        except passwords.HashTimeout:
+            flash_busy()
+            return render_template('ResetPassword.html', form=form), 503
 
         # Get user associated with token
         user = User.from_timed_token(token)
@@ -477,7 +624,7 @@ def reset_password(token):
         # If such a user exists, change their password
         if user is None:
             flash('This token is expired.')
-            return redirect(url_for('home'))
+            return redirect(url_for('.home'))
         else:
             user.set_password(new_password_hash, commit=True)
 
@@ -487,9 +634,9 @@ def reset_password(token):
         # Send confirmation email
         send_info_changed_email(user)
 
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
-    return render_template('ResetPassword.html', form=form, search_form=search_form)
+    return render_template('ResetPassword.html', form=form)
 
 
 ####################################################################################################
@@ -499,24 +646,24 @@ def reset_password(token):
 
 ##############################################################################
 # Admin Home #################################################################
-@app.route("/admin", methods=['GET', 'POST'])
+@bp.route("/admin", methods=['GET', 'POST'])
 def admin():
-    search_form = SearchForm()
-    return render_template('adminPage.html', search_form=search_form)
+    return render_template('adminPage.html')
 
 
 ##############################################################################
 # Modify Books ###############################################################
-@app.route("/books", methods=['GET', 'POST'])
+@bp.route("/books", methods=['GET', 'POST'])
+@read_only
 def books():
     books = Book.get_all()
-    search_form = SearchForm()
-    return render_template('modifyBooks.html', books=books, len=len(books), search_form=search_form)
+    return render_template('modifyBooks.html', books=books, len=len(books))
 
 
-@app.route("/addBook", methods=['GET', 'POST'])
+@bp.route("/addBook", methods=['GET', 'POST'])
 def addBook():
-    redirect_if_not_admin()
+    if not current_user_is_admin():
+        abort(403)
     form = AddBook()
     if form.validate_on_submit():
 
@@ -538,20 +685,15 @@ def addBook():
 
         book_category = BookCategory.from_id(category_to_enum[form.category.data])
 
+        # Covers are stored by content, so a cover that's already been uploaded is reused rather
+        # than saved (and resized) again
         cover_image = form.cover_image.data
-        filename = path.join(
-            BOOK_IMAGE_DIR,
-            secure_filename(cover_image.filename)
-        )
-
-        cover_image.save(path.join(
-            STATIC_DIR,
-            'img',
-            'books',
-            secure_filename(cover_image.filename)
-        ))
+        extension = path.splitext(secure_filename(cover_image.filename))[1]
+        stored = covers.save(cover_image.stream, extension)
 
-        image = Image.from_filename(filename)
+        image = Image.from_filename(stored.url)
+        if stored.created:
+            images.queue_derivatives(stored.url)
 
         book = Book(
             isbn=form.isbn.data,
@@ -568,12 +710,11 @@ def addBook():
             rating=form.rating.data
         )
         book.commit_to_system()
-        return redirect(url_for('books'))
-    search_form = SearchForm()
-    return render_template('addBook.html', form=form, search_form=search_form)
+        return redirect(url_for('.books'))
+    return render_template('addBook.html', form=form)
 
 
-@app.route("/promos", methods=['GET', 'POST'])
+@bp.route("/promos", methods=['GET', 'POST'])
 def promos():
     form = AddPromoForm()
     if form.validate_on_submit():
@@ -588,17 +729,15 @@ def promos():
 
         flash('Promotion created!')
 
-    search_form = SearchForm()
     promos = Promotion.get_all()
 
     return render_template('addPromo.html',
-                           search_form=search_form,
                            form=form,
                            promos=promos,
                            len=len(promos))
 
 
-@app.route("/send_promo/<promo_id>", methods=['GET', 'POST'])
+@bp.route("/send_promo/<promo_id>", methods=['GET', 'POST'])
 def send_promo(promo_id):
     new_promo = Promotion.from_id(promo_id)
 
@@ -625,47 +764,132 @@ def send_promo(promo_id):
             send_email(user, 'Lucky You! New Promo!', body)
     new_promo.send()
     flash('Promotion sent to users!')
-    return redirect(url_for('promos'))
+    return redirect(url_for('.promos'))
 
 
-@app.route("/delete_promo/<promo_id>", methods=['GET', 'POST'])
+@bp.route("/delete_promo/<promo_id>", methods=['GET', 'POST'])
 def delete_promo(promo_id):
     new_promo = Promotion.from_id(promo_id)
     Promotion.delete(new_promo.id)
     flash('Promotion has been deleted!')
-    return redirect(url_for('promos'))
+    return redirect(url_for('.promos'))
 
 
-@app.route("/users", methods=['GET', 'POST'])
+@bp.route("/users", methods=['GET', 'POST'])
+@read_only
 def users():
-    redirect_if_not_admin()
-    users = User.get_all()
-    search_form = SearchForm()
-    return render_template('modifyUsers.html', users=users, len=len(users), search_form=search_form)
+    if not current_user_is_admin():
+        abort(403)
+    form = UserDirectoryForm(request.args)
+
+    state_id = int(form.state.data) if (form.state.data or '').isdigit() else None
+    is_subscribed = {'yes': True, 'no': False}.get(form.subscribed.data)
+    sort = request.args.get('sort', 'id')
+    descending = request.args.get('order') == 'desc'
+
+    users = User.directory(page=request.args.get('page', 1, type=int),
+                           per_page=USERS_PER_PAGE,
+                           state_id=state_id,
+                           is_subscribed=is_subscribed,
+                           email_prefix=form.email_prefix.data,
+                           sort=sort,
+                           descending=descending)
+
+    return render_template('modifyUsers.html',
+                           users=users,
+                           form=form,
+                           bulk_form=BulkUserStateForm(),
+                           sort=sort,
+                           descending=descending)
+
+
+@bp.route("/users/state", methods=['POST'])
+def bulk_user_state():
+    """
+    Sets the state of every user checked on the user directory page in one go, then queues a
+    notification email for each of them.
+    """
+    if not current_user_is_admin():
+        abort(403)
+    form = BulkUserStateForm()
+    if form.validate_on_submit():
+        num_changed = change_user_states(request.form.getlist('user_ids', type=int),
+                                         int(form.state.data))
+        flash(f'{num_changed} user(s) updated.')
+    else:
+        flash('Please choose a state to apply.')
+
+    # Back to the same page of the directory
+    return redirect(url_for('.users', **request.args.to_dict()))
+
 
+##############################################################################
+# Request Profiles ###########################################################
+@bp.route("/admin/profiles")
+def profile_captures():
+    """
+    Lists the slowest requests captured by the sampling profiler.
+    """
+    if not current_user_is_admin():
+        abort(403)
+    return render_template('profileCaptures.html',
+                           captures=profiler.slowest_captures())
 
-@app.route("/suspend_user/<user_id>")
+
+@bp.route("/admin/profiles/<name>")
+def profile_capture(name):
+    """
+    Shows the most expensive functions of one captured request.
+    """
+    if not current_user_is_admin():
+        abort(403)
+    sort = request.args.get('sort', profiler.REPORT_SORTS[0])
+    capture = profiler.capture_report(name, sort=sort)
+    if capture is None:
+        abort(404)
+
+    metadata, report = capture
+    return render_template('profileCapture.html',
+                           capture=metadata,
+                           report=report,
+                           sort=sort,
+                           sorts=profiler.REPORT_SORTS)
+
+
+@bp.route("/admin/profiles/<name>.prof")
+def download_profile_capture(name):
+    if not current_user_is_admin():
+        abort(403)
+    prof_path = profiler.capture_path(name, '.prof')
+    if prof_path is None or not path.isfile(prof_path):
+        abort(404)
+    return send_file(prof_path, mimetype='application/octet-stream', as_attachment=True,
+                     attachment_filename=f'{name}.prof')
+
+
+@bp.route("/suspend_user/<int:user_id>")
 def suspend_user(user_id):
-    redirect_if_not_admin()
-    user = User.from_id(user_id)
-    user.set_user_state(States.SUSPENDED.value)
-    return redirect(url_for('users'))
+    if not current_user_is_admin():
+        abort(403)
+    change_user_states([user_id], States.SUSPENDED.value)
+    return redirect(url_for('.users'))
 
 
-@app.route("/unsuspend_user/<user_id>")
+@bp.route("/unsuspend_user/<int:user_id>")
 def unsuspend_user(user_id):
-    redirect_if_not_admin()
-    user = User.from_id(user_id)
-    user.set_user_state(States.ACTIVE.value)
-    return redirect(url_for('users'))
+    if not current_user_is_admin():
+        abort(403)
+    change_user_states([user_id], States.ACTIVE.value)
+    return redirect(url_for('.users'))
 
 ####################################################################################################
 #                                          UNCATEGORIZED                                           #
 ####################################################################################################
 
 
-@app.route("/search/", defaults={'term': ''}, methods=['GET', 'POST'])
-@app.route("/search/<string:term>", methods=['GET', 'POST'])
+@bp.route("/search/", defaults={'term': ''}, methods=['GET', 'POST'])
+@bp.route("/search/<string:term>", methods=['GET', 'POST'])
+@read_only
 def search(term):
     search_form = SearchForm()
 
@@ -675,36 +899,60 @@ def search(term):
             term = search_form.search_term.data
         else:
             term = ""
-        return redirect(url_for("search", term=term))
+        return redirect(url_for(".search", term=term))
 
     results = Book.search(term)
 
+    # Nothing contains the term as typed, so look for titles and authors close to it instead
+    did_you_mean = None
+    close_matches = not results and bool(term.strip())
+    if close_matches:
+        results, closest = Book.search_similar(term)
+        if closest and normalize(closest) != normalize(term):
+            did_you_mean = closest
+
     return render_template('searchResults.html',
                            term=term,
-                           search_form=search_form,
-                           results=results)
+                           results=results,
+                           close_matches=close_matches,
+                           did_you_mean=did_you_mean)
+
+
+@bp.route('/api/suggest')
+@read_only
+def suggest():
+    """
+    Returns the best selling books whose title, author or ISBN starts with the query `q`, as JSON,
+    for the search bar to suggest as it's typed in.
+    """
+    query = request.args.get('q', '')[:100]
+    suggestions = [dict(suggestion, url=url_for('.book', id=suggestion['id']))
+                   for suggestion in book_suggestions.suggest(query, SUGGESTIONS_SHOWN)]
+
+    response = jsonify(query=query, suggestions=suggestions)
+    response.cache_control.public = True
+    response.cache_control.max_age = SUGGESTIONS_MAX_AGE
+    return response
 
 
 @login_required
-@app.route("/cart", methods=['GET', 'POST'])
+@bp.route("/cart", methods=['GET', 'POST'])
 def cart():
-    search_form = SearchForm()
     return render_template('Cart.html',
-                           search_form=search_form,
                            current_user=current_user)
 
 
 @login_required
-@app.route('/add_to_cart/<book_id>')
+@bp.route('/add_to_cart/<book_id>')
 def add_to_cart(book_id):
     book_to_add = Book.get_by_id(book_id)
     current_user.cart.add_book(book_to_add)
     flash('This book has been added to your cart!')
-    return redirect(url_for('book', id=book_id))
+    return redirect(url_for('.book', id=book_id))
 
 
 @login_required
-@app.route('/remove_from_cart/<book_id>')
+@bp.route('/remove_from_cart/<book_id>')
 def remove_from_cart(book_id):
     book_to_remove = Book.get_by_id(book_id)
 
@@ -714,11 +962,11 @@ def remove_from_cart(book_id):
         current_user.cart.remove_book(book_to_remove)
 
     flash('This book has been removed to your cart!')
-    return redirect(url_for('cart'))
+    return redirect(url_for('.cart'))
 
 
 @login_required
-@app.route('/update_quantity/<book_id>/<new_quantity>')
+@bp.route('/update_quantity/<book_id>/<new_quantity>')
 def update_quantity(book_id, new_quantity):
     book_to_update = Book.get_by_id(book_id)
     cart_item = CartItem.from_cart_id(current_user.cart.id, book_to_update.id)
@@ -740,17 +988,16 @@ def update_quantity(book_id, new_quantity):
             current_user.cart.add_book(book_to_update)
 
     flash('The quantity has been updated!')
-    return redirect(url_for('cart'))
+    return redirect(url_for('.cart'))
 
 
 @login_required
-@app.route('/checkout', methods=['GET', 'POST'])
+@bp.route('/checkout', methods=['GET', 'POST'])
 def checkout():
     year = ''
     if len(current_user.payment_cards) > 0:
         year = abs(current_user.payment_cards[0].expiration_date.year) % 100
 
-    search_form = SearchForm()
     form = CheckoutForm()
     if current_user.address:
         form.state.data = current_user.address.state
@@ -765,7 +1012,11 @@ def checkout():
                                    zip_code=form.zip_code.data)
 
         # Get card info
-        card_num = bcrypt.generate_password_hash(form.card_num.data).decode('utf-8')
+        try:
+            card_num = passwords.hash_password(form.card_num.data)
+        except passwords.HashTimeout:
+            flash_busy()
+            return render_template('Checkout.html', form=form, year=year), 503
         payment_card = PaymentCard(
             type=form.card_type.data,
             number=card_num,
@@ -788,7 +1039,7 @@ def checkout():
                 flash('Uh oh! Looks like someone took your book out from under you!\n'
                       f'We only have {cart_item.book.quantity} copies of {cart_item.book.title}\n'
                       ' left to sell.')
-                return redirect(url_for('checkout'))
+                return redirect(url_for('.checkout'))
 
         current_user.confirm_order(
             promotion_applied=promo,
@@ -831,22 +1082,21 @@ def checkout():
                 'The Sahara Team')
         send_email(current_user, 'Purchase Confirmation', body)
 
-        return redirect(url_for('confirmation'))
-    return render_template('Checkout.html', form=form, search_form=search_form, year=year)
+        return redirect(url_for('.confirmation'))
+    return render_template('Checkout.html', form=form, year=year)
 
-@app.route("/confirmation/", defaults={'promo_id': '-1'}, methods=['GET', 'POST'])
-@app.route("/confirmation/<promo_id>", methods=['GET', 'POST'])
+@bp.route("/confirmation/", defaults={'promo_id': '-1'}, methods=['GET', 'POST'])
+@bp.route("/confirmation/<promo_id>", methods=['GET', 'POST'])
 def confirmation(promo_id):
     
     order = current_user.previous_orders[-1]
     promo = order.promotion_applied
-    search_form = SearchForm()
 
-    return render_template('OrderConfirmation.html', search_form=search_form, order=order, promo=promo)
+    return render_template('OrderConfirmation.html', order=order, promo=promo)
 
 
 @login_required
-@app.route('/remove_payment_card/<card_id>')
+@bp.route('/remove_payment_card/<card_id>')
 def remove_payment_card(card_id):
     card = PaymentCard.from_id(card_id)
     if card:
@@ -854,12 +1104,11 @@ def remove_payment_card(card_id):
         flash(f'Your card ending in {card.last_four_digits} has been removed')
     else:
         flash('An error has occured')
-    return redirect(url_for('profile'))
+    return redirect(url_for('.profile'))
 
 
 @login_required
-@app.route('/order_history')
+@bp.route('/order_history')
 def order_history():
     orders = current_user.previous_orders
-    search_form = SearchForm()
-    return render_template('orderHistory.html', orders=orders, search_form=search_form)
+    return render_template('orderHistory.html', orders=orders)
@@ -1,4 +1,6 @@
-from sahara import app
+from sahara import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True)
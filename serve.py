@@ -0,0 +1,103 @@
+# File: serve.py
+#
+# Running the app in production, under gunicorn.
+#
+# `run.py` starts Flask's development server: one process, with the debugger and the reloader. This
+# starts SERVER_WORKERS gunicorn worker processes instead, each serving SERVER_THREADS requests at
+# a time (with the default `gthread` workers), so a request waiting on the database or the mail
+# server doesn't hold up the others. Everything is read from the same environment and .env as
+# `create_app()`. Run it from the folder containing the `sahara` package:
+#     python -m sahara.serve
+#
+# With PRELOAD set, the app is created once in the master process and shared by the workers forked
+# from it. Send the master SIGHUP to replace the workers gracefully; with PRELOAD, new code only
+# takes effect by starting a new master (SIGUSR2, then SIGTERM to the old one).
+
+from flask import Flask
+from sahara import configure, create_app
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+
+####################################################################################################
+#                                              SERVER                                              #
+####################################################################################################
+
+
+def server_options(config):
+    """
+    Returns the gunicorn settings given by the app `config`.
+    """
+    options = {
+        'bind': config['SERVER_BIND'],
+        'workers': config['SERVER_WORKERS'],
+        'worker_class': config['SERVER_WORKER_CLASS'],
+        'threads': config['SERVER_THREADS'],
+        'timeout': config['SERVER_TIMEOUT'],
+        'graceful_timeout': config['SERVER_GRACEFUL_TIMEOUT'],
+        'preload_app': config['PRELOAD'],
+        'pidfile': config['SERVER_PIDFILE'],
+    }
+    if config['SERVER_MAX_REQUESTS']:
+        # Recycling workers now and then bounds any slow leak; the jitter stops them all restarting
+        # at once
+        options['max_requests'] = config['SERVER_MAX_REQUESTS']
+        options['max_requests_jitter'] = config['SERVER_MAX_REQUESTS'] // 10
+    return options
+
+
+class SaharaServer(BaseApplication):
+    """
+    Gunicorn running `create_app()` with the settings `options`.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Called once in the master with preload_app, and once in each worker otherwise
+        return create_app()
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    if BaseApplication is object:
+        raise SystemExit('The production server needs gunicorn: pip install gunicorn')
+
+    # Only the configuration is needed here; the app itself is created by SaharaServer.load()
+    settings = Flask(__name__)
+    configure(settings)
+    options = server_options(settings.config)
+    if options['worker_class'] not in WORKER_CLASSES:
+        raise SystemExit(f'SERVER_WORKER_CLASS must be one of {", ".join(WORKER_CLASSES)}')
+
+    if options['worker_class'] == 'gevent':
+        # Patched before the app (and its locks and connections) is created, rather than when the
+        # workers start, in case it's preloaded
+        from gevent import monkey
+        monkey.patch_all()
+
+    SaharaServer(options).run()
+
+
+if __name__ == '__main__':
+    main()
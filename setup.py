@@ -1,35 +1,65 @@
 # File: setup.py
 #
 # Run this file before running the project.
+#
+# By default the store is filled with the first 60 books of main_dataset.csv, whose covers are
+# downloaded. To work offline, or with more data, pass --offline to generate the store instead (see
+# fixtures.py):
+#     python setup.py --offline --books 1000 --users 1000 --orders 5000
 
-from sahara import bcrypt, db
+import argparse
+from sahara import create_app, db, fixtures, passwords
 from sahara.models import User
-from init_books import generate_books
 
 # Constants
 ADMIN_PASSWORD = 'password'
 
+# Options
+parser = argparse.ArgumentParser(description='Set up the Sahara database.')
+parser.add_argument('--offline', action='store_true',
+                    help='generate the books, customers and orders rather than downloading books')
+parser.add_argument('--books', type=int, default=1_000, help='books to generate (default 1000)')
+parser.add_argument('--users', type=int, default=1_000,
+                    help='customers to generate (default 1000)')
+parser.add_argument('--orders', type=int, default=5_000,
+                    help='orders to generate (default 5000)')
+parser.add_argument('--seed', type=int, default=1, help='seed for the generated data (default 1)')
+args = parser.parse_args()
+
+app = create_app()
+app.app_context().push()
+
 # Reset database
 print('Resetting database... ', end='')
 db.drop_all()
 db.create_all()
 print('done.')
 
-# Create admin user
-print('Creating admin user... ', end='')
-admin = User(
-    email='admin@sahara.com',
-    password=bcrypt.generate_password_hash(ADMIN_PASSWORD).decode('utf-8'),
-    is_subscribed=False,
-    first_name='Sahara',
-    last_name='Devs',
-    phone_number='0123456789'
-)
-admin.commit_to_system()
-print('done.')
+if args.offline:
+    # The generated store has the same admin account, whose password is also ADMIN_PASSWORD
+    print('Generating the store... ', end='', flush=True)
+    counts = fixtures.generate(args.books, args.users, num_orders=args.orders, num_promotions=24,
+                               seed=args.seed)
+    print(f'done ({sum(counts.values())} rows).')
+else:
+    # Create admin user
+    print('Creating admin user... ', end='')
+    admin = User(
+        email='admin@sahara.com',
+        password=passwords.hash_password(ADMIN_PASSWORD),
+        is_subscribed=False,
+        first_name='Sahara',
+        last_name='Devs',
+        phone_number='0123456789'
+    )
+    admin.commit_to_system()
+    print('done.')
 
-print('Generating books... ')
-generate_books(60)
-print('done.')
+    # Imported here, as it needs requests, which the offline setup doesn't
+    from init_books import generate_books
+
+    print('Generating books... ')
+    generate_books(60)
+    print('done.')
 
 print('Good to go!')
@@ -0,0 +1,44 @@
+// Suggests books in the search bar as a search is typed, from /api/suggest.
+(function () {
+	var input = document.getElementById('search');
+	var list = document.getElementById('search-suggestions');
+	if (!input || !list) {
+		return;
+	}
+
+	var timer = null;
+	var latest = '';
+
+	function show(suggestions) {
+		list.innerHTML = '';
+		suggestions.forEach(function (suggestion) {
+			var option = document.createElement('option');
+			option.value = suggestion.title;
+			option.label = suggestion.authors ? 'by ' + suggestion.authors : suggestion.isbn;
+			list.appendChild(option);
+		});
+	}
+
+	input.addEventListener('input', function () {
+		var query = input.value.trim();
+		clearTimeout(timer);
+		if (!query) {
+			show([]);
+			return;
+		}
+
+		// Wait for a pause in typing rather than asking on every key
+		timer = setTimeout(function () {
+			latest = query;
+			fetch(list.dataset.url + '?q=' + encodeURIComponent(query))
+				.then(function (response) { return response.json(); })
+				.then(function (data) {
+					// Answers can arrive out of order; only the last query's matter
+					if (data.query === latest) {
+						show(data.suggestions);
+					}
+				})
+				.catch(function () {});
+		}, 100);
+	});
+})();
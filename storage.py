@@ -0,0 +1,138 @@
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+from os import path
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+####################################################################################################
+#                                            CONSTANTS                                             #
+####################################################################################################
+
+
+# Size of the pieces uploads are read in, so a large file is never held in memory whole
+CHUNK_SIZE = 64 * 1024
+
+# Number of two-character directory levels covers are spread across, so that no directory ends
+# up holding every cover
+SHARD_DEPTH = 2
+
+
+# What `CoverStorage.save()` returns: the URL the file is served from, and whether it was new (as
+# opposed to the same content having been stored before)
+StoredCover = namedtuple('StoredCover', ['url', 'created'])
+
+
+####################################################################################################
+#                                            INTERFACE                                             #
+####################################################################################################
+
+
+class CoverStorage:
+    """
+    Where book cover images are kept.
+
+    Covers are stored under the SHA-256 hash of their contents, so uploading the same image twice
+    stores it once, and two different images can never overwrite each other however they were
+    named. Since a stored file never changes, its URL can be cached forever.
+    """
+
+    @staticmethod
+    def key(digest, extension):
+        """
+        Returns the name the file with SHA-256 hex `digest` is stored under, e.g.
+        "3f/9a/3f9a...c2.jpg".
+        """
+        shards = [digest[2 * i:2 * i + 2] for i in range(SHARD_DEPTH)]
+        return '/'.join(shards + [f'{digest}.{extension.lower().lstrip(".")}'])
+
+    def save(self, stream, extension):
+        """
+        Stores the contents of the file-like object `stream`, read a chunk at a time, as a file
+        with `extension` (e.g. "jpg"), and returns a `StoredCover`.
+        """
+        raise NotImplementedError
+
+    def url(self, key):
+        """
+        Returns the URL the file stored under `key` is served from.
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+
+####################################################################################################
+#                                          LOCAL STORAGE                                           #
+####################################################################################################
+
+
+class LocalCoverStorage(CoverStorage):
+    """
+    Keeps covers in a directory served by the app, e.g. static/img/books.
+
+    Only the node a cover was uploaded to has it, so with more than one app node this should be
+    replaced by an implementation backed by a shared object store.
+    """
+
+    def __init__(self, root_dir, base_url):
+        self.root_dir = root_dir
+        self.base_url = base_url.rstrip('/')
+
+    def path(self, key):
+        """
+        Returns the location on disk of the file stored under `key`.
+        """
+        return path.join(self.root_dir, *key.split('/'))
+
+    def url(self, key):
+        return f'{self.base_url}/{key}'
+
+    def exists(self, key):
+        return path.isfile(self.path(key))
+
+    def save(self, stream, extension):
+        os.makedirs(self.root_dir, exist_ok=True)
+
+        # The hash is only known once the whole file has been read, so write it under a temporary
+        # name in the same directory tree, then move it into place
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+
+            key = self.key(digest.hexdigest(), extension)
+            if self.exists(key):
+                os.remove(tmp_path)
+                return StoredCover(self.url(key), created=False)
+
+            # mkstemp() makes the file readable by its owner only
+            os.chmod(tmp_path, 0o644)
+            os.makedirs(path.dirname(self.path(key)), exist_ok=True)
+            os.replace(tmp_path, self.path(key))
+            return StoredCover(self.url(key), created=True)
+        except BaseException:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def create_storage(app):
+    """
+    Returns the `CoverStorage` the covers of `app` are kept in.
+    """
+    return LocalCoverStorage(path.join(app.static_folder, 'img', 'books'),
+                             f'{app.static_url_path}/img/books')
+
+
+def init_app(app):
+    app.extensions['sahara_covers'] = create_storage(app)
+
+
+# The `CoverStorage` of the current app
+covers = LocalProxy(lambda: current_app.extensions['sahara_covers'])
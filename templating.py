@@ -0,0 +1,75 @@
+# File: templating.py
+#
+# Faster template rendering: compiled templates are cached on disk, so new workers load them instead
+# of compiling every template again, and the parts of the layout that are the same on every page can
+# be cached once rendered.
+#
+# A fragment is cached with the `cache` tag, given a name and any values the fragment depends on:
+#     {% cache 'header', current_user.is_authenticated %}...{% endcache %}
+# It is rendered once per process for each combination of those values, so anything specific to the
+# request (flashed messages, form data, the cart) must stay outside of it. In debug mode, where
+# edited templates are reloaded, fragments aren't cached.
+
+import os
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sahara.forms import SearchForm
+
+####################################################################################################
+#                                        FRAGMENT CACHING                                          #
+####################################################################################################
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds the `{% cache name, *values %}...{% endcache %}` tag, which renders its body once per
+    process for each distinct tuple of `name` and `values` in a template and keeps the result.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache={}, fragment_cache_enabled=True)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        values = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            values.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        args = [nodes.Const(parser.name), nodes.Tuple(values, 'load')]
+        return nodes.CallBlock(self.call_method('_render_cached', args), [], [], body) \
+            .set_lineno(lineno)
+
+    def _render_cached(self, template, values, caller):
+        if not self.environment.fragment_cache_enabled or self.environment.auto_reload:
+            return caller()
+
+        key = (template, values)
+        fragment = self.environment.fragment_cache.get(key)
+        if fragment is None:
+            fragment = Markup(caller())
+            self.environment.fragment_cache[key] = fragment
+        return fragment
+
+
+####################################################################################################
+#                                              SETUP                                               #
+####################################################################################################
+
+
+def init_app(app):
+    """
+    Sets up the bytecode cache and the `cache` tag for the templates of `app`, and makes
+    `SearchForm` available to them for the search bar.
+    """
+    bytecode_dir = app.config['TEMPLATE_BYTECODE_DIR']
+    if bytecode_dir:
+        os.makedirs(bytecode_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache_enabled = app.config['TEMPLATE_FRAGMENT_CACHE']
+    app.add_template_global(SearchForm)
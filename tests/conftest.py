@@ -0,0 +1,38 @@
+# File: tests/conftest.py
+#
+# Fixtures shared by the tests.
+
+import pytest
+from sahara import create_app, db, fixtures
+from sahara.models import States, User, registered_emails
+
+####################################################################################################
+#                                             FIXTURES                                             #
+####################################################################################################
+
+
+NUM_BOOKS = 5
+NUM_CUSTOMERS = 5
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "site.db"}',
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'RATELIMIT_ENABLED': False,
+        'BCRYPT_LOG_ROUNDS': 4,
+        'PASSWORD_HASH_WORKERS': 0,
+        'TEMPLATE_BYTECODE_DIR': '',
+        'METRICS_ENABLED': False,
+    })
+    with app.app_context():
+        db.create_all()
+        # Built again from this test's database on first use
+        registered_emails.reset()
+        fixtures.generate(NUM_BOOKS, NUM_CUSTOMERS, placeholder_covers=False)
+        # Every customer starts out active, so that they can log in
+        User.set_states(range(2, NUM_CUSTOMERS + 2), States.ACTIVE.value)
+        yield app
+        db.session.remove()
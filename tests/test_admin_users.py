@@ -0,0 +1,85 @@
+# File: tests/test_admin_users.py
+#
+# Changing user states from the admin user directory. Run from the folder containing the `sahara`
+# package:
+#     python -m pytest sahara/tests
+
+import pytest
+from sahara import db, fixtures, routes
+from sahara.models import States, User
+
+####################################################################################################
+#                                             FIXTURES                                             #
+####################################################################################################
+
+
+ADMIN_EMAIL = 'admin@sahara.com'
+
+
+@pytest.fixture
+def sent_emails(monkeypatch):
+    sent = []
+    monkeypatch.setattr(routes, 'send_state_changed_email',
+                        lambda email, first_name, state_id: sent.append((email, state_id)))
+    return sent
+
+
+def log_in(client, email):
+    response = client.post('/login', data={'email': email, 'password': fixtures.PASSWORD})
+    assert response.status_code == 302
+
+
+def states(user_ids):
+    db.session.expire_all()
+    return [User.from_id(user_id).state.id for user_id in user_ids]
+
+
+####################################################################################################
+#                                              TESTS                                               #
+####################################################################################################
+
+
+def test_customer_cannot_bulk_change_states(app, sent_emails):
+    client = app.test_client()
+    log_in(client, User.from_id(2).email)
+
+    response = client.post('/users/state', data={'state': str(States.SUSPENDED.value),
+                                                 'user_ids': ['3', '4', '5']})
+
+    assert response.status_code == 403
+    assert states([3, 4, 5]) == [States.ACTIVE.value] * 3
+    assert sent_emails == []
+
+
+def test_customer_cannot_suspend_a_user(app, sent_emails):
+    client = app.test_client()
+    log_in(client, User.from_id(2).email)
+
+    assert client.get('/suspend_user/3').status_code == 403
+    assert states([3]) == [States.ACTIVE.value]
+
+
+def test_admin_bulk_changes_states_and_emails_each_user(app, sent_emails):
+    client = app.test_client()
+    log_in(client, ADMIN_EMAIL)
+
+    response = client.post('/users/state', data={'state': str(States.SUSPENDED.value),
+                                                 'user_ids': ['1', '3', '4']})
+
+    assert response.status_code == 302
+    # The administrator is never suspended
+    assert states([1, 3, 4]) == [States.ACTIVE.value] + [States.SUSPENDED.value] * 2
+    assert sorted(state for _, state in sent_emails) == [States.SUSPENDED.value] * 2
+
+
+def test_admin_single_suspend_and_unsuspend_email_the_user(app, sent_emails):
+    client = app.test_client()
+    log_in(client, ADMIN_EMAIL)
+    email = User.from_id(3).email
+
+    client.get('/suspend_user/3')
+    assert states([3]) == [States.SUSPENDED.value]
+    client.get('/unsuspend_user/3')
+    assert states([3]) == [States.ACTIVE.value]
+
+    assert sent_emails == [(email, States.SUSPENDED.value), (email, States.ACTIVE.value)]
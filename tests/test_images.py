@@ -0,0 +1,31 @@
+# File: tests/test_images.py
+#
+# Finding the derivatives of book covers, including the ones recorded on Windows. Run from the
+# folder containing the `sahara` package:
+#     python -m pytest sahara/tests
+
+from os import path
+from sahara import images
+
+####################################################################################################
+#                                              TESTS                                               #
+####################################################################################################
+
+
+# As recorded in the database that ships with the project
+LEGACY_FILENAME = '/static\\img\\books\\9781509858637.jpg'
+
+
+def test_derivatives_of_a_cover_recorded_with_backslashes(app):
+    assert images.derivative_name(LEGACY_FILENAME, 'thumb', 'webp') == '9781509858637-thumb.webp'
+    assert images.derivative_url(LEGACY_FILENAME, 'thumb', 'webp') == \
+        '/static/img/books/derived/9781509858637-thumb.webp'
+    assert path.isfile(images.to_disk_path(LEGACY_FILENAME))
+
+
+def test_cover_recorded_with_backslashes_is_shown_from_a_valid_url(app):
+    html = images.cover_picture(LEGACY_FILENAME, 'thumb', alt='Cover')
+
+    # The original, or its derivative once it's been made
+    assert 'src="/static/img/books/' in html
+    assert '\\' not in html
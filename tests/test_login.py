@@ -0,0 +1,33 @@
+# File: tests/test_login.py
+#
+# Logging in, whatever the case the email is typed in. Run from the folder containing the `sahara`
+# package:
+#     python -m pytest sahara/tests
+
+from sahara import fixtures
+from sahara.models import User
+
+####################################################################################################
+#                                              TESTS                                               #
+####################################################################################################
+
+
+def log_in(client, email):
+    return client.post('/login', data={'email': email, 'password': fixtures.PASSWORD})
+
+
+def test_login_ignores_the_case_of_the_email(app):
+    email = User.from_id(2).email
+
+    response = log_in(app.test_client(), email.upper())
+
+    assert response.status_code == 302
+    assert User.exists(email.title())
+    assert User.from_email(email.upper()).id == 2
+
+
+def test_login_with_an_unregistered_email_fails(app):
+    response = log_in(app.test_client(), 'nobody@example.com')
+
+    assert response.status_code == 200
+    assert not User.exists('nobody@example.com')
@@ -0,0 +1,85 @@
+# File: upgrade.py
+#
+# Brings a database created by an earlier version of the store up to the current models, without
+# touching its data. `db.create_all()` only creates the tables that are missing, so the columns and
+# indexes added to existing tables since (e.g. on users' names for the user directory) would
+# otherwise never be made. Every step checks before changing anything, so it's safe to run more
+# than once.
+#
+# Run from the project root, with the app stopped:
+#     python -m sahara.upgrade
+
+from sqlalchemy import inspect, text
+from sahara import create_app, db
+from sahara.models import Book
+
+####################################################################################################
+#                                              STEPS                                               #
+####################################################################################################
+
+
+def create_missing_tables(engine):
+    """
+    Creates, with their indexes, the tables the models declare that the database doesn't have (e.g.
+    the books recommended with each book), and returns their names.
+    """
+    inspector = inspect(engine)
+    missing = [table for table in db.metadata.sorted_tables if not inspector.has_table(table.name)]
+    db.metadata.create_all(bind=engine, tables=missing)
+    return [table.name for table in missing]
+
+
+def add_units_sold(engine):
+    """
+    Adds the count of copies sold to each book if the database doesn't have it, counting them from
+    past orders, and returns whether it was added.
+    """
+    if 'units_sold' in {column['name'] for column in inspect(engine).get_columns('book')}:
+        return False
+
+    with engine.begin() as connection:
+        connection.execute(
+            text('ALTER TABLE book ADD COLUMN units_sold INTEGER NOT NULL DEFAULT 0'))
+    Book.recount_units_sold()
+    return True
+
+
+def create_missing_indexes(engine):
+    """
+    Creates every index the models declare that the database doesn't have, and returns their
+    names. Indexes on tables or columns the database doesn't have yet are left out.
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing and {column.name for column in index.columns} <= columns:
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+####################################################################################################
+#                                               MAIN                                               #
+####################################################################################################
+
+
+def main():
+    with create_app().app_context():
+        engine = db.get_engine()
+        for name in create_missing_tables(engine):
+            print(f'Created table {name}')
+        if add_units_sold(engine):
+            print('Added and recounted the copies sold of each book')
+        for name in create_missing_indexes(engine):
+            print(f'Created index {name}')
+    print('The database is up to date')
+
+
+if __name__ == '__main__':
+    main()
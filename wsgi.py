@@ -0,0 +1,8 @@
+# File: wsgi.py
+#
+# The app, for WSGI servers that import it themselves rather than being started by serve.py, e.g.:
+#     gunicorn --workers 4 --threads 8 sahara.wsgi:app
+
+from sahara import create_app
+
+app = create_app()